@@ -0,0 +1,286 @@
+# Copyright (C) 2015 Associated Universities, Inc. Washington DC, USA.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+# Correspondence concerning GBT software should be addressed as follows:
+#       GBT Operations
+#       National Radio Astronomy Observatory
+#       P. O. Box 2
+#       Green Bank, WV 24944-0002 USA
+
+
+import os
+import time
+
+import numpy as np
+from astropy.io import fits as pyfits
+
+from .write_cube import append_cube_hdu, create_cube_file
+
+ACCUMULATOR_VERSION = 1
+
+# the header keywords that must match for new data to be added to a map,
+# the values are the allowed differences (fractions of CDELTn for CRVALn)
+_MAP_KEYWORDS = {
+    "CTYPE1": None,
+    "CTYPE2": None,
+    "CTYPE3": None,
+    "CDELT1": 1.0e-9,
+    "CDELT2": 1.0e-9,
+    "CDELT3": 1.0e-6,
+    "CRPIX1": 1.0e-6,
+    "CRPIX2": 1.0e-6,
+    "CRPIX3": 1.0e-6,
+    "CRVAL1": 1.0e-6,
+    "CRVAL2": 1.0e-6,
+    "CRVAL3": 1.0e-3,
+    "BMAJ": 1.0e-9,
+}
+
+
+def read_accumulator(accFile, verbose=4):
+    """Read the header and the list of gridded files of an accumulator file.
+
+    Returns (accHdr, ingested) where accHdr is the PHDU header and ingested
+    is a list of dictionaries, one per SDFITS file already gridded into it,
+    with the fields of the INGESTED table in lower case.  Returns
+    (None, []) if accFile does not exist yet and (None, None) if it can not
+    be used.
+    """
+    if not os.path.exists(accFile):
+        return (None, [])
+
+    try:
+        with pyfits.open(accFile) as hdul:
+            accHdr = hdul[0].header
+            if accHdr.get("ACCUMVER") != ACCUMULATOR_VERSION or len(hdul) != 3:
+                if verbose > 1:
+                    print("%s is not a gbtgridder accumulator file" % accFile)
+                return (None, None)
+            table = hdul["INGESTED"].data
+            ingested = [
+                {name.lower(): row[name] for name in table.columns.names}
+                for row in table
+            ]
+    except (OSError, KeyError) as e:
+        if verbose > 1:
+            print("Unable to read the accumulator %s : %s" % (accFile, e))
+        return (None, None)
+
+    return (accHdr, ingested)
+
+
+def read_accumulator_region(accFile, chanStart, chanStop, x0, x1, y0, y1):
+    """The accumulated sums for a block of channels and pixels.
+
+    Returns (dataSum, weightSum), float64 (nchan, ny, nx) copies of that
+    part of the unweighted data and weight cubes.
+    """
+    with pyfits.open(accFile, memmap=True) as hdul:
+        region = (0, slice(chanStart, chanStop), slice(y0, y1), slice(x0, x1))
+        dataSum = hdul[0].data[region].astype(np.float64)
+        weightSum = hdul["WEIGHT"].data[region].astype(np.float64)
+    return (dataSum, weightSum)
+
+
+def file_identity(sdfitsFile):
+    """The (path, size, mtime) recorded for each SDFITS file in an accumulator."""
+    stat = os.stat(sdfitsFile)
+    return (os.path.abspath(sdfitsFile), stat.st_size, stat.st_mtime_ns)
+
+
+def scan_numbers(scans):
+    """The scan numbers in a SCANS value of the INGESTED table, e.g. "1:3,7"."""
+    result = set()
+    for item in scans.split(","):
+        if len(item) == 0:
+            continue
+        ends = [int(value) for value in item.split(":")]
+        result.update(range(ends[0], ends[-1] + 1))
+    return result
+
+
+def new_files(sdfitsFiles, ingested, scanlist=None, verbose=4):
+    """The SDFITS files and scans that have not been gridded into the
+    accumulator yet.
+
+    scanlist is the list of scans selected now, None for all scans.  For a
+    file already in the accumulator only the selected scans that are in the
+    file and not in its SCANS yet are gridded, those scans are then given in
+    fileScanlists.
+
+    Returns (files, fileScanlists), the files to grid and a dictionary of
+    the scans to select from those already in the accumulator.
+
+    A file that has been gridded in can not be taken out again, so if one
+    has changed since then the accumulator can not be brought up to date.
+    That is reported and None is returned.
+    """
+    known = {}
+    doneScans = {}
+    for entry in ingested:
+        known[entry["file"]] = (entry["size"], entry["mtime"])
+        doneScans.setdefault(entry["file"], set()).update(scan_numbers(entry["scans"]))
+
+    files = []
+    fileScanlists = {}
+    for sdfitsFile in sdfitsFiles:
+        if sdfitsFile in files:
+            continue
+        path, size, mtime = file_identity(sdfitsFile)
+        if path not in known:
+            files.append(sdfitsFile)
+            continue
+        if known[path] != (size, mtime):
+            if verbose > 1:
+                print("%s has changed since it was added to the accumulator" % path)
+                print("grid all of the data again into a new accumulator")
+            return None
+        # only the selected scans that are in this file
+        with pyfits.open(sdfitsFile, memmap=True) as hdul:
+            selected = set(np.unique(hdul[1].data.field("scan")).tolist())
+        if scanlist is not None:
+            selected &= set(scanlist)
+        newScans = sorted(selected - doneScans[path])
+        if len(newScans) == 0:
+            if verbose > 3:
+                print("%s is already in the accumulator, skipping" % sdfitsFile)
+            continue
+        if verbose > 3:
+            print(
+                "%s is already in the accumulator, adding %d more scans"
+                % (sdfitsFile, len(newScans))
+            )
+        files.append(sdfitsFile)
+        fileScanlists[sdfitsFile] = newScans
+    return (files, fileScanlists)
+
+
+def check_accumulator(accHdr, hdr, kernel, nchan, verbose=4):
+    """Check that new data with map header hdr can be added to an accumulator.
+
+    accHdr is the header of the accumulator and nchan the number of channels
+    of the new data.  The map, spectral axis, beam and kernel must all be
+    the same.  Returns True if they are.
+    """
+    if accHdr.get("KERNEL") != kernel:
+        if verbose > 1:
+            print(
+                "The accumulated map used the %s kernel, not %s"
+                % (accHdr.get("KERNEL"), kernel)
+            )
+        return False
+    shape = (hdr["NAXIS1"], hdr["NAXIS2"], nchan)
+    accShape = (accHdr["NAXIS1"], accHdr["NAXIS2"], accHdr["NAXIS3"])
+    if shape != accShape:
+        if verbose > 1:
+            print(
+                "The new data do not match the accumulated map, the shape is %s not %s"
+                % (shape, accShape)
+            )
+        return False
+    for key, tolerance in _MAP_KEYWORDS.items():
+        accValue = accHdr.get(key)
+        value = hdr.get(key)
+        if tolerance is None or accValue is None or value is None:
+            same = accValue == value
+        elif key.startswith("CRVAL"):
+            scale = abs(accHdr.get("CDELT" + key[5:], 1.0))
+            same = abs(accValue - value) <= tolerance * scale
+        else:
+            same = abs(accValue - value) <= tolerance * max(abs(accValue), 1.0)
+        if not same:
+            if verbose > 1:
+                print(
+                    "The new data do not match the accumulated map, %s is %s not %s"
+                    % (key, value, accValue)
+                )
+            return False
+    return True
+
+
+def create_accumulator(accFile, hdr, kernel, nchan, ny, nx):
+    """Start a new accumulator file with zero sums.
+
+    The PHDU holds the unweighted data cube (the sum of the weighted
+    spectra) with the map header hdr, the WEIGHT extension the weight cube.
+    Both are float64 so that many sessions can be added up.  The INGESTED
+    table is added by finish_accumulator.
+
+    Returns (dataOffset, weightOffset), the data offsets of the two cubes
+    for write_cube_region.
+    """
+    accHdr = hdr.copy()
+    for key in ["DATAMAX", "DATAMIN"]:
+        if key in accHdr:
+            del accHdr[key]
+    accHdr["ACCUMVER"] = (ACCUMULATOR_VERSION, "gbtgridder accumulator version")
+    accHdr["KERNEL"] = (kernel, "gbtgridder gridding kernel")
+    accHdr.add_comment("Unweighted data cube (sum of weight*data) to accumulate.")
+    dataOffset = create_cube_file(accFile, accHdr, nchan, ny, nx, dtype=np.float64)
+
+    wtHdr = pyfits.Header()
+    wtHdr["EXTNAME"] = "WEIGHT"
+    wtHdr["BUNIT"] = ("weight", "Weight cube")
+    weightOffset = append_cube_hdu(accFile, wtHdr, nchan, ny, nx, dtype=np.float64)
+
+    return (dataOffset, weightOffset)
+
+
+def finish_accumulator(accFile, ingested):
+    """Add the INGESTED table to a file from create_accumulator.
+
+    ingested is the list of file dictionaries (as from read_accumulator)
+    for everything that has been gridded into it.
+    """
+    columns = [
+        pyfits.Column(
+            name="FILE",
+            format="%dA" % max([len(entry["file"]) for entry in ingested] + [1]),
+            array=[entry["file"] for entry in ingested],
+        ),
+        pyfits.Column(
+            name="SIZE", format="K", array=[entry["size"] for entry in ingested]
+        ),
+        pyfits.Column(
+            name="MTIME", format="K", array=[entry["mtime"] for entry in ingested]
+        ),
+        pyfits.Column(
+            name="NSPEC", format="K", array=[entry["nspec"] for entry in ingested]
+        ),
+        pyfits.Column(
+            name="SCANS",
+            format="%dA" % max([len(entry["scans"]) for entry in ingested] + [1]),
+            array=[entry["scans"] for entry in ingested],
+        ),
+        pyfits.Column(
+            name="ADDED", format="19A", array=[entry["added"] for entry in ingested]
+        ),
+    ]
+    table = pyfits.BinTableHDU.from_columns(columns, name="INGESTED")
+    pyfits.append(accFile, table.data, table.header)
+
+
+def ingested_entry(sdfitsFile, nspec, scans):
+    """The INGESTED table entry for an SDFITS file gridded now."""
+    path, size, mtime = file_identity(sdfitsFile)
+    return {
+        "file": path,
+        "size": size,
+        "mtime": mtime,
+        "nspec": nspec,
+        "scans": scans,
+        "added": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()),
+    }
@@ -0,0 +1,113 @@
+# Copyright (C) 2015 Associated Universities, Inc. Washington DC, USA.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+# Correspondence concerning GBT software should be addressed as follows:
+#       GBT Operations
+#       National Radio Astronomy Observatory
+#       P. O. Box 2
+#       Green Bank, WV 24944-0002 USA
+
+
+import numpy as np
+from astropy.io import fits as pyfits
+
+# speed of light (m/s)
+_C = 299792458.0
+
+
+def beam_fwhm_at(freq, diameter):
+    """The FWHM (deg) of the beam of a dish of diameter (m) at freq (Hz)."""
+    return np.rad2deg(1.2 * _C / (diameter * np.abs(freq)))
+
+
+def kernel_fwhm(kernel_type, beam_fwhm):
+    """The FWHM (deg) of the gaussian part of the gridding kernel for a beam."""
+    if kernel_type in ["gauss", "gaussbessel"]:
+        return 2.0 * np.sqrt(np.log(2.0) / 9) * beam_fwhm
+    # don't need this value for pill box
+    return 0.0
+
+
+def beam_bands(faxis, tolerance):
+    """Split the channels into bands over which the beam changes by at most
+    tolerance (a fraction of the beam size).
+
+    The beam size goes as 1/frequency, so within a band the highest
+    frequency is at most (1 + tolerance) times the lowest.  Returns a list
+    of (chanStart, chanStop) ranges, chanStop is exclusive.
+    """
+    freq = np.abs(np.asarray(faxis, dtype=np.float64))
+    bands = []
+    chanStart = 0
+    fmin, fmax = (freq[0], freq[0])
+    for chan in range(1, len(freq)):
+        newMin, newMax = (min(fmin, freq[chan]), max(fmax, freq[chan]))
+        if newMax > (1.0 + tolerance) * newMin:
+            bands.append((chanStart, chan))
+            chanStart = chan
+            newMin, newMax = (freq[chan], freq[chan])
+        fmin, fmax = (newMin, newMax)
+    bands.append((chanStart, len(freq)))
+    return bands
+
+
+def band_beam_fwhm(faxis, band, diameter):
+    """The beam FWHM (deg) used for the channels of one band from beam_bands.
+
+    That is the middle of the range of beam sizes in the band, so no
+    channel is off by more than half the tolerance.
+    """
+    freq = np.abs(np.asarray(faxis[band[0] : band[1]], dtype=np.float64))
+    return 0.5 * (
+        beam_fwhm_at(freq.min(), diameter) + beam_fwhm_at(freq.max(), diameter)
+    )
+
+
+def band_slabs(slabs, bands):
+    """Split the (chanStart, chanStop) slabs at the band edges.
+
+    Returns a list of (chanStart, chanStop, band) where band is the index
+    in bands of the band holding those channels.
+    """
+    result = []
+    for band, (b0, b1) in enumerate(bands):
+        for s0, s1 in slabs:
+            if s0 < b1 and b0 < s1:
+                result.append((max(s0, b0), min(s1, b1), band))
+    return result
+
+
+def beam_table(bands, bandFwhm, nchan):
+    """The BEAMS table of the beam of each channel, as CASA uses for cubes
+    with a beam per plane (with CASAMBM set in the PHDU).
+
+    bandFwhm is the final FWHM (deg) of the gridded cube in each of the
+    bands.  The beams are round, BMAJ and BMIN are in arcsec.
+    """
+    chanFwhm = np.empty(nchan, dtype=np.float32)
+    for (b0, b1), fwhm in zip(bands, bandFwhm):
+        chanFwhm[b0:b1] = fwhm * 3600.0
+    columns = [
+        pyfits.Column(name="BMAJ", format="E", unit="arcsec", array=chanFwhm),
+        pyfits.Column(name="BMIN", format="E", unit="arcsec", array=chanFwhm),
+        pyfits.Column(name="BPA", format="E", unit="deg", array=np.zeros(nchan)),
+        pyfits.Column(name="CHAN", format="J", array=np.arange(nchan)),
+        pyfits.Column(name="POL", format="J", array=np.zeros(nchan)),
+    ]
+    table = pyfits.BinTableHDU.from_columns(columns, name="BEAMS")
+    table.header["NCHAN"] = nchan
+    table.header["NPOL"] = 1
+    return table
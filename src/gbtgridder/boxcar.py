@@ -24,18 +24,23 @@ import math
 
 import numpy
 
+# smoothing kernels known to smooth
+SMOOTH_KERNELS = ("boxcar", "hanning", "gaussian")
 
-def boxcar(dataArray, freqAxis, width):
+
+def boxcar(dataArray, freqAxis, width, out=None):
     """Smooth all of the spectra in dataArray using a boxcar of the requested
     width.
 
-    This uses numpy.convolve.  The returned array is decimated by taking only every
-    width channels.
+    The returned array is decimated by taking only every width channels.
+    All of the spectra are done at once by viewing each row as (nout, width)
+    boxes and taking the mean of each box.
 
     input:
        dataArray: an (nspec, nchan) array, smoothing is along the channel axis
        freqAxis: the frequency values at each channel on nchan, assumed to be linear in freq
        width: the width of the boxcar
+       out: optional (nspec, nout) array to hold the result
 
     output:
        The smoothed array, now with dimension (nspec,nchan/width)
@@ -44,32 +49,128 @@ def boxcar(dataArray, freqAxis, width):
 
     Expects to work with sdfits data where the data type is float32
     """
+    return smooth(dataArray, freqAxis, width, kernel="boxcar", out=out)
+
+
+def smooth(dataArray, freqAxis, width, kernel="boxcar", out=None):
+    """Smooth all of the spectra in dataArray and decimate by width.
+
+    Output channel k is centered on input channels k*width through
+    (k+1)*width - 1, exactly as for boxcar, so the number of channels and the
+    frequency axis (see boxcar_freq) do not depend on the kernel.  The kernel
+    has a FWHM of width channels:
 
+       boxcar: the mean of the width channels
+       hanning: a Hann (cosine squared) window, which is 2*width channels wide
+       gaussian: a gaussian truncated at 3 sigma
+
+    The hanning and gaussian kernels reach past the ends of the first and
+    last boxes.  Output channels near the edges use only the channels that
+    are there, with the kernel renormalized.  NaN values spread to every
+    output channel that uses them.
+
+    The result is built with one vector operation per kernel tap over all
+    of the spectra, so it is cheap to call once per chunk of rows.  It is
+    written into out if given, otherwise into a new float32 array.
+
+    Returns (result, newFreqAxis).
+    """
     if dataArray.ndim != 2:
         raise ValueError("boxcar expected dataArray to have 2 dimensions")
 
     if dataArray.shape[1] < width:
         raise ValueError("width must be < number of channels")
 
-    box = numpy.ones(width, "float32") / width
     nspec, nchan = dataArray.shape
-    nout = nchan / width
-    # we always loose the channel on the end, no matter what
-    if width * nout == nchan:
-        nout -= 1
+    nout = boxcar_nout(nchan, width)
+    if out is None:
+        out = numpy.empty((nspec, nout), "float32")
+    elif out.shape != (nspec, nout):
+        raise ValueError("out must have shape (%d, %d)" % (nspec, nout))
+
+    if kernel == "boxcar":
+        boxes = dataArray[:, : (nout * width)].reshape(nspec, nout, width)
+        numpy.mean(boxes, axis=2, out=out)
+    else:
+        taps = smooth_kernel(kernel, width)
+        # input channel of the first tap for output channel 0
+        first = (width - len(taps)) // 2
+        tapSum = numpy.zeros(nout)
+        out[...] = 0.0
+        for i, tap in enumerate(taps):
+            # output channels for which this tap falls on an input channel
+            offset = first + i
+            k0 = max(0, -(offset // width))
+            k1 = min(nout, (nchan - 1 - offset) // width + 1)
+            if k1 <= k0:
+                continue
+            c0 = k0 * width + offset
+            out[:, k0:k1] += (
+                tap * dataArray[:, c0 : (c0 + (k1 - k0 - 1) * width + 1) : width]
+            )
+            tapSum[k0:k1] += tap
+        out /= tapSum.astype(out.dtype)
+
+    # and the new frequency axis
+    newFreqAxis = boxcar_freq(freqAxis, width, nout=nout)
 
-    nout = math.ceil(nout)
+    return (out, newFreqAxis)
 
-    result = numpy.zeros((nspec, nout), "float32")
-    for i in range(nspec):
-        y = numpy.convolve(box, dataArray[i, :], mode="valid")
-        # decimate and save
-        result[i, :] = y[0:-1:width]
 
-    # and the new frequency axis
-    newFreqAxis = (
+def smooth_kernel(kernel, width):
+    """Return the taps of a smoothing kernel with a FWHM of width channels.
+
+    The taps are symmetric about the center of a box of width channels, so
+    there is an even number of them when width is even.  They sum to 1.
+    """
+    if kernel not in SMOOTH_KERNELS:
+        raise ValueError("unknown smoothing kernel %s" % kernel)
+
+    if kernel == "boxcar":
+        return numpy.full(width, 1.0 / width)
+
+    if kernel == "hanning":
+        support = float(width)
+    else:
+        sigma = width / (2.0 * math.sqrt(2.0 * math.log(2.0)))
+        support = 3.0 * sigma
+
+    # grow the box by one channel on each side until it covers the support
+    ntaps = width + 2 * max(0, int(math.ceil(support - (width + 1) / 2.0)))
+    x = numpy.arange(ntaps) - (ntaps - 1) / 2.0
+    if kernel == "hanning":
+        taps = numpy.cos(numpy.pi * x / (2.0 * width)) ** 2
+        taps[numpy.abs(x) >= width] = 0.0
+    else:
+        taps = numpy.exp(-0.5 * (x / sigma) ** 2)
+
+    return taps / taps.sum()
+
+
+def boxcar_freq(freqAxis, width, nout=None):
+    """Return the frequency axis that boxcar produces for a given width.
+
+    This lets callers know the smoothed axis (and so the number of output
+    channels) without having to read and smooth any data.
+
+    input:
+       freqAxis: the frequency values at each channel, assumed to be linear in freq
+       width: the width of the boxcar
+       nout: the number of output channels, computed as in boxcar if not given
+
+    output:
+       The new frequency axis, the average of the first and last frequency in each box
+    """
+    if nout is None:
+        nout = boxcar_nout(len(freqAxis), width)
+
+    return (
         freqAxis[0 : (nout * width) : width]
         + freqAxis[(width - 1) : (nout * width) : width]
     ) / 2.0
 
-    return (result, newFreqAxis)
+
+def boxcar_nout(nchan, width):
+    """The number of channels boxcar returns for nchan input channels."""
+    # we always loose the channel on the end, no matter what
+    return (nchan - 1) // width
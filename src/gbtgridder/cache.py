@@ -0,0 +1,243 @@
+# Copyright (C) 2015 Associated Universities, Inc. Washington DC, USA.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+# Correspondence concerning GBT software should be addressed as follows:
+#       GBT Operations
+#       National Radio Astronomy Observatory
+#       P. O. Box 2
+#       Green Bank, WV 24944-0002 USA
+
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+# bump this when the layout of a cache entry or the get_data result changes
+CACHE_VERSION = 3
+
+_MANIFEST = "manifest.json"
+
+
+def cache_selection(
+    chanStart,
+    chanStop,
+    average,
+    smoothing,
+    scanlist,
+    mintsys,
+    maxtsys,
+    getdata=True,
+    rowRange=None,
+    rows=None,
+):
+    """The get_data arguments that determine its result for a given file.
+
+    rows, the table rows handed to get_data, are kept as a digest.
+
+    Returns a dictionary that can be written to JSON as part of a cache key.
+    """
+    selection = {}
+    selection["chanStart"] = chanStart
+    selection["chanStop"] = chanStop
+    selection["average"] = average
+    selection["smoothing"] = smoothing if average is not None else None
+    selection["scans"] = None if scanlist is None else sorted(set(scanlist))
+    selection["mintsys"] = mintsys
+    selection["maxtsys"] = maxtsys
+    selection["getdata"] = bool(getdata)
+    selection["rowRange"] = None if rowRange is None else list(rowRange)
+    selection["rows"] = None
+    if rows is not None:
+        rows = np.asarray(rows, dtype=np.int64)
+        selection["rows"] = hashlib.sha1(rows.tobytes()).hexdigest()
+    return selection
+
+
+def cache_key(sdfitsFile, selection):
+    """The name of the cache entry for this file and selection.
+
+    The key includes the absolute path, size and modification time of the
+    file, so an entry is never used once its file has changed.
+
+    Returns (name, keyInfo) where keyInfo is what was hashed to make name.
+    """
+    stat = os.stat(sdfitsFile)
+    keyInfo = {
+        "version": CACHE_VERSION,
+        "file": os.path.abspath(sdfitsFile),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "selection": selection,
+    }
+    keyString = json.dumps(keyInfo, sort_keys=True, default=_json_value)
+    return (hashlib.sha1(keyString.encode("utf-8")).hexdigest(), keyInfo)
+
+
+def read_cache(cacheDir, sdfitsFile, selection, out=None):
+    """Return the cached get_data result for this file and selection.
+
+    The per-row columns and the spectra are memory-mapped from the .npy
+    files in the entry (copy-on-write, the entry itself is never changed).
+    If out is given the spectra are copied into it, as get_data does.  A
+    metadata selection (getdata False) is also satisfied by an entry that
+    has the spectra.  Using an entry marks it as recently used.
+
+    Returns None if there is no entry.
+    """
+    if selection["getdata"]:
+        candidates = [selection]
+    else:
+        candidates = [selection, dict(selection, getdata=True)]
+
+    for thisSelection in candidates:
+        name, _ = cache_key(sdfitsFile, thisSelection)
+        entryDir = os.path.join(cacheDir, name)
+        manifestFile = os.path.join(entryDir, _MANIFEST)
+        try:
+            with open(manifestFile) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            continue
+
+        result = dict(manifest["values"])
+        for arrayName in manifest["arrays"]:
+            if arrayName == "data" and not selection["getdata"]:
+                continue
+            if arrayName == "obstimes" and not selection["getdata"]:
+                continue
+            result[arrayName] = np.load(
+                os.path.join(entryDir, arrayName + ".npy"), mmap_mode="c"
+            )
+        if "data" in manifest["arrays"]:
+            if not selection["getdata"]:
+                result["data"] = None
+            elif out is not None:
+                out[...] = result["data"]
+                result["data"] = out
+
+        # least recently used entries are the first to go in trim_cache
+        os.utime(manifestFile)
+        return result
+
+    return None
+
+
+def write_cache(cacheDir, sdfitsFile, selection, result, verbose=4):
+    """Save a get_data result as a cache entry.
+
+    Arrays are written as .npy files, everything else goes into the JSON
+    manifest.  The entry is written to a temporary directory and renamed
+    into place so that a partly written entry is never read.  Problems
+    writing the cache are reported (at verbose > 2) and otherwise ignored.
+    """
+    name, keyInfo = cache_key(sdfitsFile, selection)
+    entryDir = os.path.join(cacheDir, name)
+    if os.path.exists(entryDir):
+        return
+
+    tmpDir = None
+    try:
+        os.makedirs(cacheDir, exist_ok=True)
+        tmpDir = tempfile.mkdtemp(prefix=".tmp-", dir=cacheDir)
+        arrays = []
+        values = {}
+        for key in result:
+            value = result[key]
+            if isinstance(value, np.ndarray):
+                np.save(os.path.join(tmpDir, key + ".npy"), value)
+                arrays.append(key)
+            else:
+                values[key] = _json_value(value)
+
+        manifest = {"key": keyInfo, "arrays": arrays, "values": values}
+        with open(os.path.join(tmpDir, _MANIFEST), "w") as f:
+            json.dump(manifest, f, default=_json_value)
+        os.rename(tmpDir, entryDir)
+        tmpDir = None
+    except (OSError, TypeError, ValueError) as e:
+        if verbose > 2:
+            print(
+                "Warning: could not write the cache entry for %s: %s" % (sdfitsFile, e)
+            )
+    finally:
+        if tmpDir is not None:
+            shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+def trim_cache(cacheDir, maxBytes, verbose=4):
+    """Remove the least recently used cache entries until the cache is no
+    larger than maxBytes.
+
+    This includes the scan indexes and gridding plans kept in the same
+    directory, which are single files that are touched when used.
+
+    Returns the number of entries removed.
+    """
+    entries = []
+    totalBytes = 0
+    if not os.path.isdir(cacheDir):
+        return 0
+    for name in os.listdir(cacheDir):
+        if name.startswith(".tmp-"):
+            # still being written
+            continue
+        entryPath = os.path.join(cacheDir, name)
+        manifestFile = os.path.join(entryPath, _MANIFEST)
+        if os.path.isfile(manifestFile):
+            entryBytes = sum(
+                [
+                    os.path.getsize(os.path.join(entryPath, f))
+                    for f in os.listdir(entryPath)
+                ]
+            )
+            lastUsed = os.path.getmtime(manifestFile)
+        elif os.path.isfile(entryPath) and (
+            name.startswith("index-") or name.startswith("plan-")
+        ):
+            entryBytes = os.path.getsize(entryPath)
+            lastUsed = os.path.getmtime(entryPath)
+        else:
+            continue
+        entries.append((lastUsed, entryBytes, entryPath))
+        totalBytes += entryBytes
+
+    nremoved = 0
+    for _, entryBytes, entryPath in sorted(entries):
+        if totalBytes <= maxBytes:
+            break
+        if os.path.isdir(entryPath):
+            shutil.rmtree(entryPath, ignore_errors=True)
+        else:
+            os.remove(entryPath)
+        totalBytes -= entryBytes
+        nremoved += 1
+
+    if verbose > 4 and nremoved > 0:
+        print("Removed %d cache entries from %s" % (nremoved, cacheDir))
+    return nremoved
+
+
+def _json_value(value):
+    """Convert numpy scalars to the equivalent python values for JSON."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, bytes):
+        return value.decode("ascii")
+    return value
@@ -0,0 +1,114 @@
+# Copyright (C) 2015 Associated Universities, Inc. Washington DC, USA.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+# Correspondence concerning GBT software should be addressed as follows:
+#       GBT Operations
+#       National Radio Astronomy Observatory
+#       P. O. Box 2
+#       Green Bank, WV 24944-0002 USA
+
+
+import numpy as np
+from astropy.io import fits as pyfits
+
+
+def block_stats(block):
+    """The per-channel statistics of a (nchan, ny, nx) block of a cube.
+
+    NaN values are ignored.  Returns a dictionary of nchan length arrays:
+       npix: the number of valid (not NaN) pixels
+       sum, sumsq: the sum of the valid values and of their squares
+       min, max: the smallest and largest valid value, NaN if none
+    The block is looked at one plane at a time, so the only temporary
+    values are for one plane.
+    """
+    nchan = len(block)
+    stats = new_stats(nchan)
+    for chan, plane in enumerate(block):
+        good = plane[~np.isnan(plane)].astype(np.float64, copy=False)
+        stats["npix"][chan] = good.size
+        if good.size:
+            stats["sum"][chan] = good.sum()
+            stats["sumsq"][chan] = np.dot(good, good)
+            stats["min"][chan] = good.min()
+            stats["max"][chan] = good.max()
+    return stats
+
+
+def new_stats(nchan):
+    """Empty statistics, as from block_stats, for nchan channels."""
+    return {
+        "npix": np.zeros(nchan, dtype=np.int64),
+        "sum": np.zeros(nchan),
+        "sumsq": np.zeros(nchan),
+        "min": np.full(nchan, np.nan),
+        "max": np.full(nchan, np.nan),
+    }
+
+
+def add_stats(stats, chanStart, blockStats):
+    """Add the block_stats of a block starting at channel chanStart to the
+    statistics of the whole cube, in place.
+
+    A channel can be added in several blocks, e.g. for the tiles of a map.
+    """
+    chans = slice(chanStart, chanStart + len(blockStats["npix"]))
+    for key in ["npix", "sum", "sumsq"]:
+        stats[key][chans] += blockStats[key]
+    stats["min"][chans] = np.fmin(stats["min"][chans], blockStats["min"])
+    stats["max"][chans] = np.fmax(stats["max"][chans], blockStats["max"])
+
+
+def stats_range(stats):
+    """The (max, min) over all channels, for DATAMAX and DATAMIN.
+
+    Both are NaN if there are no valid pixels.
+    """
+    if len(stats["npix"]) == 0 or not stats["npix"].any():
+        return (np.nan, np.nan)
+    return (np.nanmax(stats["max"]), np.nanmin(stats["min"]))
+
+
+def stats_table(stats, bunit, weightStats=None):
+    """The CHANSTATS table of the statistics of each channel of a cube.
+
+    The columns are the channel (counting from 0, as in the BEAMS table),
+    the number of valid pixels, their min, max, mean and rms (the square
+    root of the mean square, in bunit) and, given the statistics of the
+    weight cube, the sum of the weights of the channel.
+    """
+    nchan = len(stats["npix"])
+    npix = stats["npix"]
+    mean = np.full(nchan, np.nan)
+    rms = np.full(nchan, np.nan)
+    good = npix > 0
+    mean[good] = stats["sum"][good] / npix[good]
+    rms[good] = np.sqrt(stats["sumsq"][good] / npix[good])
+    columns = [
+        pyfits.Column(name="CHAN", format="J", array=np.arange(nchan)),
+        pyfits.Column(name="NPIX", format="K", array=npix),
+        pyfits.Column(name="MIN", format="D", unit=bunit, array=stats["min"]),
+        pyfits.Column(name="MAX", format="D", unit=bunit, array=stats["max"]),
+        pyfits.Column(name="MEAN", format="D", unit=bunit, array=mean),
+        pyfits.Column(name="RMS", format="D", unit=bunit, array=rms),
+    ]
+    if weightStats is not None:
+        columns.append(
+            pyfits.Column(name="SUMWT", format="D", array=weightStats["sum"])
+        )
+    table = pyfits.BinTableHDU.from_columns(columns, name="CHANSTATS")
+    table.header["NCHAN"] = nchan
+    return table
@@ -20,6 +20,7 @@
 #       P. O. Box 2
 #       Green Bank, WV 24944-0002 USA
 
+import functools
 import os
 import sys  # using sys.argv
 import time
@@ -30,14 +31,88 @@ from astropy import wcs
 from astropy.io import fits as pyfits
 
 from . import gbtgridder_args
-from .get_data import get_data
-from .grid_otf import grid_otf
+from .accumulate import (
+    check_accumulator,
+    create_accumulator,
+    finish_accumulator,
+    ingested_entry,
+    new_files,
+    read_accumulator,
+    read_accumulator_region,
+)
+from .beams import (
+    band_beam_fwhm,
+    band_slabs,
+    beam_bands,
+    beam_fwhm_at,
+    beam_table,
+    kernel_fwhm,
+)
+from .cache import trim_cache
+from .cube_stats import add_stats, block_stats, new_stats, stats_range, stats_table
+from .grid_otf import (
+    channel_slabs,
+    grid_otf,
+    nan_mask,
+    normalize_cube,
+    slab_channels,
+)
+from .load_data import (
+    close_shared_spectra,
+    create_shared_spectra,
+    iter_spectra,
+    load_spectra,
+    load_spectra_parallel,
+    release_shared_spectra,
+    scan_sdfits,
+    slab_channel_range,
+)
+from .lines import line_header, line_layout, load_lines, parse_line
 from .make_header import make_header
+from .moments import (
+    NOISE_PRODUCTS,
+    SIGNAL_PRODUCTS,
+    add_moment_block,
+    channel_velocities,
+    map_header,
+    moment_maps,
+    new_moments,
+    parse_window,
+    window_channels,
+    write_map,
+)
+from .output_formats import (
+    output_copies,
+    remove_copy,
+    write_chunk_store,
+    write_compressed,
+)
+from .partitions import (
+    grid_partitions,
+    partition_header,
+    partition_rows,
+    position_groups,
+    stokes_i_sets,
+)
+from .preview import PREVIEW_TYPES, write_preview
 from .get_cube_info import get_cube_info
+from .tiles import (
+    iter_tiles,
+    map_tiles,
+    tile_commands,
+    tile_padding,
+    tile_rows,
+    write_tile_tasks,
+)
+from .write_cube import (
+    create_cube_file,
+    update_cube_header,
+    write_cube_blocks,
+    write_cube_region,
+)
 from . import version
 
 gbtgridderVersion = version()
-_C = 299792458.0  # speed of light (m/s)
 
 
 def parse_channels(channelString, verbose=4):
@@ -181,13 +256,21 @@ def format_scans(scanlist):
     return result
 
 
+def default_output_root(source, rest_freq):
+    # the root output name used when --output is not given
+    return "%s_%.0f_MHz" % (source, rest_freq / 1.0e6)
+
+
 def set_output_files(source, rest_freq, args, file_types, verbose=4):
 
     outputNameRoot = args.output
     clobber = args.clobber
 
     if outputNameRoot is None:
-        outputNameRoot = "%s_%.0f_MHz" % (source, rest_freq / 1.0e6)
+        outputNameRoot = default_output_root(source, rest_freq)
+    if args.tile is not None:
+        # each tile of a --tile-tasks run has its own files
+        outputNameRoot += "_tile%03d" % args.tile
     # always tack on the underscore
     outputNameRoot += "_"
     if verbose > 4:
@@ -207,13 +290,76 @@ def set_output_files(source, rest_freq, args, file_types, verbose=4):
                 os.remove(typeName)
                 if verbose > 3:
                     print("existing " + typeName + " removed")
+        # and the compressed and chunked copies of it
+        for copyName in output_copies(typeName, args.compress, args.chunked):
+            if os.path.exists(copyName):
+                if not clobber:
+                    if verbose > 1:
+                        print(copyName + " exists, will not overwrite")
+                    return {}
+                else:
+                    remove_copy(copyName)
+                    if verbose > 3:
+                        print("existing " + copyName + " removed")
         result[file_type] = typeName
     return result
 
 
+def remove_output_files(outputFiles):
+    """Remove any of the output files that have already been written."""
+    for typeName in outputFiles.values():
+        if os.path.exists(typeName):
+            os.remove(typeName)
+
+
+def accumulate_block(
+    accFile,
+    newAccFile,
+    accOffsets,
+    addOld,
+    cubeShape,
+    chanStart,
+    tile,
+    dataSum,
+    weightSum,
+):
+    """Add the sums gridded from new data to an accumulator.
+
+    dataSum and weightSum are the unnormalized grid_otf results for the
+    channels from chanStart and the (x0, x1, y0, y1) tile of the map.  If
+    addOld, the sums already in accFile are added to them.  The totals are
+    written to newAccFile (from create_accumulator, with accOffsets).
+
+    Returns the normalized (cube, weight) for the output files.
+    """
+    (x0, x1, y0, y1) = tile
+    dataSum = dataSum.astype(np.float64)
+    weightSum = weightSum.astype(np.float64)
+    if addOld:
+        (oldData, oldWeight) = read_accumulator_region(
+            accFile, chanStart, chanStart + dataSum.shape[0], x0, x1, y0, y1
+        )
+        dataSum += oldData
+        weightSum += oldWeight
+    for sums, offset in zip([dataSum, weightSum], accOffsets):
+        write_cube_region(newAccFile, offset, cubeShape, chanStart, x0, y0, sums)
+    return normalize_cube(dataSum, weightSum)
+
+
 def gbtgridder(args):
     """"""
 
+    # the shared memory of the spectra loaded with --jobs, it is closed
+    # once the gridding is done and the spectra are gone
+    sharedSpectra = []
+    try:
+        _gbtgridder(args, sharedSpectra)
+    finally:
+        for shm in sharedSpectra:
+            close_shared_spectra(shm)
+
+
+def _gbtgridder(args, sharedSpectra):
     start_time = time.time()
     print("Collecting arguments and data... ")
 
@@ -234,6 +380,44 @@ def gbtgridder(args):
 
     average = args.average
 
+    # with --line the channels of all of the lines are read together and
+    # each line is averaged on its own as the data are loaded
+    lines = None
+    if args.line is not None:
+        lines = []
+        for lineString in args.line:
+            line = parse_line(lineString)
+            if line is None:
+                print("line didn't parse: %s" % lineString)
+                return
+            if line["average"] is None:
+                line["average"] = average
+            lines.append(line)
+        if len(set([line["name"] for line in lines])) < len(lines):
+            print("line names must all be different")
+            return
+        chanStart = min([line["chanStart"] for line in lines])
+        chanStop = max([line["chanStop"] for line in lines])
+        average = None
+
+    # the channel windows of the moment and noise maps
+    signalWindows = None
+    lineFreeWindows = None
+    mapTypes = []
+    if args.signal is not None:
+        signalWindows = [parse_window(args.signal)]
+        mapTypes += SIGNAL_PRODUCTS
+    if args.line_free is not None:
+        lineFreeWindows = [parse_window(window) for window in args.line_free]
+        mapTypes += NOISE_PRODUCTS
+    for windows, option in [
+        (signalWindows, "signal"),
+        (lineFreeWindows, "line-free"),
+    ]:
+        if windows is not None and None in windows:
+            print("%s didn't parse" % option)
+            return
+
     minTsys = args.mintsys
     maxTsys = args.maxtsys
 
@@ -248,165 +432,249 @@ def gbtgridder(args):
                 print(sdf + " does not exist")
             return
 
-    # extract everything from the SDFITS files
-    xsky = None
-    ysky = None
-    spec = None
-    rest_freq = None
-    faxis = None
-    source = None
-    dataUnits = None
-    calibType = None
-    veldef = None
-    specsys = None
-    coordType = (None, None)
-    radesys = None
-    equinox = None
-    observer = None
-    telescop = None
-    frontend = None
-    dateObs = None
-    uniqueScans = None
-    ntsysFlagCount = 0
-    outputFiles = {}
+    # with --accumulate only the files and scans not yet in the accumulator
+    # are gridded
+    accHdr = None
+    ingested = []
+    fileScanlists = None
+    if args.accumulate is not None:
+        (accHdr, ingested) = read_accumulator(args.accumulate, verbose=verbose)
+        if ingested is None:
+            return
+        newFiles = new_files(sdfitsFiles, ingested, scanlist, verbose=verbose)
+        if newFiles is None:
+            return
+        (sdfitsFiles, fileScanlists) = newFiles
+        if len(sdfitsFiles) == 0:
+            if verbose > 1:
+                print("No new SDFITS files or scans to add to " + args.accumulate)
+            return
+        if verbose > 3:
+            print(
+                "Adding %d files to %d already in %s"
+                % (len(sdfitsFiles), len(ingested), args.accumulate)
+            )
 
     if verbose > 3:
         print("Loading data ... ")
         sys.stdout.flush()
 
-    num_positions = 0
-    for thisFile in sdfitsFiles:
-        try:
-            if verbose > 3:
-                print("   ", thisFile)
-                sys.stdout.flush()
-            dataRecord = get_data(
-                thisFile,
-                chanStart,
-                chanStop,
-                average,
-                scanlist,
-                minTsys,
-                maxTsys,
-                verbose=verbose,
-            )
+    # the cheap metadata pass, no spectra are read here
+    fileInfo = scan_sdfits(
+        sdfitsFiles,
+        chanStart,
+        chanStop,
+        average,
+        scanlist,
+        minTsys,
+        maxTsys,
+        smoothing=args.smooth,
+        cacheDir=args.cache,
+        verbose=verbose,
+        fileScanlists=fileScanlists,
+    )
 
-            if dataRecord is None:
-                # there was a problem that should not be recovered from
-                # reported by get_data, no additional reporting necessary here
-                sys.exit(1)
-
-            if len(dataRecord) == 0:
-                # empty file, skipping
-                continue
-
-            num_positions += dataRecord["xsky"].size
-            if xsky is None:
-                chanStart = dataRecord["chanStart"]
-                chanStop = dataRecord["chanStop"]
-                wt_value = dataRecord["wt"]
-                faxis = dataRecord["freq"]
-                source = dataRecord["source"]
-                dataUnits = dataRecord["units"]
-                calibType = dataRecord["calibtype"]
-                veldef = dataRecord["veldef"]
-                specsys = dataRecord["specsys"]
-                coordType = (dataRecord["xctype"], dataRecord["yctype"])
-                radesys = dataRecord["radesys"]
-                equinox = dataRecord["equinox"]
-                telescop = dataRecord["telescop"]
-                frontend = dataRecord["frontend"]
-                observer = dataRecord["observer"]
-                dateObs = dataRecord["date-obs"]
-                uniqueScans = np.unique(dataRecord["scans"])
-                spec_size = dataRecord["spec_size"]
-                rest_freq = dataRecord["restfreq"]
-                old_velocity_axis = (faxis - rest_freq) / rest_freq
-                old_velocity_axis *= _C / 1000.0  # km/s
-                if spec_size != old_velocity_axis.size:
-                    raise ValueError("Spec axis mismatch in %s", thisFile)
-
-                # this also checks that the output files are OK to write
-                # given the value of the clobber argument
-                outputFiles = set_output_files(
-                    source,
-                    rest_freq,
-                    args,
-                    ["cube", "weight"],
-                    verbose=verbose,
-                )
-                if len(outputFiles) == 0:
-                    if verbose > 1:
-                        print("Unable to write to output files")
-                    return
+    if fileInfo is None:
+        # there was a problem that should not be recovered from
+        # reported by get_data, no additional reporting necessary here
+        sys.exit(1)
 
-            else:
-                wt_value = np.append(wt_value, dataRecord["wt"])
-                uniqueScans = np.unique(np.append(uniqueScans, dataRecord["scans"]))
+    if fileInfo["first"] is None:
+        if verbose > 1:
+            print(
+                "No data was found in the input SDFITS files given the data selection options used."
+            )
+            print("Can not continue.")
+        return
 
-            ntsysFlagCount += dataRecord["ntsysflag"]
+    # assumes all files are consistent with the first one
+    dataRecord = fileInfo["first"]
+    chanStart = dataRecord["chanStart"]
+    chanStop = dataRecord["chanStop"]
+    faxis = dataRecord["freq"]
+    source = dataRecord["source"]
+    dataUnits = dataRecord["units"]
+    calibType = dataRecord["calibtype"]
+    veldef = dataRecord["veldef"]
+    specsys = dataRecord["specsys"]
+    coordType = (dataRecord["xctype"], dataRecord["yctype"])
+    radesys = dataRecord["radesys"]
+    equinox = dataRecord["equinox"]
+    telescop = dataRecord["telescop"]
+    frontend = dataRecord["frontend"]
+    observer = dataRecord["observer"]
+    dateObs = dataRecord["date-obs"]
+    spec_size = dataRecord["spec_size"]
+    rest_freq = dataRecord["restfreq"]
+
+    if lines is not None:
+        for line in lines:
+            if line["chanStop"] >= dataRecord["nchan"]:
+                print(
+                    "line %s is outside of the %d channels of the data"
+                    % (line["name"], dataRecord["nchan"])
+                )
+                return
+            lineChans = line["chanStop"] - line["chanStart"] + 1
+            if line["average"] is not None and line["average"] >= lineChans:
+                print(
+                    "line %s averaging must be less than its %d channels"
+                    % (line["name"], lineChans)
+                )
+                return
+        # the lines are side by side in the spectra
+        spec_size = line_layout(lines, faxis, chanStart)
+
+    num_positions = fileInfo["num_positions"]
+    uniqueScans = fileInfo["scans"]
+    wt_value = fileInfo["wt"]
+    ntsysFlagCount = fileInfo["ntsysflag"]
+    xsky = fileInfo["xsky"]  # deg
+    ysky = fileInfo["ysky"]  # deg
+    texp = fileInfo["texp"]
+    tsys = fileInfo["tsys"]
+
+    # with --partition each polarization and/or feed has its own output
+    # files, named by outputNames, and its own STOKES axis value
+    partitions = None
+    stokesSets = []
+    outputNames = [""]
+    outputStokes = {"": None}
+    if args.partition is not None:
+        partitions = partition_rows(
+            fileInfo["stokes"], fileInfo["feeds"], args.partition
+        )
+        if args.stokes_i:
+            stokesSets = stokes_i_sets(partitions, verbose=verbose)
+        outputNames = []
+        for part in partitions:
+            outputNames.append(part["name"] + "_")
+            outputStokes[part["name"] + "_"] = part["stokes"]
+        for name, indexA, indexB in stokesSets:
+            outputNames.append(name + "_")
+            outputStokes[name + "_"] = 1
+        if verbose > 3:
+            print(
+                "Gridding %d partitions: %s"
+                % (len(outputNames), ", ".join([name[:-1] for name in outputNames]))
+            )
+    elif lines is not None:
+        # each line has its own output files
+        outputNames = [line["name"] + "_" for line in lines]
 
-        except (AssertionError):
+    # this also checks that the output files are OK to write
+    # given the value of the clobber argument
+    # --tile-tasks only writes the task list
+    outputFiles = {}
+    fileTypes = ["cube", "weight"]
+    if args.preview:
+        # only the quick look is written, for all of the data together
+        (outputNames, fileTypes, mapTypes) = ([""], PREVIEW_TYPES, [])
+    if args.tile_tasks is None:
+        outputFiles = set_output_files(
+            source,
+            rest_freq,
+            args,
+            [
+                name + fileType
+                for name in outputNames
+                for fileType in fileTypes + mapTypes
+            ],
+            verbose=verbose,
+        )
+        if len(outputFiles) == 0:
             if verbose > 1:
-                print("There was an unexpected problem processing %s" % thisFile)
-            raise
+                print("Unable to write to output files")
+            return
 
-    # Loop over SDFITS files and get data and positions
-    spec = np.ones((num_positions, spec_size), dtype=np.float64) * np.nan
-    xsky = np.ones(num_positions, dtype=np.float32) * np.nan
-    ysky = np.ones(num_positions, dtype=np.float32) * np.nan
-    texp = np.ones(num_positions, dtype=np.float32) * np.nan
-    tsys = np.ones(num_positions, dtype=np.float32) * np.nan
-    idx = 0
-    # run through the file again so we have the right num_positions value
-    for thisFile in sdfitsFiles:
+    # the type used for the spectra, the gridding and the output cubes
+    gridType = np.dtype(args.dtype)
+
+    # the single data pass, each file's spectra go straight into spec.
+    # Where spec is gridded whole the loaders note its NaN values and set
+    # them to 0 as they are read, so grid_otf needs no copy without them.
+    nans = None
+    if partitions is None and args.tile_size is None:
+        nans = []
+    if args.preview:
+        # the preview reads its few spectra itself, see preview.py
+        spec = None
+        dataLoaded = True
+    elif lines is not None:
+        spec = np.full((num_positions, spec_size), np.nan, dtype=gridType)  # K
+        dataLoaded = load_lines(
+            fileInfo["files"],
+            spec,
+            lines,
+            faxis,
+            chanStart,
+            chanStop,
+            scanlist,
+            minTsys,
+            maxTsys,
+            smoothing=args.smooth,
+            cacheDir=args.cache,
+            rowsPerChunk=args.chunkrows,
+            verbose=verbose,
+            nans=nans,
+        )
+    elif args.stream or args.tile_tasks is not None:
+        # nothing is read yet, the chunks are read as they are gridded
+        spec = None
+        dataLoaded = True
+    elif args.jobs > 1:
+        # the worker processes write into spec in shared memory
+        (specShm, spec) = create_shared_spectra(
+            (num_positions, spec_size), dtype=gridType
+        )  # K
+        sharedSpectra.append(specShm)
         try:
-            dataRecord = get_data(
-                thisFile,
+            dataLoaded = load_spectra_parallel(
+                fileInfo["files"],
+                specShm,
+                spec,
                 chanStart,
                 chanStop,
                 average,
                 scanlist,
                 minTsys,
                 maxTsys,
+                args.jobs,
+                smoothing=args.smooth,
+                cacheDir=args.cache,
                 verbose=verbose,
+                nans=nans,
             )
-
-            if dataRecord is None:
-                # this should be covered in the above dataRecord loop
-                sys.exit(1)
-
-            if len(dataRecord) == 0:
-                # empty file, skipping
-                continue
-
-            try:
-                num = dataRecord["xsky"].size
-                tsys[idx : idx + num] = dataRecord["tsys"]
-                texp[idx : idx + num] = dataRecord["texp"]
-                spec[idx : idx + num] = dataRecord["data"]  # K
-                xsky[idx : idx + num] = dataRecord["xsky"]  # deg
-                ysky[idx : idx + num] = dataRecord["ysky"]  # deg
-                idx += num
-            except:
-                print("There was an error getting data from the SDFits file")
-                return
-
-        except (AssertionError):
-            if verbose > 1:
-                print("There was an unexpected problem processing %s" % thisFile)
-            raise
+        finally:
+            release_shared_spectra(specShm)
+    else:
+        spec = np.full((num_positions, spec_size), np.nan, dtype=gridType)  # K
+        dataLoaded = load_spectra(
+            fileInfo["files"],
+            spec,
+            chanStart,
+            chanStop,
+            average,
+            scanlist,
+            minTsys,
+            maxTsys,
+            smoothing=args.smooth,
+            cacheDir=args.cache,
+            verbose=verbose,
+            nans=nans,
+        )
+    if not dataLoaded:
+        return
+    nanMask = None
+    if nans is not None and spec is not None:
+        nanMask = nan_mask(nans, spec.shape)
+        del nans
 
     if verbose > 3:
-        print("Data Extracted Successfully.")
-
-    if xsky is None:
-        if verbose > 1:
-            print(
-                "No data was found in the input SDFITS files given the data selection options used."
-            )
-            print("Can not continue.")
-        return
+        if args.stream:
+            print("Data will be read while gridding.")
+        else:
+            print("Data Extracted Successfully.")
 
     # Setting weight so we don't have to pass
     # the system temperature and exposure time to grid_otf.
@@ -426,7 +694,7 @@ def gbtgridder(args):
         beam_fwhm = args.beam_fwhm
     else:
         avg_faxis = (faxis[0] + faxis[len(faxis) - 1]) / 2
-        beam_fwhm = np.rad2deg(1.2 * _C / (_D * avg_faxis))
+        beam_fwhm = beam_fwhm_at(avg_faxis, _D)
 
     # account for a xsky value that crossed the 0-360 axis
     if xsky.max() > 180:
@@ -499,9 +767,13 @@ def gbtgridder(args):
         nx = args.size[0]
         ny = args.size[1]
 
-    if args.clonecube is not None:
+    cloneCube = args.clonecube
+    if accHdr is not None:
+        # the new data are gridded onto the accumulated map
+        cloneCube = args.accumulate
+    if cloneCube is not None:
         # use the cloned values
-        cubeInfo = get_cube_info(args.clonecube, verbose=verbose)
+        cubeInfo = get_cube_info(cloneCube, verbose=verbose)
         if cubeInfo is not None:
             if (
                 (cubeInfo["xtype"] != coordType[0])
@@ -513,7 +785,7 @@ def gbtgridder(args):
                 if verbose > 2:
                     print(
                         "Sky coordinates of data are not the same type found in %s"
-                        % args.clonecube
+                        % cloneCube
                     )
                     print("Will not clone the coordinate information from that cube")
                     if verbose > 4:
@@ -562,19 +834,17 @@ def gbtgridder(args):
 
     # Avoid using 0,0 as map center.
     # `cygrid` does not handle this case well.
-    if refXsky == 0:
-        refXsky += 1e-8
-    if refYsky == 0:
-        refYsky += 1e-8
+    # A cloned map already has its center, and for SFL the
+    # reference latitude is 0.0 by definition
+    if refXpix is None:
+        if refXsky == 0:
+            refXsky += 1e-8
+        if refYsky == 0:
+            refYsky += 1e-8
 
 
     # Get convolution Gaussian FWHM (deg)
-    if args.kernel == "gauss":
-        gauss_fwhm = 2.0 * np.sqrt(np.log(2.0) / 9) * beam_fwhm
-    elif args.kernel == "gaussbessel":
-        gauss_fwhm = 2.0 * np.sqrt(np.log(2.0) / 9) * beam_fwhm
-    else:
-        gauss_fwhm = 0.0  # don't need this value for pill box
+    gauss_fwhm = kernel_fwhm(args.kernel, beam_fwhm)
 
     # used only for header purposes
     centerYsky = refYsky
@@ -597,7 +867,9 @@ def gbtgridder(args):
             # then reset refYsky
             refYsky = 0.0
 
-    print("\n Please note that this gridding will be done using a monochromatic beam ie. using a single frequency (color) for the convolution kernel. \n")
+    # each --line is gridded with the beam at its own frequency
+    if args.beam_tolerance is None and lines is None:
+        print("\n Please note that this gridding will be done using a monochromatic beam ie. using a single frequency (color) for the convolution kernel. \n")
     if verbose > 4:
         print("Data summary ...")
         print("   scans : ", format_scans(uniqueScans))
@@ -668,8 +940,8 @@ def gbtgridder(args):
         name, value = v
         print("{:<13} {:<2}".format(name, value))
 
-    # getting their answer
-    if not args.autoConfirm:
+    # getting their answer, the preview is quick enough to not ask
+    if not args.autoConfirm and not args.preview:
         answer = input(
             "\n If you need more info, type 'N' and run again with `--verbose 4` flag \n\n Would you like to continue with these parameters? \n 'Y' for yes, 'N' for no.  \n"
         )
@@ -716,48 +988,9 @@ def gbtgridder(args):
 
     wcsObj = wcs.WCS(hdr, relax=True)
 
-    if verbose > 3:
-        print("\n\n Gridding")
-        sys.stdout.flush()
-
-    try:  # pass all the info to the grid_otf function
-        (cube, weight, final_fwhm) = grid_otf(
-            spec,
-            nx,
-            ny,
-            xsky,
-            ysky,
-            wcsObj,
-            pix_scale,
-            refXsky,
-            centerYsky,
-            beam_fwhm=beam_fwhm,
-            weights=weights,
-            kernel_type=args.kernel,
-            gauss_fwhm=gauss_fwhm,
-            verbose=verbose,
-        )
-    except MemoryError:
-        if verbose > 1:
-            print(
-                "Not enough memory to create the image cubes necessary to grid this data"
-            )
-            print("   Requested image size : %d x %d x %d " % (nx, ny, len(faxis)))
-            print(
-                "   find a beefier machine, consider restricting the data to fewer channels or using channel averaging"
-            )
-            print("   or use AIPS (with idlToSdfits) to grid all of this data")
-        return
-
-    if cube is None or weight is None:
-        if verbose > 1:
-            print("Problem gridding data")
-        return
-
-    if verbose > 3:
-        print("Writing cube")
+    # Final spatial resolution, this is also returned by grid_otf
+    final_fwhm = np.sqrt(beam_fwhm**2.0 + gauss_fwhm**2.0)
 
-    # start writing stuff to disk
     # add additional information to the header
     hdr["object"] = source
     hdr["telescop"] = telescop
@@ -793,21 +1026,9 @@ def gbtgridder(args):
         dataUnits = "Jy/Beam"
     hdr["BUNIT"] = (dataUnits, calibType)
 
-    # This suppresses runtime NaN warnings if the cube is empty
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        hdr["DATAMAX"] = np.nanmax(cube)
-
-    if np.isnan(hdr["DATAMAX"]):
-        if verbose > 2:
-            print(
-                "Entire data cube is not-a-number, this may be because a few channels are consistently bad"
-            )
-            print("consider restricting the channel range")
-        # remove it
-        hdr.remove("DATAMAX")
-    else:
-        hdr["DATAMIN"] = np.nanmin(cube)
+    # placeholders, these are set once the whole cube has been gridded
+    hdr["DATAMAX"] = 0.0
+    hdr["DATAMIN"] = 0.0
 
     # note the parameter values - this must be updated as new parameters are added
     hdr.add_history("gbtgridder version: %s" % gbtgridderVersion)
@@ -818,7 +1039,11 @@ def gbtgridder(args):
     hdr.add_history("gbtgridder clobber: " + str(args.clobber))
     if average is not None and average > 1:
         hdr.add_history("gbtgridder average: %s channels" % average)
+        if args.smooth != "boxcar":
+            hdr.add_history("gbtgridder smooth: " + args.smooth)
     hdr.add_history("gbtgridder kernel: " + args.kernel)
+    if args.backend != "cygrid":
+        hdr.add_history("gbtgridder backend: " + args.backend)
     if args.output is not None:
         hdr.add_history("gbtgridder output: " + args.output)
     if args.scans is not None:
@@ -832,8 +1057,12 @@ def gbtgridder(args):
             hdr.add_history("gbtgridder maxtsys: %f" % args.maxtsys)
         hdr.add_history("gbtgridder N spectra outside tsys range: %d" % ntsysFlagCount)
 
+    historyFiles = args.SDFITSfiles
+    if args.accumulate is not None:
+        hdr.add_history("gbtgridder accumulate: " + args.accumulate)
+        historyFiles = [entry["file"] for entry in ingested] + sdfitsFiles
     hdr.add_history("gbtgridder sdfits files ...")
-    for thisFile in args.SDFITSfiles:
+    for thisFile in historyFiles:
         # protect against long file names
         if len(thisFile) > 60:
             thisFile = "*" + thisFile[-59:]
@@ -847,22 +1076,561 @@ def gbtgridder(args):
         "  and Astrophysics', volume 376, page 359; bibcode: 2001A&A...376..359H"
     )
 
-    # adding STOKES axis
-    # phdu = pyfits.PrimaryHDU(cube[..., None].T, header=hdr)
-    phdu = pyfits.PrimaryHDU(cube[None, ...], header=hdr)
-    phdu.writeto(outputFiles["cube"])
+    if args.preview:
+        # a coarse quick look at the map in place of the cube
+        write_preview(
+            outputFiles,
+            hdr,
+            fileInfo["files"],
+            xsky,
+            ysky,
+            weights,
+            chanStart,
+            average,
+            faxis,
+            args.preview_channels,
+            args.preview_binning,
+            args.preview_sample,
+            dtype=gridType,
+            verbose=verbose,
+        )
+        if verbose > 3:
+            print("Runtime: {0:.1f} minutes".format((time.time() - start_time) / 60.0))
+        return
 
-    if not args.noweight:
+    # with --beam-tolerance each band of channels has its own beam and kernel
+    bands = None
+    if args.beam_tolerance is not None:
+        bands = beam_bands(faxis, args.beam_tolerance)
+        bandBeams = [band_beam_fwhm(faxis, band, _D) for band in bands]
+        bandGauss = [kernel_fwhm(args.kernel, fwhm) for fwhm in bandBeams]
+        bandFinal = np.sqrt(np.array(bandBeams) ** 2 + np.array(bandGauss) ** 2)
+        hdr["CASAMBM"] = (True, "Beam of each channel in the BEAMS table")
+        hdr.add_history(
+            "gbtgridder beam tolerance: %g, %d bands" % (args.beam_tolerance, len(bands))
+        )
         if verbose > 3:
-            print("Writing weight cube")
-        wtHdr = hdr.copy()
-        wtHdr["BUNIT"] = ("weight", "Weight cube")  # change from K -> weight
-        wtHdr["DATAMAX"] = np.nanmax(weight)
-        wtHdr["DATAMIN"] = np.nanmin(weight)
-
-        # adding STOKES axis
-        phdu = pyfits.PrimaryHDU(weight[None, ...], header=wtHdr)
-        phdu.writeto(outputFiles["weight"])
+            print(
+                "Gridding %d bands with beams from %.2f to %.2f arcsec"
+                % (len(bands), min(bandBeams) * 3600.0, max(bandBeams) * 3600.0)
+            )
+    elif lines is not None:
+        # each line is a band gridded with the beam at its own frequency
+        bands = [(line["specStart"], line["specStop"]) for line in lines]
+        bandBeams = []
+        for line in lines:
+            if args.beam_fwhm:
+                bandBeams.append(beam_fwhm)
+            else:
+                lineFreq = (line["faxis"][0] + line["faxis"][-1]) / 2
+                bandBeams.append(beam_fwhm_at(lineFreq, _D))
+        bandGauss = [kernel_fwhm(args.kernel, fwhm) for fwhm in bandBeams]
+        bandFinal = np.sqrt(np.array(bandBeams) ** 2 + np.array(bandGauss) ** 2)
+
+    if accHdr is not None and not check_accumulator(
+        accHdr, hdr, args.kernel, spec_size, verbose=verbose
+    ):
+        remove_output_files(outputFiles)
+        return
+
+    # the output cube is the whole map or, with --tile, one tile of it
+    (cubeX0, cubeY0, cubeNx, cubeNy) = (0, 0, nx, ny)
+    tiles = None
+    if args.tile_size is not None:
+        tiles = map_tiles(nx, ny, args.tile_size)
+        if args.tile_tasks is not None:
+            # the tasks name their files from the rest frequency of the data
+            outputRoot = default_output_root(source, dataRecord["restfreq"])
+            write_tile_tasks(
+                args.tile_tasks,
+                tile_commands(args, len(tiles), outputRoot),
+                verbose=verbose,
+            )
+            return
+        if args.tile is not None:
+            if args.tile >= len(tiles):
+                if verbose > 1:
+                    print(
+                        "tile %d is not one of the %d tiles of this map"
+                        % (args.tile, len(tiles))
+                    )
+                remove_output_files(outputFiles)
+                return
+            tiles = [tiles[args.tile]]
+            (x0, x1, y0, y1) = tiles[0]
+            (cubeX0, cubeY0, cubeNx, cubeNy) = (x0, y0, x1 - x0, y1 - y0)
+            hdr["CRPIX1"] -= x0
+            hdr["CRPIX2"] -= y0
+            hdr.add_history(
+                "gbtgridder tile: %d, pixels %d:%d, %d:%d of %d x %d"
+                % (args.tile, x0, x1 - 1, y0, y1 - 1, nx, ny)
+            )
+        # the spectra that may contribute to each tile, for the largest beam
+        maxBeam = beam_fwhm if bands is None else max(beam_fwhm, max(bandBeams))
+        tileRowsList = tile_rows(
+            wcsObj,
+            xsky,
+            ysky,
+            tiles,
+            tile_padding(
+                args.kernel, maxBeam, kernel_fwhm(args.kernel, maxBeam), pix_scale
+            ),
+        )
+        if verbose > 3:
+            print(
+                "Gridding %d tiles of at most %d x %d pixels"
+                % (len(tiles), args.tile_size, args.tile_size)
+            )
+
+    # split the spectral axis into slabs that fit in the memory budget
+    slabs = [(0, spec_size)]
+    if args.max_memory is not None:
+        maxBytes = args.max_memory * 1024.0**3
+        nspecChunk = num_positions
+        if args.stream:
+            nspecChunk = max([len(rows) for (_, rows) in fileInfo["files"]])
+            if args.chunkrows is not None:
+                nspecChunk = min(nspecChunk, args.chunkrows)
+        else:
+            # the loaded spectra stay in memory throughout
+            maxBytes -= spec.nbytes
+        (slabNx, slabNy) = (nx, ny)
+        if tiles is not None:
+            # the tiles are gridded one at a time in each process
+            slabNx = min(nx, args.tile_size)
+            slabNy = min(ny, args.tile_size)
+        # every partition's slab is in memory at once
+        nchanPerSlab = slab_channels(
+            slabNx, slabNy, nspecChunk, maxBytes, dtype=gridType
+        ) // len(outputNames)
+        if nchanPerSlab < 1:
+            if verbose > 1:
+                print(
+                    "--max-memory is too small to grid even one channel of the %d x %d image"
+                    % (nx, ny)
+                )
+            return
+        slabs = channel_slabs(spec_size, nchanPerSlab)
+        if verbose > 3:
+            print(
+                "Gridding in %d slabs of at most %d channels" % (len(slabs), nchanPerSlab)
+            )
+
+    # each slab is gridded with the beam of its band
+    slabBands = [(slabStart, slabStop, None) for slabStart, slabStop in slabs]
+    if bands is not None:
+        slabBands = band_slabs(slabs, bands)
+
+    # the output files are written at their full size now and
+    # then filled in as each slab is gridded
+    writeFiles = []
+    fileHdrs = {}
+    fileNchan = {}
+    for outputIndex, outputName in enumerate(outputNames):
+        outHdr = hdr
+        outNchan = spec_size
+        if lines is not None:
+            line = lines[outputIndex]
+            outHdr = line_header(
+                hdr,
+                line,
+                rest_freq if line["restfreq"] is None else line["restfreq"],
+                bandBeams[outputIndex],
+                bandFinal[outputIndex],
+            )
+            outNchan = line["specStop"] - line["specStart"]
+        elif outputName:
+            outHdr = partition_header(hdr, outputName[:-1], outputStokes[outputName])
+        writeFiles.append(outputName + "cube")
+        fileHdrs[outputName + "cube"] = outHdr
+        fileNchan[outputName + "cube"] = outNchan
+        if not args.noweight:
+            wtHdr = outHdr.copy()
+            wtHdr["BUNIT"] = ("weight", "Weight cube")  # change from K -> weight
+            writeFiles.append(outputName + "weight")
+            fileHdrs[outputName + "weight"] = wtHdr
+            fileNchan[outputName + "weight"] = outNchan
+
+    # the moment and noise maps of each output are added up as it is written
+    fileMoments = {}
+    for name in outputNames:
+        if not mapTypes:
+            break
+        cubeHdr = fileHdrs[name + "cube"]
+        outNchan = fileNchan[name + "cube"]
+        velocity = channel_velocities(cubeHdr, outNchan, veldef)
+        if signalWindows is not None and velocity is None:
+            if verbose > 1:
+                print("moment maps need a rest frequency, see --restfreq")
+            return
+        masks = {}
+        for kind, windows in [
+            ("signal", signalWindows),
+            ("line-free", lineFreeWindows),
+        ]:
+            masks[kind] = None
+            if windows is not None:
+                masks[kind] = window_channels(windows, outNchan, velocity)
+                if masks[kind] is None or not masks[kind].any():
+                    if verbose > 1:
+                        print(
+                            "the %s windows hold no channels of %s"
+                            % (kind, outputFiles[name + "cube"])
+                        )
+                    return
+        fileMoments[name] = new_moments(
+            cubeNy, cubeNx, velocity, masks["signal"], masks["line-free"]
+        )
+
+    # the output files are made at their full size now and filled in slab
+    # by slab, DATAMAX and DATAMIN are set once all of them are written
+    dataOffsets = {}
+    try:
+        for fileType in writeFiles:
+            dataOffsets[fileType] = create_cube_file(
+                outputFiles[fileType],
+                fileHdrs[fileType],
+                fileNchan[fileType],
+                cubeNy,
+                cubeNx,
+                dtype=gridType,
+            )
+    except OSError as e:
+        if verbose > 1:
+            print("Unable to create the output files: %s" % e)
+            print(
+                "   Requested image size : %d x %d x %d "
+                % (cubeNx, cubeNy, max(fileNchan.values()))
+            )
+        remove_output_files(outputFiles)
+        return
+
+    if args.accumulate is not None:
+        # the updated accumulator replaces the old one once it is complete
+        outputFiles["accumulator"] = args.accumulate + ".tmp"
+        accOffsets = create_accumulator(
+            outputFiles["accumulator"], hdr, args.kernel, spec_size, ny, nx
+        )
+
+    if verbose > 3:
+        print("\n\n Gridding")
+        sys.stdout.flush()
+
+    # the statistics of each channel of every output, as they are written.
+    # Those of the weights are kept with --noweight for the CHANSTATS table.
+    fileStats = {}
+    for name in outputNames:
+        for fileType in fileTypes:
+            fileStats[name + fileType] = new_stats(fileNchan[name + "cube"])
+    if partitions is not None:
+        # partitions at the same positions are gridded together, except
+        # when streaming where each reads its own rows from the files
+        groups = [[index] for index in range(len(partitions))]
+        if not args.stream:
+            groups = position_groups(partitions, xsky, ysky)
+        if verbose > 3 and len(groups) < len(partitions):
+            print("The partitions are at %d sets of positions" % len(groups))
+    # the grid_otf arguments that are the same for every slab and tile
+    gridArgs = {
+        "pix_scale": pix_scale,
+        "refXsky": refXsky,
+        "centerYsky": centerYsky,
+        "beam_fwhm": beam_fwhm,
+        "kernel_type": args.kernel,
+        "gauss_fwhm": gauss_fwhm,
+        "verbose": verbose,
+        "dtype": gridType,
+        "backend": args.backend,
+        "planDir": args.cache,
+        # the sparse gridding plan, shared by the slabs of this run
+        "plans": {},
+        "threads": args.threads,
+        # with --accumulate the sums are normalized after the old ones are added
+        "normalize": args.accumulate is None,
+    }
+    cubeShape = (spec_size, cubeNy, cubeNx)
+    for slabStart, slabStop, band in slabBands:
+        slabGridArgs = gridArgs
+        if band is not None:
+            slabGridArgs = dict(
+                gridArgs, beam_fwhm=bandBeams[band], gauss_fwhm=bandGauss[band]
+            )
+        slabSpec = None
+        makeChunks = None
+        slabMask = None
+        if args.stream:
+            # each slab reads only its own channels from the files
+            (slabChanStart, slabChanStop, skip) = slab_channel_range(
+                chanStart,
+                slabStart,
+                slabStop,
+                average,
+                smoothing=args.smooth,
+                chanStop=chanStop,
+            )
+            makeChunks = functools.partial(
+                iter_spectra,
+                fileInfo["files"],
+                slabChanStart,
+                slabChanStop,
+                average,
+                scanlist,
+                minTsys,
+                maxTsys,
+                smoothing=args.smooth,
+                cacheDir=args.cache,
+                rowsPerChunk=args.chunkrows,
+                chanSlice=slice(skip, skip + slabStop - slabStart),
+                verbose=verbose,
+            )
+        else:
+            slabSpec = spec[:, slabStart:slabStop]
+            if nanMask is not None:
+                slabMask = nanMask[:, slabStart:slabStop]
+
+        if verbose > 3 and len(slabBands) > 1:
+            print("   channels %d:%d" % (slabStart, slabStop - 1))
+            sys.stdout.flush()
+
+        # the output files of this slab and the channel it starts at in them
+        slabName = ""
+        fileChanStart = slabStart
+        if lines is not None:
+            slabName = outputNames[band]
+            fileChanStart = slabStart - bands[band][0]
+
+        try:  # pass all the info to the grid_otf function
+            if partitions is not None:
+                slabData = grid_partitions(
+                    partitions,
+                    groups,
+                    stokesSets,
+                    slabSpec,
+                    makeChunks,
+                    xsky,
+                    ysky,
+                    weights,
+                    nx,
+                    ny,
+                    wcsObj,
+                    slabGridArgs,
+                )
+                slabResults = [((0, nx, 0, ny), slabData)]
+            elif tiles is None:
+                (cube, weight, final_fwhm) = grid_otf(
+                    slabSpec,
+                    nx,
+                    ny,
+                    xsky,
+                    ysky,
+                    wcsObj,
+                    weights=weights,
+                    chunks=None if makeChunks is None else makeChunks(),
+                    nanMask=slabMask,
+                    **slabGridArgs,
+                )
+                slabData = {slabName + "cube": cube, slabName + "weight": weight}
+                slabResults = [((0, nx, 0, ny), slabData)]
+            else:
+                # the tiles are gridded and written one by one
+                tileResults = iter_tiles(
+                    tiles,
+                    tileRowsList,
+                    slabSpec,
+                    makeChunks,
+                    xsky,
+                    ysky,
+                    weights,
+                    wcsObj,
+                    slabStop - slabStart,
+                    slabGridArgs,
+                    jobs=args.jobs,
+                )
+                slabResults = (
+                    (tile, {"cube": cube, "weight": weight})
+                    for tile, cube, weight in tileResults
+                )
+
+            for tile, slabData in slabResults:
+                if slabData is None or any(
+                    [block is None for block in slabData.values()]
+                ):
+                    if verbose > 1:
+                        print("Problem gridding data")
+                    remove_output_files(outputFiles)
+                    return
+
+                if args.accumulate is not None:
+                    (cube, weight) = accumulate_block(
+                        args.accumulate,
+                        outputFiles["accumulator"],
+                        accOffsets,
+                        accHdr is not None,
+                        cubeShape,
+                        slabStart,
+                        tile,
+                        slabData["cube"],
+                        slabData["weight"],
+                    )
+                    slabData = {
+                        "cube": cube.astype(gridType, copy=False),
+                        "weight": weight.astype(gridType, copy=False),
+                    }
+
+                # the cube and weight files are written at the same time
+                slabFiles = [
+                    fileType for fileType in writeFiles if fileType in slabData
+                ]
+                blockShape = None
+                (blockX0, blockY0) = (0, 0)
+                if tiles is not None:
+                    blockShape = cubeShape
+                    (blockX0, blockY0) = (tile[0] - cubeX0, tile[2] - cubeY0)
+                blockStats = write_cube_blocks(
+                    [
+                        (
+                            outputFiles[fileType],
+                            dataOffsets[fileType],
+                            blockShape,
+                            fileChanStart,
+                            blockX0,
+                            blockY0,
+                            slabData[fileType],
+                        )
+                        for fileType in slabFiles
+                    ]
+                )
+                for fileType, stats in zip(slabFiles, blockStats):
+                    add_stats(fileStats[fileType], fileChanStart, stats)
+                for name in fileMoments:
+                    if name + "cube" in slabData:
+                        add_moment_block(
+                            fileMoments[name],
+                            fileChanStart,
+                            blockX0,
+                            blockY0,
+                            slabData[name + "cube"],
+                        )
+                for fileType in slabData:
+                    if fileType not in slabFiles:
+                        add_stats(
+                            fileStats[fileType],
+                            fileChanStart,
+                            block_stats(slabData[fileType]),
+                        )
+                del slabData
+        except MemoryError:
+            if verbose > 1:
+                print(
+                    "Not enough memory to create the image cubes necessary to grid this data"
+                )
+                print(
+                    "   Requested image size : %d x %d x %d "
+                    % (nx, ny, slabStop - slabStart)
+                )
+                print(
+                    "   find a beefier machine, use --max-memory to grid the cube in channel slabs,"
+                )
+                print(
+                    "   consider restricting the data to fewer channels or using channel averaging"
+                )
+                print("   or use AIPS (with idlToSdfits) to grid all of this data")
+            remove_output_files(outputFiles)
+            return
+
+    if verbose > 3:
+        print("Writing cube")
+
+    # DATAMAX and DATAMIN come from the channel statistics
+    dataMax = {}
+    dataMin = {}
+    for fileType in writeFiles:
+        (dataMax[fileType], dataMin[fileType]) = stats_range(fileStats[fileType])
+
+    cubeFiles = [name + "cube" for name in outputNames]
+    if all([np.isnan(dataMax[fileType]) for fileType in cubeFiles]) and verbose > 2:
+        print(
+            "Entire data cube is not-a-number, this may be because a few channels are consistently bad"
+        )
+        print("consider restricting the channel range")
+
+    for fileType in writeFiles:
+        if np.isnan(dataMax[fileType]):
+            # remove them
+            update_cube_header(
+                outputFiles[fileType],
+                dataOffsets[fileType],
+                {},
+                remove=["DATAMAX", "DATAMIN"],
+            )
+        else:
+            update_cube_header(
+                outputFiles[fileType],
+                dataOffsets[fileType],
+                {
+                    "DATAMAX": float(dataMax[fileType]),
+                    "DATAMIN": float(dataMin[fileType]),
+                },
+            )
+
+    if args.beam_tolerance is not None:
+        # the beam of each plane follows the cube data
+        table = beam_table(bands, bandFinal, spec_size)
+        for fileType in cubeFiles:
+            pyfits.append(outputFiles[fileType], table.data, table.header)
+
+    # the statistics of each channel go in a CHANSTATS table with the cube
+    for name in outputNames:
+        table = stats_table(
+            fileStats[name + "cube"],
+            fileHdrs[name + "cube"].get("BUNIT", ""),
+            weightStats=fileStats[name + "weight"],
+        )
+        pyfits.append(outputFiles[name + "cube"], table.data, table.header)
+
+    # the moment and noise maps, each in its own file
+    for name in fileMoments:
+        maps = moment_maps(fileMoments[name])
+        for product in maps:
+            if product in SIGNAL_PRODUCTS:
+                (mask, windows) = (fileMoments[name]["signal"], signalWindows)
+            else:
+                (mask, windows) = (fileMoments[name]["lineFree"], lineFreeWindows)
+            mapHdr = map_header(fileHdrs[name + "cube"], product, mask, windows)
+            write_map(outputFiles[name + product], mapHdr, maps[product], gridType)
+            if verbose > 3:
+                print("Wrote " + outputFiles[name + product])
+
+    # the compressed and chunked copies are made from the finished files
+    for fileType in writeFiles:
+        if args.compress is not None:
+            write_compressed(
+                outputFiles[fileType],
+                args.compress,
+                args.quantize,
+                args.chunk_shape,
+                verbose=verbose,
+            )
+        if args.chunked:
+            write_chunk_store(
+                outputFiles[fileType], args.chunk_shape, verbose=verbose
+            )
+
+    if args.accumulate is not None:
+        newEntries = [
+            ingested_entry(thisFile, len(rows), format_scans(fileScans))
+            for (thisFile, rows), fileScans in zip(
+                fileInfo["files"], fileInfo["filescans"]
+            )
+        ]
+        finish_accumulator(outputFiles["accumulator"], ingested + newEntries)
+        os.replace(outputFiles["accumulator"], args.accumulate)
+        if verbose > 3:
+            print("Updated " + args.accumulate)
+
+    # with --stream the cache entries are written while gridding
+    if args.cache is not None and args.cache_size is not None:
+        trim_cache(args.cache, args.cache_size * 1024.0**3, verbose=verbose)
 
     end_time = time.time()
     if verbose > 3:
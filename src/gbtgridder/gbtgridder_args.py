@@ -49,8 +49,122 @@ def check_args(args):
         print("maxtsys must be > mintsys")
         sys.exit(1)
 
+    if args.smooth != "boxcar" and args.average is None and args.line is None:
+        print("smooth requires average or line")
+        sys.exit(1)
 
-def parser_args(args, gbtgridderVersion):
+    if args.beam_tolerance is not None and args.beam_tolerance <= 0:
+        print("beam-tolerance must be > 0")
+        sys.exit(1)
+
+    if args.beam_tolerance is not None and args.beam_fwhm is not None:
+        print("beam-tolerance can not be used with beam_fwhm")
+        sys.exit(1)
+
+    if args.jobs < 1:
+        print("jobs must be >= 1")
+        sys.exit(1)
+
+    if args.threads < 1:
+        print("threads must be >= 1")
+        sys.exit(1)
+
+    if args.backend == "sparse" and args.kernel != "gauss":
+        print("backend sparse can only be used with the gauss kernel")
+        sys.exit(1)
+
+    if args.tile_size is not None and args.tile_size < 1:
+        print("tile-size must be >= 1")
+        sys.exit(1)
+
+    if args.tile is not None and args.tile < 0:
+        print("tile must be >= 0")
+        sys.exit(1)
+
+    tileOptions = args.tile is not None or args.tile_tasks is not None
+    if tileOptions and args.tile_size is None:
+        print("tile and tile-tasks require tile-size")
+        sys.exit(1)
+
+    if args.tile is not None and args.tile_tasks is not None:
+        print("tile and tile-tasks can not be used together")
+        sys.exit(1)
+
+    if args.accumulate is not None and tileOptions:
+        print("accumulate can not be used with tile or tile-tasks")
+        sys.exit(1)
+
+    if args.stokes_i and args.partition not in ["pol", "polfeed"]:
+        print("stokes-i requires partition pol or polfeed")
+        sys.exit(1)
+
+    if args.partition is not None and (
+        args.tile_size is not None or args.accumulate is not None
+    ):
+        print("partition can not be used with tile-size or accumulate")
+        sys.exit(1)
+
+    if args.line is not None and args.channels is not None:
+        print("line can not be used with channels")
+        sys.exit(1)
+
+    lineOptions = [
+        args.stream,
+        args.tile_size is not None,
+        args.accumulate is not None,
+        args.partition is not None,
+        args.beam_tolerance is not None,
+    ]
+    if args.line is not None and any(lineOptions):
+        print(
+            "line can not be used with stream, tile-size, accumulate, partition "
+            "or beam-tolerance"
+        )
+        sys.exit(1)
+
+    if args.chunkrows is not None and args.chunkrows < 1:
+        print("chunkrows must be >= 1")
+        sys.exit(1)
+
+    if args.cache_size is not None and args.cache_size <= 0:
+        print("cache-size must be > 0")
+        sys.exit(1)
+
+    if args.cache_size is not None and args.cache is None:
+        print("cache-size requires cache")
+        sys.exit(1)
+
+    if args.max_memory is not None and args.max_memory <= 0:
+        print("max-memory must be > 0")
+        sys.exit(1)
+
+    if args.compress == "rice" and args.quantize is None:
+        print("compress rice is lossy, it requires quantize")
+        sys.exit(1)
+
+    if args.quantize is not None and args.compress is None:
+        print("quantize requires compress")
+        sys.exit(1)
+
+    if args.quantize is not None and args.quantize == 0:
+        print("quantize must not be 0")
+        sys.exit(1)
+
+    if min(args.chunk_shape) < 1:
+        print("chunk-shape values must be >= 1")
+        sys.exit(1)
+
+    previewValues = [args.preview_channels, args.preview_binning, args.preview_sample]
+    if min(previewValues) < 1:
+        print("preview-channels, preview-binning and preview-sample must be >= 1")
+        sys.exit(1)
+
+    if args.preview and tileOptions:
+        print("preview can not be used with tile or tile-tasks")
+        sys.exit(1)
+
+
+def make_parser(gbtgridderVersion):
     parser = argparse.ArgumentParser(
         epilog="gbtgridder version: %s" % gbtgridderVersion
     )
@@ -60,12 +174,30 @@ def parser_args(args, gbtgridderVersion):
         type=str,
         help="Optional channel range to use.  " "'<start>:<end>' counting from 0.",
     )
+    parser.add_argument(
+        "--line",
+        type=str,
+        action="append",
+        metavar="NAME:START:END[:RESTFREQ[:AVERAGE]]",
+        help="Grid this channel window, counted as for --channels, into its own "
+        "files named <output>_NAME_cube.fits, with its own rest frequency (MHz) and "
+        "channel averaging (default --average).  Give --line once for each line, "
+        "the data are read once for all of them.",
+    )
     parser.add_argument(
         "-a",
         "--average",
         type=int,
         help="Optionally average channels, keeping only number of channels/naverage channels",
     )
+    parser.add_argument(
+        "--smooth",
+        type=str,
+        default="boxcar",
+        choices=["boxcar", "hanning", "gaussian"],
+        help="Smoothing kernel used by --average, with a FWHM of naverage channels, "
+        "default is boxcar",
+    )
     parser.add_argument(
         "-s",
         "--scans",
@@ -74,6 +206,21 @@ def parser_args(args, gbtgridderVersion):
     )
     parser.add_argument("-m", "--maxtsys", type=float, help="max Tsys value to use")
     parser.add_argument("-z", "--mintsys", type=float, help="min Tsys value to use")
+    parser.add_argument(
+        "--partition",
+        type=str,
+        choices=["pol", "feed", "polfeed"],
+        help="Grid each polarization (CRVAL4), each feed or each of both separately "
+        "onto the same map, from one read of the data.  Each partition is written "
+        "to its own files named by the partition, e.g. <output>_XX_cube.fits",
+    )
+    parser.add_argument(
+        "--stokes-i",
+        default=False,
+        action="store_true",
+        help="With --partition pol or polfeed also write Stokes I, the mean of the "
+        "XX and YY (or RR and LL) cubes, for each feed",
+    )
     parser.add_argument(
         "SDFITSfiles", type=str, nargs="+", help="The calibrated SDFITS files to use."
     )
@@ -91,6 +238,17 @@ def parser_args(args, gbtgridderVersion):
         choices=["gauss", "gaussbessel", "nearest"],
         help="gridding kernel, default is gauss",
     )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="cygrid",
+        choices=["cygrid", "sparse"],
+        help="Gridding engine, default is cygrid.  sparse builds the kernel weights "
+        "between each pixel and spectrum once, as a sparse matrix, and grids all "
+        "channels with sparse matrix products.  It needs memory for every "
+        "pixel-spectrum pair within the kernel support.  Only the gauss kernel "
+        "can be used with sparse.",
+    )
     parser.add_argument(
         "--diameter",
         type=float,
@@ -121,6 +279,15 @@ def parser_args(args, gbtgridderVersion):
         type=float,
         help="Specify the BEAM_FWHM (HPBW) value, default calculated per telscope diameter in degrees",
     )
+    parser.add_argument(
+        "--beam-tolerance",
+        type=float,
+        help="Grid with a beam that follows the frequency.  The channels are grouped "
+        "into bands over which the beam changes by at most this fraction, and each "
+        "band is gridded with the kernel for its own beam.  The beam of each channel "
+        "is written to a BEAMS table in the cube file.  Default is one beam at the "
+        "center frequency for all channels.",
+    )
     parser.add_argument("--restfreq", type=float, help="Rest frequency (MHz)")
     parser.add_argument(
         "-p",
@@ -142,12 +309,54 @@ def parser_args(args, gbtgridderVersion):
         " gridding all of the input data.  Use of --clonecube overrides any use"
         " of --size, --pixelwidth, --mapcenter and --proj arguments.",
     )
+    parser.add_argument(
+        "--accumulate",
+        type=str,
+        help="Accumulator FITS file for a map that is built up over many runs.  It "
+        "holds the unweighted data and weight sums and the list of SDFITS files "
+        "gridded so far.  Only the SDFITS files that are not in it yet are "
+        "gridded, onto the map of the accumulator (as with --clonecube), and "
+        "added to it.  The output cubes are made from the updated sums.  The "
+        "file is created by the first run.",
+    )
     parser.add_argument(
         "--autoConfirm",
         default=False,
         action="store_true",
         help="Set this to True if you'd like to auto-confirm the program stop and move straight into gridding",
     )
+    parser.add_argument(
+        "--preview",
+        default=False,
+        action="store_true",
+        help="Write a quick look at the map, <output>_preview.fits, and the number "
+        "of spectra in each of its pixels, <output>_hits.fits, in place of the cube "
+        "and weight files.  The channels are averaged into a few blocks, the pixels "
+        "are made coarser and the spectra are binned to the nearest pixel without "
+        "a kernel, so the map center, size and scan selection can be checked "
+        "quickly.  There is no confirmation prompt.",
+    )
+    parser.add_argument(
+        "--preview-channels",
+        type=int,
+        default=1,
+        help="Number of channel blocks in the --preview cube, default is 1 (the "
+        "average of all channels).",
+    )
+    parser.add_argument(
+        "--preview-binning",
+        type=int,
+        default=4,
+        help="Each --preview pixel is this many pixels of the map on a side, "
+        "default is 4.",
+    )
+    parser.add_argument(
+        "--preview-sample",
+        type=int,
+        default=1,
+        help="Read only every Nth spectrum for the --preview, default is 1 (all of "
+        "them).  The hits count every spectrum.",
+    )
     parser.add_argument(
         "--noweight",
         default=False,
@@ -160,6 +369,138 @@ def parser_args(args, gbtgridderVersion):
         action="store_true",
         help="Is selected, all weight values will be equal and set to 1",
     )
+    parser.add_argument(
+        "--signal",
+        type=str,
+        metavar="START:END[km/s]",
+        help="Also write moment 0, 1 and 2 and peak maps of these channels of the "
+        "output cube, <output>_mom0.fits etc.  The channels are counted as for "
+        "--channels, or give a velocity range in km/s, e.g. --signal=-20:35km/s "
+        "(with = when it starts with -).  The maps are made as the cube is gridded.",
+    )
+    parser.add_argument(
+        "--line-free",
+        type=str,
+        action="append",
+        metavar="START:END[km/s]",
+        help="Also write a noise map, <output>_noise.fits, of the rms of these "
+        "channels of the output cube, given as for --signal.  Give --line-free once "
+        "for each line-free window.",
+    )
+    parser.add_argument(
+        "--compress",
+        type=str,
+        choices=["gzip", "rice"],
+        help="Also write tile-compressed copies of the output cubes, "
+        "<output>_cube.fits.fz and _weight.fits.fz, compressed in --chunk-shape "
+        "tiles.  gzip is lossless unless --quantize is given, rice requires "
+        "--quantize.",
+    )
+    parser.add_argument(
+        "--quantize",
+        type=float,
+        help="Quantization level for --compress: the values are rounded to about "
+        "1/QUANTIZE of the noise in each tile (a negative value is the step size "
+        "itself), which compresses much better but is lossy.",
+    )
+    parser.add_argument(
+        "--chunked",
+        default=False,
+        action="store_true",
+        help="Also write the output cubes as chunked directory stores, "
+        "<output>_cube.zarr and _weight.zarr, of compressed --chunk-shape chunks "
+        "with the FITS header as JSON.",
+    )
+    parser.add_argument(
+        "--chunk-shape",
+        type=int,
+        nargs=3,
+        default=[16, 128, 128],
+        metavar=("NCHAN", "NY", "NX"),
+        help="Shape of the tiles of --compress and of the chunks of --chunked, "
+        "default is 16 128 128.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes used to load the SDFITS data, and to grid "
+        "the tiles with --tile-size, default is 1",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of threads used for the gridding, default is 1.  The channels "
+        "are split into this many blocks which are gridded at the same time.  The "
+        "result does not depend on the number of threads.",
+    )
+    parser.add_argument(
+        "--tile-size",
+        type=int,
+        help="Grid the map in square tiles of at most this many pixels on a side.  "
+        "Each tile is gridded from just the spectra near it, and the tiles are put "
+        "together in the output cube.  Default is to grid the whole map at once.",
+    )
+    parser.add_argument(
+        "--tile",
+        type=int,
+        help="Only grid this tile (counting from 0) of the --tile-size tiles, into "
+        "output files named for the tile.  The header places the tile in the map.",
+    )
+    parser.add_argument(
+        "--tile-tasks",
+        type=str,
+        help="Write one gbtgridder command per --tile-size tile to this file and exit, "
+        "without gridding.  Each command uses --tile, so a batch system can run them "
+        "as separate jobs.",
+    )
+    parser.add_argument(
+        "--stream",
+        default=False,
+        action="store_true",
+        help="Grid the spectra as they are read, one chunk of rows at a time, "
+        "instead of first loading all of them into memory.  --jobs is not used when streaming.",
+    )
+    parser.add_argument(
+        "--chunkrows",
+        type=int,
+        help="Maximum number of rows per chunk when streaming, default is one chunk per SDFITS file",
+    )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        default="float64",
+        choices=["float64", "float32"],
+        help="Floating point type used for the loaded spectra, the weights, the "
+        "gridding and the output cubes, default is float64.  float32 halves the "
+        "memory and output size, see the documentation for its accuracy.",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=float,
+        help="Memory budget for gridding (GB).  The spectral axis is gridded in "
+        "slabs of channels that fit within this budget and each slab is written "
+        "to the output files before the next one starts.  With --stream each slab "
+        "reads only its own channels from the SDFITS files.  Each slab repeats the "
+        "spatial part of the gridding, so use as large a budget as is available.",
+    )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        help="Directory of the ingestion cache.  The rows and spectra selected from "
+        "each SDFITS file are saved there and are used instead of reading the file "
+        "again by later runs with the same file, channels, averaging, scans and "
+        "tsys limits.  The scan index of each file used by --scans, and the "
+        "gridding plans of --backend sparse, are also kept there.  An entry is not used once its file has changed.",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=float,
+        help="Maximum size of the ingestion cache (GB).  The least recently used "
+        "entries are removed when the cache grows past this.  Default is no limit.",
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -176,6 +517,12 @@ def parser_args(args, gbtgridderVersion):
         version="gbtgridder version: %s" % gbtgridderVersion,
     )
 
+    return parser
+
+
+def parser_args(args, gbtgridderVersion):
+    parser = make_parser(gbtgridderVersion)
+
     args = parser.parse_args()
 
     return args
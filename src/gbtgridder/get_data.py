@@ -24,11 +24,95 @@ import astropy.time as apTime
 import numpy
 from astropy.io import fits
 
-from .boxcar import boxcar
+from .boxcar import boxcar_freq, smooth
+from .cache import cache_selection, read_cache, write_cache
+from .scan_index import scan_rows
 
 # speed of light (m/s)
 _C = 299792458.0
 
+
+def data_window_view(sdfitsHDU):
+    """Return a read-only (nrows, nchan) view of the DATA column of an
+    SDFITS table straight from the memory-mapped file.
+
+    The view is built from the table's row stride (NAXIS1, the bytes in
+    each row) and the byte offset of DATA within each row, with the big-endian FITS element type,
+    so slicing it touches only the requested bytes of each row.
+
+    Returns None when the file can not be read that way (e.g. it is
+    compressed or DATA is a variable length array).  The caller should then
+    fall back to the DATA field of the table.
+    """
+    fileInfo = sdfitsHDU.fileinfo()
+    if fileInfo is None or fileInfo["file"].compression is not None:
+        return None
+    names = [name.upper() for name in sdfitsHDU.columns.names]
+    if "DATA" not in names:
+        return None
+    colName = sdfitsHDU.columns.names[names.index("DATA")]
+    dataType, colOffset = sdfitsHDU.columns.dtype.fields[colName][:2]
+    if dataType.subdtype is None or dataType.base.kind != "f":
+        return None
+    nchan = dataType.shape[0]
+    elemType = dataType.base.newbyteorder(">")
+
+    nrows = sdfitsHDU.header["NAXIS2"]
+    rowStride = sdfitsHDU.header["NAXIS1"]
+    rawBytes = numpy.memmap(
+        fileInfo["file"].name,
+        dtype=numpy.uint8,
+        mode="r",
+        offset=fileInfo["datLoc"],
+        shape=(nrows * rowStride,),
+    )
+    return numpy.ndarray(
+        (nrows, nchan),
+        dtype=elemType,
+        buffer=rawBytes,
+        offset=colOffset,
+        strides=(rowStride, elemType.itemsize),
+    )
+
+
+def read_data_window(dataView, rows, chanStart, chanStop, out=None):
+    """Read channels chanStart through chanStop (inclusive) of the given rows.
+
+    dataView is the big-endian view returned by data_window_view and rows
+    is an increasing array of row indices.  Each contiguous run of rows is
+    copied in one step, which also converts to native byte order, so only
+    the bytes in the channel window are read from the file.
+
+    The values are written into out if it is given, otherwise a new array
+    with the native byte order version of the DATA type is returned.
+    """
+    nchan = chanStop - chanStart + 1
+    if out is None:
+        out = numpy.empty((len(rows), nchan), dtype=dataView.dtype.newbyteorder("="))
+
+    if len(rows) == 0:
+        return out
+
+    # start of each run of consecutive rows
+    breaks = numpy.flatnonzero(numpy.diff(rows) != 1) + 1
+    runStarts = numpy.concatenate(([0], breaks))
+    runStops = numpy.concatenate((breaks, [len(rows)]))
+    for i0, i1 in zip(runStarts, runStops):
+        r0 = rows[i0]
+        out[i0:i1] = dataView[r0 : r0 + (i1 - i0), chanStart : (chanStop + 1)]
+
+    return out
+
+
+def obstimes_jd(obsTimes):
+    """Convert the obstimes strings returned by get_data to Julian dates (UTC).
+
+    get_data leaves the DATE-OBS strings as they are since nothing in the
+    gridding needs the times.  This is for whatever does.
+    """
+    return apTime.Time(obsTimes, format="isot", scale="utc").jd
+
+
 # instead of reporting on tsys flagging here, just return number actually flagged here
 # for reporting later
 
@@ -43,12 +127,59 @@ def get_data(
     maxtsys,
     getdata=True,
     verbose=4,
+    out=None,
+    rowRange=None,
+    smoothing="boxcar",
+    cacheDir=None,
+    rows=None,
 ):
     """Given an sdfits file, return the desired data and associated sky
     positions, weight, polarization and frequency axis information.
 
     If getdata is False then do not actually return the data values.
+    This is the cheap metadata pass: the DATA and DATE-OBS columns are
+    never touched, but "nrows" and "spec_size" are set so that the caller
+    can preallocate the spectra.  Otherwise
+    result["obstimes"] holds the DATE-OBS string of each row, use
+    obstimes_jd to get Julian dates.
+
+    If out is given it must be an (nrows, spec_size) array and the selected,
+    optionally averaged, data are written directly into it.  That array is
+    then returned as result["data"].
+
+    When averaging, smoothing is the kernel used before decimating (one of
+    boxcar, hanning, gaussian, see boxcar.smooth).
+
+    If rowRange is given as (rowStart, rowStop) then only those rows of the
+    table are considered, before any scan selection.  The indices of the
+    selected table rows are always returned in result["rows"].
+
+    rows, if given, are the selected table rows from an earlier call with
+    the same selection (e.g. result["rows"] of the metadata pass).  The
+    scans are then not looked up again, rowRange still applies.  Only the
+    values of the selected rows are read from each column.
+
+    If cacheDir is given the result is first looked for in that ingestion
+    cache (see cache.py) and the SDFITS file is not opened when it is
+    found there.  Otherwise it is saved there once it has been read.
     """
+    if cacheDir is not None:
+        selection = cache_selection(
+            chanStart,
+            chanStop,
+            average,
+            smoothing,
+            scanlist,
+            mintsys,
+            maxtsys,
+            getdata=getdata,
+            rowRange=rowRange,
+            rows=rows,
+        )
+        result = read_cache(cacheDir, sdfitsFile, selection, out=out)
+        if result is not None:
+            return result
+
     result = {}
     thisFits = fits.open(sdfitsFile, memmap=True, mode="readonly")
 
@@ -93,35 +224,59 @@ def get_data(
         thisFits.close()
         return result
 
-    # scan selection first
+    # scan selection first.  The selected rows are kept as an index into
+    # the table, rowSel, so only their values are read from each column.
     thisTabData = thisFits[1].data
-    if scanlist is not None:
-        allScans = thisTabData.field("scan")
-        uniqueScans = numpy.unique(allScans)
-        scanMask = numpy.full(allScans.shape, True, dtype=bool)
-        for scan in uniqueScans:
-            if scan not in scanlist:
-                scanMask[allScans == scan] = False
-        thisTabData = thisTabData[scanMask]
-        if len(thisTabData) == 0:
-            if verbose > 2:
-                print(
-                    "Warning: %s has no rows within the list of selected scan numbers.  Skipping."
-                    % sdfitsFile
-                )
+    if rows is not None:
+        rows = numpy.asarray(rows)
+        if len(rows) > 0 and rows[-1] >= len(thisTabData):
+            # the file has changed since those rows were selected
             thisFits.close()
             return result
-
-    result["scans"] = thisTabData.field("scan")
-    result["xsky"] = thisTabData.field("crval2")
-    result["ysky"] = thisTabData.field("crval3")
-    result["stokes"] = thisTabData.field("crval4")
+        if rowRange is not None:
+            rows = rows[(rows >= rowRange[0]) & (rows < rowRange[1])]
+    elif scanlist is not None:
+        rows = scan_rows(
+            sdfitsFile,
+            thisFits[1],
+            scanlist,
+            rowRange=rowRange,
+            cacheDir=cacheDir,
+            verbose=verbose,
+        )
+    elif rowRange is not None:
+        rows = numpy.arange(rowRange[0], min(rowRange[1], len(thisTabData)))
+    else:
+        rows = numpy.arange(len(thisTabData))
+    if len(rows) == 0:
+        if verbose > 2 and scanlist is not None:
+            print(
+                "Warning: %s has no rows within the list of selected scan numbers.  Skipping."
+                % sdfitsFile
+            )
+        thisFits.close()
+        return result
+    rowSel = rows
+    if rows[-1] - rows[0] + 1 == len(rows):
+        # consecutive rows are a view of the columns, not a copy
+        rowSel = slice(rows[0], rows[-1] + 1)
+    firstRow = thisTabData[rows[0]]
+
+    result["scans"] = thisTabData.field("scan")[rowSel]
+    result["xsky"] = thisTabData.field("crval2")[rowSel]
+    result["ysky"] = thisTabData.field("crval3")[rowSel]
+    result["stokes"] = thisTabData.field("crval4")[rowSel]
+    # the feed of each row, for partitioning the data by feed
+    if "FEED" in thisTabData.names:
+        result["feeds"] = thisTabData.field("feed")[rowSel]
+    else:
+        result["feeds"] = numpy.zeros(len(rows), dtype=numpy.int16)
 
     # assumes all the data are in the same coordinate system
-    result["xctype"] = thisTabData[0].field("ctype2")
-    result["yctype"] = thisTabData[0].field("ctype3")
-    result["radesys"] = thisTabData[0].field("radesys")
-    result["equinox"] = thisTabData[0].field("equinox")
+    result["xctype"] = firstRow.field("ctype2")
+    result["yctype"] = firstRow.field("ctype3")
+    result["radesys"] = firstRow.field("radesys")
+    result["equinox"] = firstRow.field("equinox")
 
     # watch for ???? issues in [xy]ctype - caused by missing GO FITS file as seen by sdfits
     if result["xctype"] == "????" or result["yctype"] == "????":
@@ -139,11 +294,11 @@ def get_data(
         result["radesys"] = "FK5"
         result["equinox"] = 2000.0
 
-    # time
-    dateObs = thisTabData.field("date-obs")
-    result["jdobs"] = apTime.Time(dateObs, format="isot", scale="utc").jd
+    # time, the strings are only converted when needed, see obstimes_jd
+    if getdata:
+        result["obstimes"] = numpy.asarray(thisTabData.field("date-obs")[rowSel])
     # date-obs from first row
-    result["date-obs"] = dateObs[0]
+    result["date-obs"] = firstRow.field("date-obs")
 
     if chanStop is None or chanStop >= nchan:
         chanStop = nchan - 1
@@ -154,14 +309,14 @@ def get_data(
     # need the frequency axis information first
     # column values relevant to the frequency axis
     # assumes axis is FREQ
-    crval1 = thisTabData[0].field("crval1")
-    crv1 = thisTabData.field("crval1")
-    cdelt1 = thisTabData[0].field("cdelt1")
-    cd1 = thisTabData.field("cdelt1")
-    crpix1 = thisTabData[0].field("crpix1")
-    crp1 = thisTabData.field("crpix1")
-    vframe = thisTabData.field("vframe")
-    frest = thisTabData.field("restfreq")
+    crval1 = firstRow.field("crval1")
+    crv1 = thisTabData.field("crval1")[rowSel]
+    cdelt1 = firstRow.field("cdelt1")
+    cd1 = thisTabData.field("cdelt1")[rowSel]
+    crpix1 = firstRow.field("crpix1")
+    crp1 = thisTabData.field("crpix1")[rowSel]
+    vframe = thisTabData.field("vframe")[rowSel]
+    frest = thisTabData.field("restfreq")[rowSel]
     beta = vframe / _C
     doppler = numpy.sqrt((1.0 + beta) / (1.0 - beta))
     result["crp1"] = crpix1
@@ -175,22 +330,40 @@ def get_data(
     result["freq"] = freq
 
     if getdata:
-        # chan selection happens here
-        result["data"] = thisTabData.field("data")[:, chanStart : (chanStop + 1)]
-        # do any channel averaging here
+        # chan selection happens here, reading only the selected channels
+        # of the selected rows when possible
+        dataView = data_window_view(thisFits[1])
+        if average is None:
+            dataOut = out
+        else:
+            dataOut = None
+        if dataView is not None:
+            data = read_data_window(dataView, rows, chanStart, chanStop, out=dataOut)
+        else:
+            data = thisTabData.field("data")[rowSel, chanStart : (chanStop + 1)]
+        # do any channel averaging here, straight into out if given
         if average is not None:
-            (result["data"], result["freq"]) = boxcar(
-                result["data"], result["freq"], average
+            (data, result["freq"]) = smooth(
+                data, result["freq"], average, kernel=smoothing, out=out
             )
+        if out is not None and data is not out:
+            # this also converts from the big-endian FITS values
+            out[...] = data
+            data = out
+        result["data"] = data
 
     else:
         result["data"] = None
+        if average is not None:
+            result["freq"] = boxcar_freq(result["freq"], average)
 
-    result["spec_size"] = result["data"][1, :].size
+    result["nrows"] = len(rows)
+    result["rows"] = rows
+    result["spec_size"] = result["freq"].size
     # for now, scalar weights.  Eventually spectral weights - which will need to know
     # where the NaNs were in the above
-    texp = thisTabData.field("exposure")
-    tsys = thisTabData.field("tsys")
+    texp = thisTabData.field("exposure")[rowSel]
+    tsys = thisTabData.field("tsys")[rowSel]
     result["tsys"] = tsys
     result["texp"] = texp
 
@@ -225,7 +398,7 @@ def get_data(
     # and specsys - appropriate for current WCS spectral coordinate convention.
     # this will throw an exception if there is no hyphen.  A proper
     # sdfits file will always have that hyphen
-    veldef = thisTabData[0].field("veldef")
+    veldef = firstRow.field("veldef")
     veldef, dopframe = veldef.split("-")
     result["veldef"] = veldef
     # translate dopframe into specsys
@@ -252,11 +425,11 @@ def get_data(
         result["specsys"] = specSysDict["OBS"]
 
     # source name of first spectra
-    result["source"] = thisTabData[0].field("object")
+    result["source"] = firstRow.field("object")
 
     # data units, assumes all rows have the same as the first one
     # also assumes DATA is column 7
-    result["units"] = thisTabData[0].field("tunit7")
+    result["units"] = firstRow.field("tunit7")
     # currently the pipeline sets this to the argument value of the
     # requested calibration units, e.g. Ta, Tmb, Jy.  This should
     # really be physical units with the calibration type indicated
@@ -292,4 +465,7 @@ def get_data(
 
     thisFits.close()
 
+    if cacheDir is not None:
+        write_cache(cacheDir, sdfitsFile, selection, result, verbose=verbose)
+
     return result
@@ -21,12 +21,22 @@
 #       Green Bank, WV 24944-0002 USA
 
 
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import cygrid
 import numpy as np
+from scipy import sparse
+
+from .sparse_grid import grid_rows_sparse, kernel_plan, weight_columns
 
 # speed of light (m/s)
 _C = 299792458.0
 
+# the most bytes of per-value weights given to cygrid at once, small next
+# to the spectra so that the weights never add much to the peak memory
+_WEIGHT_BLOCK_BYTES = 8 * 1024**2
+
 
 def prepare_header(wcsObj, nx, ny, nchan):
     """"""
@@ -44,6 +54,257 @@ def prepare_header(wcsObj, nx, ny, nchan):
     return header
 
 
+def slab_channels(nx, ny, nspec, maxBytes, dtype=np.float64):
+    """The number of channels that can be gridded at once within maxBytes.
+
+    This is an estimate of the peak memory used by grid_otf for each
+    channel: the cygrid data and weight planes plus the normalized copies
+    made at the end (about 6 nx*ny planes), and the C-ordered and NaN-cleaned
+    copies of the nspec input values for that channel that cygrid needs.
+    The per-value weights are made a block of rows at a time (see
+    grid_block) and are not counted.  dtype is the type used for all of
+    those.
+
+    Returns 0 if not even one channel fits.
+    """
+    bytesPerChan = np.dtype(dtype).itemsize * (6 * nx * ny + 3 * nspec)
+    return int(maxBytes // bytesPerChan)
+
+
+def channel_slabs(nchan, nchanPerSlab):
+    """Split nchan channels into (chanStart, chanStop) slabs of at most
+    nchanPerSlab channels, chanStop is exclusive."""
+    return [
+        (c0, min(c0 + nchanPerSlab, nchan)) for c0 in range(0, nchan, nchanPerSlab)
+    ]
+
+
+def kernel_setup(kernel_type, beam_fwhm, gauss_fwhm, pix_scale):
+    """Translate a gbtgridder kernel into the cygrid kernel settings.
+
+    Returns (cygrid_kernel_type, kernel_params, support_distance, hpx_maxres)
+    suitable for cygrid.WcsGrid.set_kernel.
+    """
+    gauss_sigma = gauss_fwhm / (2.0 * np.sqrt(2.0 * np.log(2.0)))
+    if kernel_type == "gauss":
+        kernel_type = "gauss1d"
+        kernel_params = gauss_sigma
+        # Resolution of the healpix lookup table.
+        # Value recommended by Winkel et al. (2016)
+        # for Gaussian beams.
+        hpx_maxres = gauss_sigma / 5.0
+        # Support distance for convolution,
+        # same as v0.5 of the `gbtgridder`.
+        support_distance = 3.0 * gauss_fwhm
+    elif kernel_type == "gaussbessel":
+        kernel_type = "gaussbessel"
+        # Convolution function width for a Gaussian tapered Bessel
+        # from Mangum, Emerson, Greisen (2007).
+        kernel_params = (beam_fwhm / 3.0, 2.52, 1.55)
+        hpx_maxres = pix_scale / 2.0
+        # Support distance for convolution.
+        support_distance = 1.0 * beam_fwhm
+    elif kernel_type == "nearest":
+        # kernel_type = "gauss1d"
+        # kernel_params = (gauss_sigma)
+        # hpx_maxres = gauss_sigma / 5
+        kernel_type = "gaussbessel"
+        kernel_params = (beam_fwhm / 3.0, 2.52, 1.55)
+        hpx_maxres = beam_fwhm / 3.0 / 2.0
+        support_distance = 0.5 * pix_scale
+
+    return (kernel_type, kernel_params, support_distance, hpx_maxres)
+
+
+def normalize_cube(data_cube, weights_cube):
+    """Divide the unweighted data cube from the gridding by the weights.
+
+    Pixels with no weight are blanked (NaN), as are invalid weights.  The
+    division is done in place, one channel at a time, so only one plane of
+    temporary values is needed.  Returns (cube, weight), which are
+    data_cube and weights_cube.
+    """
+    # numpy.ma division masks weights this small, keep the same blanking
+    tiny = np.finfo(float).tiny
+    for dataPlane, weightPlane in zip(data_cube, weights_cube):
+        badWeight = ~np.isfinite(weightPlane)
+        blank = badWeight | ~np.isfinite(dataPlane)
+        blank |= np.absolute(dataPlane) * tiny >= np.absolute(weightPlane)
+        np.divide(dataPlane, weightPlane, out=dataPlane, where=~blank)
+        dataPlane[blank] = np.nan
+        weightPlane[badWeight] = np.nan
+
+    return (data_cube, weights_cube)
+
+
+def find_nans(spec):
+    """The (rows, chans) indices of the NaN values in spec.
+
+    Only the rows whose sum is NaN are looked at, so spectra without NaN
+    values cost one sum.
+    """
+    nanRows = np.flatnonzero(np.isnan(np.sum(spec, axis=1)))
+    rowNans, nanChans = np.nonzero(np.isnan(spec[nanRows]))
+    return (nanRows[rowNans], nanChans)
+
+
+def zero_nans(spec):
+    """Set the NaN values of spec to 0 in place.
+
+    This is how the loaders record the NaN values of each block of spectra
+    as it is read, so that grid_otf does not need a copy of the spectra
+    without them.  Returns find_nans(spec) from before they were set.
+    """
+    (rows, chans) = find_nans(spec)
+    spec[rows, chans] = 0
+    return (rows, chans)
+
+
+def nan_mask(nans, shape):
+    """The sparse (nspec, nchan) matrix that is 1 where the spectra were NaN.
+
+    nans is a list of (specOffset, rows, chans) from zero_nans for blocks
+    of rows starting at specOffset.  Returns None if there are no NaN
+    values.
+    """
+    nans = [(offset + rows, chans) for offset, rows, chans in nans if len(rows)]
+    if not nans:
+        return None
+    rows = np.concatenate([rows for rows, _ in nans])
+    chans = np.concatenate([chans for _, chans in nans])
+    return sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.int8), (rows, chans)), shape=shape
+    )
+
+
+def row_weights(spec, weights, nanMask=None):
+    """The weights to grid one block of spectra with.
+
+    Inputs:
+       spec - (nspec, nchan) array of spectra
+       weights - nspec length vector, (nspec, nchan) array or (nspec, m) array
+                 for m equal ranges of channels (see
+                 sparse_grid.weight_columns) of weights, or None for equal
+                 weights (all 1)
+       nanMask - (optional) the nan_mask of spec when its NaN values have
+                 already been set to 0 by zero_nans
+
+    Returns (spec, weight_array, nanMask), spec and weight_array are in the
+    type of spec.  weight_array is one value per spectrum, unless weights
+    has more.  nanMask is None when spec has no NaN values.
+    Otherwise it is a sparse (nspec, nchan) matrix that is 1 where spec is
+    NaN, only the rows with NaN values are looked at to make it, and spec
+    is a copy with those values set to 0.  They get zero weight when
+    gridded (see channel_weights), per-channel weights are also a copy with
+    zero weight there.
+    """
+    if weights is None:
+        weight_array = np.ones(spec.shape[0], dtype=spec.dtype)
+    else:
+        weight_array = np.asarray(weights).astype(spec.dtype, copy=False)
+
+    if nanMask is not None:
+        nanMask = sparse.csr_matrix(nanMask)
+        (nanRows, nanChans) = nanMask.nonzero()
+    elif np.isnan(np.sum(spec)):
+        # Remove NaN and inf values from the data before gridding.
+        (nanRows, nanChans) = find_nans(spec)
+        nanMask = sparse.csr_matrix(
+            (np.ones(len(nanChans), dtype=np.int8), (nanRows, nanChans)),
+            shape=spec.shape,
+        )
+        spec = np.nan_to_num(spec)
+    if nanMask is not None and nanMask.nnz == 0:
+        nanMask = None
+    perChannel = weight_array.ndim == 2 and weight_array.shape[1] == spec.shape[1]
+    if nanMask is not None and perChannel:
+        weight_array = weight_array.copy()
+        weight_array[nanRows, nanChans] = 0
+
+    return (spec, weight_array, nanMask)
+
+
+def channel_weights(
+    weight_array, nanMask, rowStart, rowStop, chanStart, chanStop, nchan=None
+):
+    """The (nrows, nchan) weights of a block of rows and channels from the
+    row_weights results, with zero weight where the spectra were NaN.
+    nchan is the number of channels of the spectra, needed when there is
+    a weight for each of some ranges of channels.
+
+    cygrid needs a weight for every value it grids, this is built a block
+    of rows at a time so that the full weight array is never needed.
+    """
+    if weight_array.ndim == 1:
+        block = np.empty((rowStop - rowStart, chanStop - chanStart), weight_array.dtype)
+        block[...] = weight_array[rowStart:rowStop, None]
+    else:
+        if nchan is None:
+            nchan = weight_array.shape[1]
+        block = np.array(
+            weight_columns(weight_array[rowStart:rowStop], nchan, chanStart, chanStop)
+        )
+    if nanMask is not None:
+        block[nanMask[rowStart:rowStop, chanStart:chanStop].nonzero()] = 0
+    return block
+
+
+def grid_rows(mygridder, glon, glat, spec, weights, nanMask=None):
+    """Grid one block of spectra into an existing cygrid gridder.
+
+    cygrid accumulates, so this can be called repeatedly with successive
+    blocks of rows.
+
+    Inputs:
+       mygridder - the cygrid.WcsGrid to accumulate into
+       glon, glat - nspec length vectors of sky positions (deg)
+       spec - (nspec, nchan) array of spectra
+       weights - nspec length vector or (nspec, nchan) array of weights, or None
+                 for equal weights
+       nanMask - (optional) the nan_mask of spec, see row_weights
+    """
+    (spec, weight_array, nanMask) = row_weights(spec, weights, nanMask)
+    grid_block(mygridder, glon, glat, spec, weight_array, nanMask, 0, spec.shape[1])
+
+
+def grid_block(
+    mygridder,
+    glon,
+    glat,
+    spec,
+    weight_array,
+    nanMask,
+    chanStart,
+    chanStop,
+    ompThreads=None,
+):
+    """Grid channels chanStart to chanStop of spectra already passed
+    through row_weights.
+
+    mygridder is the gridder for just those channels.  cygrid needs
+    C-contiguous data and a weight for every value, so the rows are given
+    to it in blocks whose weights (from channel_weights) take at most
+    _WEIGHT_BLOCK_BYTES.  cygrid accumulates so this does not change the
+    result.  ompThreads, if given, sets the number of OpenMP threads cygrid
+    uses in the calling thread.
+    """
+    if ompThreads is not None:
+        mygridder.set_num_threads(ompThreads)
+    nrows = spec.shape[0]
+    rowBytes = spec.itemsize * max(chanStop - chanStart, 1)
+    rowsPerBlock = max(1, _WEIGHT_BLOCK_BYTES // rowBytes)
+    for r0 in range(0, nrows, rowsPerBlock):
+        r1 = min(r0 + rowsPerBlock, nrows)
+        mygridder.grid(
+            np.require(glon[r0:r1], np.float64, "C"),
+            np.require(glat[r0:r1], np.float64, "C"),
+            np.ascontiguousarray(spec[r0:r1, chanStart:chanStop]),
+            weights=channel_weights(
+                weight_array, nanMask, r0, r1, chanStart, chanStop, spec.shape[1]
+            ),
+        )
+
+
 def grid_otf(
     spec,
     nx,
@@ -59,6 +320,14 @@ def grid_otf(
     kernel_type,
     gauss_fwhm,
     verbose,
+    chunks=None,
+    dtype=np.float64,
+    backend="cygrid",
+    planDir=None,
+    plans=None,
+    threads=1,
+    normalize=True,
+    nanMask=None,
 ):
     """Grid individual spectra onto a specified regular grid using the package
     cygrid https://github.com/bwinkel/cygrid/tree/master/cygrid.
@@ -78,10 +347,41 @@ def grid_otf(
        centerYsky - reference for the Y center of the resultant image
        beam_fwhm - the fwhm in decimal degrees of the telescope beam.
        weights - (optional) an nspec length vector of weights for each spectra in data.
-                if not supplied, equal weights are assumed
+                if not supplied, equal weights are assumed.  An (nspec, m)
+                array gives a weight for each of m equal ranges of channels
+                (see sparse_grid.weight_columns), e.g. for each channel.
        gauss_fwhm - the fwhm in decimal degrees of the gaussian used in the
                     convolution kernel.  Used only when kern="gauss".
        kernel_type - specify the gridding kernel to use from "gaussbessel", "gauss", or "nearest".
+       chunks - (optional) an iterable of (rowStart, data) pairs used in place
+                of spec, which should then be None.  Each data block holds the
+                spectra for rows rowStart onward of glon, glat and weights.
+                The blocks are gridded as they are produced so the full
+                spectra array is never needed.
+       dtype - (optional) the type of the cygrid accumulators and so of the
+               returned cubes, np.float64 (default) or np.float32.
+       backend - (optional) "cygrid" (default) or "sparse".  The sparse backend
+                 builds the matrix of kernel weights between pixels and spectra
+                 once (see sparse_grid.py) and grids all channels with sparse
+                 matrix products.
+       planDir - (optional) directory where the sparse backend keeps its
+                 gridding plans (see sparse_grid.kernel_plan).
+       plans - (optional) a dictionary kept by the caller that holds the last
+               sparse gridding plan, so that repeated calls over the same
+               positions (e.g. channel slabs) build it once.
+       threads - (optional) split the channels into this many blocks and grid
+                 them concurrently, each block in its own thread with its own
+                 cygrid gridder (or its own channels of the sparse sums).  The
+                 channels are independent so the result is the same as with
+                 one thread (the default).
+       normalize - (optional) when False the unweighted data cube (the sum
+                   of the weighted spectra) is returned in place of the cube,
+                   so that more data can be added to it before it is divided
+                   by the weights with normalize_cube.
+       nanMask - (optional) a sparse (nspec, nchan) matrix that is 1 where spec
+                 was NaN, when those values have already been set to 0 (see
+                 zero_nans and nan_mask).  Without it spec is searched for
+                 NaN values and gridded from a copy with them set to 0.
 
     Returns: (cube, weight, final_fwhm) where cube is the cube array after gridding and
        weight is the related weight array and final_fwhm is effective fwhm of the beam
@@ -90,21 +390,26 @@ def grid_otf(
 
     result = (None, None, None)
 
-    # argument checking
-    if len(spec.shape) != 2 or len(glon.shape) != 1 or len(glat.shape) != 1:
-        if verbose > 1:
-            print("data, sky coordinates have unexpected shapes")
-            print("data : ", spec.shape)
-            print("gLongitude : ", glon.shape)
-            print("gLatitude : ", glat.shape)
-        return result
+    if chunks is None:
+        # argument checking
+        if len(spec.shape) != 2 or len(glon.shape) != 1 or len(glat.shape) != 1:
+            if verbose > 1:
+                print("data, sky coordinates have unexpected shapes")
+                print("data : ", spec.shape)
+                print("gLongitude : ", glon.shape)
+                print("gLatitude : ", glat.shape)
+            return result
 
-    nspec, nchan_data = spec.shape
+        nspec, nchan_data = spec.shape
 
-    if nspec == 0 or nchan_data == 0:
-        if verbose > 1:
-            print("no data given")
-        return result
+        if nspec == 0 or nchan_data == 0:
+            if verbose > 1:
+                print("no data given")
+            return result
+
+        chunks = [(0, spec)]
+    else:
+        nspec = len(glon)
 
     if nspec != len(glon) or nspec != len(glat):
         if verbose > 1:
@@ -113,86 +418,166 @@ def grid_otf(
             )
         return result
 
+    if backend not in ["cygrid", "sparse"]:
+        if verbose > 1:
+            print("backend must be one of cygrid or sparse")
+        return result
+
     if kernel_type not in ["gaussbessel", "gauss", "nearest"]:
         if verbose > 1:
             print("kern must be one of gaussbessel or gauss")
         return result
 
+    if threads < 1:
+        if verbose > 1:
+            print("threads must be >= 1")
+        return result
+
     # Handle the weights.
     if weights is None:
         print("Configuring equal weights, all = 1")
-        weights = np.ones(spec.shape[0])[..., None] + np.ones(nchan_data, dtype=np.float64)
     else:
         weights[weights == 0] += 1e-16
 
-    if weights.shape != spec.shape:
-        if weights.shape[0] == spec.shape[0]:
-            weight_array = weights[..., None] + np.zeros_like(spec) 
-    else:
-        weight_array = weights
-
-    # Remove NaN and inf values from the data before gridding.
-    if np.isnan(np.sum(spec)):
-        weight_array[np.isnan(spec)] = 0
-        spec = np.nan_to_num(spec)
-
     # Final spatial resolution.
     final_fwhm = np.sqrt(beam_fwhm ** 2.0 + gauss_fwhm ** 2.0)
 
-    header = prepare_header(wcsObj, nx, ny, nchan_data)
-
     # Set up kernel parameters.
-    gauss_sigma = gauss_fwhm / (2.0 * np.sqrt(2.0 * np.log(2.0)))
-    if kernel_type == "gauss":
-        kernel_type = "gauss1d"
-        kernel_params = gauss_sigma
-        # Resolution of the healpix lookup table.
-        # Value recommended by Winkel et al. (2016)
-        # for Gaussian beams.
-        hpx_maxres = gauss_sigma / 5.0
-        # Support distance for convolution,
-        # same as v0.5 of the `gbtgridder`.
-        support_distance = 3.0 * gauss_fwhm
-    elif kernel_type == "gaussbessel":
-        kernel_type = "gaussbessel"
-        # Convolution function width for a Gaussian tapered Bessel
-        # from Mangum, Emerson, Greisen (2007).
-        kernel_params = (beam_fwhm / 3.0, 2.52, 1.55)
-        hpx_maxres = pix_scale / 2.0 
-        # Support distance for convolution.
-        support_distance = 1.0 * beam_fwhm
-    elif kernel_type == "nearest":
-        # kernel_type = "gauss1d"
-        # kernel_params = (gauss_sigma)
-        # hpx_maxres = gauss_sigma / 5
-        kernel_type = "gaussbessel"
-        kernel_params = (beam_fwhm / 3.0, 2.52, 1.55)
-        hpx_maxres = beam_fwhm / 3.0 / 2.0
-        support_distance = 0.5 * pix_scale
-
-    kernel_support = support_distance
-
-    # Define a `cygrid.gridder` object and its kernel.
-    mygridder = cygrid.WcsGrid(header, dtype=np.float64)
-    mygridder.set_kernel(kernel_type, kernel_params, kernel_support, hpx_maxres)
+    (kernel_type, kernel_params, kernel_support, hpx_maxres) = kernel_setup(
+        kernel_type, beam_fwhm, gauss_fwhm, pix_scale
+    )
 
     # Do the gridding.
     if verbose > 1:
-        print("Running cygrid on the data")
-    mygridder.grid(glon, glat, spec, weights=weight_array)
+        print("Running %s on the data" % backend)
+    gridders = []
+    kernelMatrix = None
+    executor = None
+    ompThreads = None
+    nrows = 0
+    try:
+        for rowStart, data in chunks:
+            if nrows == 0:
+                nchan = data.shape[1]
+                chanBlocks = channel_slabs(nchan, -(-nchan // threads))
+                if len(chanBlocks) > 1:
+                    if verbose > 2:
+                        print(
+                            "Gridding %d channels in %d threads"
+                            % (nchan, len(chanBlocks))
+                        )
+                    executor = ThreadPoolExecutor(len(chanBlocks))
+                    # cygrid also uses OpenMP threads, share the cpus out
+                    ompThreads = max(1, (os.cpu_count() or 1) // len(chanBlocks))
+                if backend == "sparse":
+                    # the kernel weights are the same for all channels
+                    kernelMatrix = kernel_plan(
+                        prepare_header(wcsObj, nx, ny, nchan),
+                        np.asarray(glon, dtype=np.float64),
+                        np.asarray(glat, dtype=np.float64),
+                        kernel_type,
+                        kernel_params,
+                        kernel_support,
+                        dtype=dtype,
+                        planDir=planDir,
+                        verbose=verbose,
+                        plans=plans,
+                    )
+                    dataSum = np.zeros((nchan, ny * nx), dtype=dtype)
+                    weightSum = np.zeros((nchan, ny * nx), dtype=dtype)
+                else:
+                    # Define a `cygrid.gridder` object and its kernel for
+                    # each block of channels.
+                    for c0, c1 in chanBlocks:
+                        mygridder = cygrid.WcsGrid(
+                            prepare_header(wcsObj, nx, ny, c1 - c0), dtype=dtype
+                        )
+                        mygridder.set_kernel(
+                            kernel_type, kernel_params, kernel_support, hpx_maxres
+                        )
+                        gridders.append(mygridder)
+            rowStop = rowStart + data.shape[0]
+            rowWeights = None
+            if weights is not None:
+                rowWeights = weights[rowStart:rowStop]
+            rowMask = None
+            if nanMask is not None:
+                rowMask = nanMask[rowStart:rowStop]
+            if backend == "sparse":
+                data = data.astype(dtype, copy=False)
+                (data, weight_array, blockMask) = row_weights(
+                    data, rowWeights, rowMask
+                )
+                grid_rows_sparse(
+                    kernelMatrix,
+                    rowStart,
+                    data,
+                    weight_array,
+                    dataSum,
+                    weightSum,
+                    nanMask=blockMask,
+                    chanBlocks=chanBlocks,
+                    executor=executor,
+                )
+            elif executor is None:
+                grid_rows(
+                    gridders[0],
+                    glon[rowStart:rowStop],
+                    glat[rowStart:rowStop],
+                    data,
+                    rowWeights,
+                    rowMask,
+                )
+            else:
+                (data, weight_array, blockMask) = row_weights(
+                    data, rowWeights, rowMask
+                )
+                blockLon = np.require(glon[rowStart:rowStop], np.float64, "C")
+                blockLat = np.require(glat[rowStart:rowStop], np.float64, "C")
+                futures = [
+                    executor.submit(
+                        grid_block,
+                        mygridder,
+                        blockLon,
+                        blockLat,
+                        data,
+                        weight_array,
+                        blockMask,
+                        c0,
+                        c1,
+                        ompThreads,
+                    )
+                    for mygridder, (c0, c1) in zip(gridders, chanBlocks)
+                ]
+                for future in futures:
+                    future.result()
+            nrows += data.shape[0]
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if nrows != nspec or (not gridders and kernelMatrix is None):
+        if verbose > 1:
+            print("Number of spectra gridded does not match number of sky positions")
+        return result
 
     # Query results.
-    #data_cube = mygridder.get_datacube()
-    data_cube = mygridder.get_unweighted_datacube()
-    weights_cube = mygridder.get_weights()
-
-    # Avoid division by invalid values.
-    data_cube = np.ma.masked_invalid(data_cube)
-    weights_cube = np.ma.masked_invalid(weights_cube)
-    data_cube /= weights_cube
-
-    data_cube = data_cube.filled(np.nan)
-    weights_cube = weights_cube.filled(np.nan)
+    if backend == "sparse":
+        data_cube = dataSum.reshape(nchan, ny, nx)
+        weights_cube = weightSum.reshape(nchan, ny, nx)
+    elif len(gridders) == 1:
+        #data_cube = mygridder.get_datacube()
+        data_cube = gridders[0].get_unweighted_datacube()
+        weights_cube = gridders[0].get_weights()
+    else:
+        data_cube = np.empty((nchan, ny, nx), dtype=dtype)
+        weights_cube = np.empty((nchan, ny, nx), dtype=dtype)
+        for mygridder, (c0, c1) in zip(gridders, chanBlocks):
+            data_cube[c0:c1] = mygridder.get_unweighted_datacube()
+            weights_cube[c0:c1] = mygridder.get_weights()
+
+    if normalize:
+        (data_cube, weights_cube) = normalize_cube(data_cube, weights_cube)
 
     # Remove pixels whose weight is too small,
     # as these have a much larger scale.
@@ -0,0 +1,213 @@
+# Copyright (C) 2015 Associated Universities, Inc. Washington DC, USA.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+# Correspondence concerning GBT software should be addressed as follows:
+#       GBT Operations
+#       National Radio Astronomy Observatory
+#       P. O. Box 2
+#       Green Bank, WV 24944-0002 USA
+
+
+import re
+
+from .boxcar import boxcar_freq, smooth
+from .grid_otf import zero_nans
+from .load_data import iter_spectra
+
+# line names become part of the output file names
+_NAME_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.+-]*$")
+
+
+def parse_line(lineString):
+    """Turn a --line value, NAME:START:END[:RESTFREQ[:AVERAGE]], into a
+    dictionary with these fields:
+       name: the line name, used in the output file names
+       chanStart, chanStop: the channel range, counted as for --channels
+          and converted to python channels, chanStop is inclusive
+       restfreq: the rest frequency in Hz, or None
+       average: the number of channels to average, or None
+
+    Returns None if lineString does not parse.
+    """
+    items = lineString.split(":")
+    if len(items) < 3 or len(items) > 5 or not _NAME_PATTERN.match(items[0]):
+        return None
+    try:
+        result = {
+            "name": items[0],
+            # subtract 1 to go from FITS to python convention
+            "chanStart": int(items[1]) - 1,
+            "chanStop": int(items[2]) - 1,
+            "restfreq": None,
+            "average": None,
+        }
+        if len(items) > 3 and len(items[3]) > 0:
+            # given in MHz, as --restfreq
+            result["restfreq"] = float(items[3]) * 1.0e6
+        if len(items) > 4 and len(items[4]) > 0:
+            result["average"] = int(items[4])
+    except ValueError:
+        return None
+    if (
+        result["chanStart"] < 0
+        or result["chanStop"] < result["chanStart"]
+        or (result["restfreq"] is not None and result["restfreq"] <= 0)
+        or (result["average"] is not None and result["average"] < 1)
+    ):
+        return None
+    return result
+
+
+def line_layout(lines, freq, chanStart):
+    """Place the output channels of each line side by side.
+
+    freq is the frequency axis of the channels from chanStart on, which
+    must cover all of the lines.  Each line dictionary from parse_line is
+    given these fields:
+       faxis: the frequency axis of the line after any averaging
+       specStart, specStop: where its channels are in the combined
+          spectra filled in by fan_out, specStop is exclusive
+
+    Returns the total number of channels.
+    """
+    specStart = 0
+    for line in lines:
+        lineFreq = freq[
+            line["chanStart"] - chanStart : line["chanStop"] - chanStart + 1
+        ]
+        if line["average"] is not None:
+            lineFreq = boxcar_freq(lineFreq, line["average"])
+        line["faxis"] = lineFreq
+        line["specStart"] = specStart
+        line["specStop"] = specStart + len(lineFreq)
+        specStart = line["specStop"]
+    return specStart
+
+
+def fan_out(data, freq, lines, chanStart, out, smoothing="boxcar"):
+    """Copy the channels of each line from a block of spectra into out.
+
+    data holds the channels from chanStart on, freq is their frequency
+    axis.  Each line is averaged as a spectrum of just its own channels
+    would be, and written to its specStart:specStop columns of out (see
+    line_layout).
+    """
+    for line in lines:
+        c0 = line["chanStart"] - chanStart
+        c1 = line["chanStop"] - chanStart + 1
+        lineOut = out[:, line["specStart"] : line["specStop"]]
+        if line["average"] is None:
+            lineOut[...] = data[:, c0:c1]
+        else:
+            smooth(
+                data[:, c0:c1],
+                freq[c0:c1],
+                line["average"],
+                kernel=smoothing,
+                out=lineOut,
+            )
+
+
+def load_lines(
+    files,
+    spec,
+    lines,
+    freq,
+    chanStart,
+    chanStop,
+    scanlist,
+    minTsys,
+    maxTsys,
+    smoothing="boxcar",
+    cacheDir=None,
+    rowsPerChunk=None,
+    verbose=4,
+    nans=None,
+):
+    """The data pass for --line.
+
+    Each chunk of rows of the files found by scan_sdfits is read once, for
+    the channels chanStart through chanStop that hold all of the lines,
+    and the lines are copied out of it into spec by fan_out.  Only one
+    chunk of the full channel range is in memory at a time.  nans is as
+    for load_data.load_spectra, the NaN values of the lines of each chunk
+    are set to 0 as they are copied out.
+
+    Returns True on success, False otherwise.
+    """
+    try:
+        for specOffset, data in iter_spectra(
+            files,
+            chanStart,
+            chanStop,
+            None,
+            scanlist,
+            minTsys,
+            maxTsys,
+            cacheDir=cacheDir,
+            rowsPerChunk=rowsPerChunk,
+            verbose=verbose,
+        ):
+            fan_out(
+                data,
+                freq,
+                lines,
+                chanStart,
+                spec[specOffset : specOffset + data.shape[0]],
+                smoothing=smoothing,
+            )
+            if nans is not None:
+                nans.append(
+                    (specOffset,)
+                    + zero_nans(spec[specOffset : specOffset + data.shape[0]])
+                )
+    except ValueError as e:
+        if verbose > 1:
+            print(e)
+        print("There was an error getting data from the SDFits file")
+        return False
+
+    return True
+
+
+def line_header(hdr, line, restfreq, beamFwhm, finalFwhm):
+    """A copy of the cube header for the output of one line.
+
+    The spectral axis, the rest frequency and the beam are those of the
+    line.
+    """
+    lineHdr = hdr.copy()
+    faxis = line["faxis"]
+    lineHdr["CRVAL3"] = faxis[0]
+    lineHdr["CDELT3"] = faxis[1] - faxis[0] if len(faxis) > 1 else hdr["CDELT3"]
+    if lineHdr["CDELT3"] != 0.0 and restfreq > 0.0:
+        lineHdr["ALTRVAL"] = 0.0
+        lineHdr["ALTRPIX"] = (
+            lineHdr["CRPIX3"] + (restfreq - lineHdr["CRVAL3"]) / lineHdr["CDELT3"]
+        )
+    lineHdr["RESTFRQ"] = restfreq
+    lineHdr["beamFWHM"] = beamFwhm
+    lineHdr["BMAJ"] = finalFwhm
+    lineHdr["BMIN"] = finalFwhm
+    history = "gbtgridder line: %s channels %d:%d" % (
+        line["name"],
+        line["chanStart"] + 1,
+        line["chanStop"] + 1,
+    )
+    if line["average"] is not None and line["average"] > 1:
+        history += " average %d" % line["average"]
+    lineHdr.add_history(history)
+    return lineHdr
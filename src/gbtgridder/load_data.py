@@ -0,0 +1,511 @@
+# Copyright (C) 2015 Associated Universities, Inc. Washington DC, USA.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+# Correspondence concerning GBT software should be addressed as follows:
+#       GBT Operations
+#       National Radio Astronomy Observatory
+#       P. O. Box 2
+#       Green Bank, WV 24944-0002 USA
+
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .boxcar import smooth_kernel
+from .get_data import get_data
+from .grid_otf import zero_nans
+
+
+def scan_sdfits(
+    sdfitsFiles,
+    chanStart,
+    chanStop,
+    average,
+    scanlist,
+    minTsys,
+    maxTsys,
+    smoothing="boxcar",
+    cacheDir=None,
+    verbose=4,
+    fileScanlists=None,
+):
+    """The metadata pass over all of the SDFITS files.
+
+    Each file is opened once with get_data(getdata=False) so only the row
+    selection and the small per-row columns are read.  The DATA column is
+    not touched.
+
+    Returns a dictionary with these fields:
+       files: list of (sdfitsFile, rows) for each file with selected rows,
+          rows are the indices of the selected rows in that file's table
+       first: the get_data result (without data) for the first such file
+       num_positions: total number of selected rows
+       xsky, ysky, tsys, texp, wt: per-row values concatenated over files
+       stokes, feeds: the polarization (CRVAL4) and feed of each row
+       scans: the unique scan numbers
+       filescans: the unique scan numbers of each file in files
+       ntsysflag: the number of rows flagged by the tsys limits
+
+    smoothing and cacheDir are passed on to get_data.  fileScanlists maps
+    some of the files to the scans selected from them instead of scanlist.
+    The data passes only use the rows found here.
+
+    Returns None if get_data found a problem that should not be recovered
+    from.  That has already been reported by get_data.
+    """
+    files = []
+    first = None
+    xsky = []
+    ysky = []
+    tsys = []
+    texp = []
+    wt = []
+    stokes = []
+    feeds = []
+    scans = []
+    ntsysFlagCount = 0
+
+    for thisFile in sdfitsFiles:
+        thisScanlist = scanlist
+        if fileScanlists is not None and thisFile in fileScanlists:
+            thisScanlist = fileScanlists[thisFile]
+        try:
+            if verbose > 3:
+                print("   ", thisFile)
+                sys.stdout.flush()
+            dataRecord = get_data(
+                thisFile,
+                chanStart,
+                chanStop,
+                average,
+                thisScanlist,
+                minTsys,
+                maxTsys,
+                getdata=False,
+                verbose=verbose,
+                smoothing=smoothing,
+                cacheDir=cacheDir,
+            )
+
+            if dataRecord is None:
+                return None
+
+            if len(dataRecord) == 0:
+                # empty file, skipping
+                continue
+
+            if first is None:
+                first = dataRecord
+            elif dataRecord["spec_size"] != first["spec_size"]:
+                raise ValueError("Spec axis mismatch in %s" % thisFile)
+
+            files.append((thisFile, dataRecord["rows"]))
+            xsky.append(dataRecord["xsky"])
+            ysky.append(dataRecord["ysky"])
+            tsys.append(dataRecord["tsys"])
+            texp.append(dataRecord["texp"])
+            wt.append(dataRecord["wt"])
+            stokes.append(dataRecord["stokes"])
+            feeds.append(dataRecord["feeds"])
+            scans.append(np.unique(dataRecord["scans"]))
+            ntsysFlagCount += dataRecord["ntsysflag"]
+
+        except AssertionError:
+            if verbose > 1:
+                print("There was an unexpected problem processing %s" % thisFile)
+            raise
+
+    result = {}
+    result["files"] = files
+    result["first"] = first
+    result["num_positions"] = sum([len(rows) for (_, rows) in files])
+    result["ntsysflag"] = ntsysFlagCount
+    if first is None:
+        return result
+
+    # positions and weights are kept as float32, as they always have been
+    result["xsky"] = np.concatenate(xsky).astype(np.float32)
+    result["ysky"] = np.concatenate(ysky).astype(np.float32)
+    result["tsys"] = np.concatenate(tsys).astype(np.float32)
+    result["texp"] = np.concatenate(texp).astype(np.float32)
+    result["wt"] = np.concatenate(wt)
+    result["stokes"] = np.concatenate(stokes).astype(int)
+    result["feeds"] = np.concatenate(feeds).astype(int)
+    result["scans"] = np.unique(np.concatenate(scans))
+    result["filescans"] = scans
+    return result
+
+
+def load_spectra(
+    files,
+    spec,
+    chanStart,
+    chanStop,
+    average,
+    scanlist,
+    minTsys,
+    maxTsys,
+    smoothing="boxcar",
+    cacheDir=None,
+    verbose=4,
+    nans=None,
+):
+    """The data pass over the files found by scan_sdfits.
+
+    The selected and averaged spectra from each file are written straight
+    into the preallocated spec array, in the same row order used by
+    scan_sdfits.
+
+    If nans is given (a list), the NaN values of each file's spectra are
+    set to 0 in spec as they are read and (specOffset, rows, chans) from
+    grid_otf.zero_nans is appended to nans for them, see grid_otf.nan_mask.
+
+    Returns True on success, False otherwise.
+    """
+    idx = 0
+    for thisFile, rows in files:
+        nrows = len(rows)
+        try:
+            dataRecord = get_data(
+                thisFile,
+                chanStart,
+                chanStop,
+                average,
+                scanlist,
+                minTsys,
+                maxTsys,
+                smoothing=smoothing,
+                cacheDir=cacheDir,
+                verbose=verbose,
+                out=spec[idx : idx + nrows],
+                rows=rows,
+            )
+
+            if dataRecord is None or len(dataRecord) == 0:
+                # this should be covered by scan_sdfits
+                if verbose > 1:
+                    print("%s changed since it was first read" % thisFile)
+                return False
+
+            if nans is not None:
+                nans.append((idx,) + zero_nans(spec[idx : idx + nrows]))
+            idx += nrows
+
+        except ValueError:
+            print("There was an error getting data from the SDFits file")
+            return False
+
+    return True
+
+
+def slab_channel_range(
+    chanStart, slabStart, slabStop, average, smoothing="boxcar", chanStop=None
+):
+    """The input channel range to read to get output channels slabStart
+    through slabStop-1.
+
+    Output channel k is the average of input channels chanStart + k*average
+    through chanStart + (k+1)*average - 1.  One extra input channel is
+    included when averaging because boxcar always drops the last partial
+    box.
+
+    The hanning and gaussian smoothing kernels reach into the neighboring
+    boxes, so for those whole boxes are added on each side, no further than
+    chanStart and chanStop (the last channel of the full range).  The first
+    skip output channels of the smoothed range then belong to the previous
+    slab.
+
+    Returns (slabChanStart, slabChanStop, skip), the channel range is
+    inclusive, for use as the get_data channel range.
+    """
+    if average is None:
+        return (chanStart + slabStart, chanStart + slabStop - 1, 0)
+
+    # extra boxes needed on each side for the kernel to be complete
+    ntaps = len(smooth_kernel(smoothing, average))
+    margin = int(np.ceil(max(0, ntaps - average) / (2.0 * average)))
+    skip = min(margin, slabStart)
+    slabChanStart = chanStart + (slabStart - skip) * average
+    slabChanStop = chanStart + (slabStop + margin) * average
+    if chanStop is not None:
+        slabChanStop = min(slabChanStop, chanStop)
+    return (slabChanStart, slabChanStop, skip)
+
+
+def create_shared_spectra(shape, dtype=np.float64):
+    """Allocate a NaN-filled array in shared memory.
+
+    Worker processes started by load_spectra_parallel attach to it by name
+    and write their rows directly into it.
+
+    Returns (shm, spec).  The caller must call release_shared_spectra once
+    the workers are done and close_shared_spectra once spec is no longer
+    used.
+    """
+    dtype = np.dtype(dtype)
+    nbytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+    shm = shared_memory.SharedMemory(create=True, size=nbytes)
+    spec = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    spec.fill(np.nan)
+    return (shm, spec)
+
+
+def release_shared_spectra(shm):
+    """Remove the name of the shared memory allocated by create_shared_spectra.
+
+    No other process can attach to it after this, so this should be called
+    as soon as the data pass is done.  The memory stays mapped by shm, so
+    spec can still be used, until close_shared_spectra.
+    """
+    shm.unlink()
+
+
+def close_shared_spectra(shm):
+    """Unmap the shared memory allocated by create_shared_spectra.
+
+    spec and any views of it must have been deleted first.  If they are
+    still held, e.g. by the traceback of an error, the memory is left
+    mapped until the process exits.
+    """
+    try:
+        shm.close()
+    except BufferError:
+        pass
+
+
+def split_load_tasks(files, jobs, rowsPerTask=None):
+    """Break the data pass into tasks of roughly equal size.
+
+    Large files are split into several row ranges so that a few big files
+    do not hold up the finish.  The default task size gives about 4 tasks
+    per job.
+
+    Returns a list of (sdfitsFile, rowRange, specOffset, nrows) with the
+    largest tasks first, where rowRange is the (rowStart, rowStop) table
+    row range and specOffset is where the nrows selected rows from that
+    range start in the spectra array.
+    """
+    num_positions = sum([len(rows) for (_, rows) in files])
+    if rowsPerTask is None:
+        rowsPerTask = int(np.ceil(num_positions / (4.0 * jobs)))
+
+    tasks = split_rows(files, rowsPerTask)
+    tasks.sort(key=lambda task: task[3], reverse=True)
+    return tasks
+
+
+def split_rows(files, rowsPerTask=None):
+    """Break the selected rows of each file into pieces of at most
+    rowsPerTask rows, in file and row order.
+
+    If rowsPerTask is None each file is a single piece.
+
+    Returns a list of (sdfitsFile, rowRange, specOffset, nrows) as
+    described in split_load_tasks.
+    """
+    tasks = []
+    offset = 0
+    for thisFile, rows in files:
+        fileRows = rowsPerTask
+        if fileRows is None:
+            fileRows = len(rows)
+        fileRows = max(fileRows, 1)
+        for i0 in range(0, len(rows), fileRows):
+            i1 = min(i0 + fileRows, len(rows))
+            rowRange = (int(rows[i0]), int(rows[i1 - 1]) + 1)
+            tasks.append((thisFile, rowRange, offset + i0, i1 - i0))
+        offset += len(rows)
+
+    return tasks
+
+
+def iter_spectra(
+    files,
+    chanStart,
+    chanStop,
+    average,
+    scanlist,
+    minTsys,
+    maxTsys,
+    smoothing="boxcar",
+    cacheDir=None,
+    rowsPerChunk=None,
+    chanSlice=None,
+    verbose=4,
+):
+    """Read the files found by scan_sdfits one chunk at a time.
+
+    This yields (specOffset, data) where data holds the selected, averaged
+    spectra for rows specOffset onward of the scan_sdfits row order.  Each
+    chunk is at most rowsPerChunk rows (one chunk per file if None), so
+    only one chunk is in memory at a time.  This is the form expected by
+    the chunks argument of grid_otf.  If chanSlice is given only those
+    channels of each chunk are yielded (see slab_channel_range).
+
+    Raises ValueError if a file no longer matches the metadata pass.
+    """
+    fileRows = dict(files)
+    for thisFile, rowRange, specOffset, nrows in split_rows(files, rowsPerChunk):
+        if verbose > 4:
+            print("   ", thisFile, "rows %d:%d" % rowRange)
+            sys.stdout.flush()
+        dataRecord = get_data(
+            thisFile,
+            chanStart,
+            chanStop,
+            average,
+            scanlist,
+            minTsys,
+            maxTsys,
+            smoothing=smoothing,
+            cacheDir=cacheDir,
+            verbose=verbose,
+            rowRange=rowRange,
+            rows=fileRows[thisFile],
+        )
+
+        if (
+            dataRecord is None
+            or len(dataRecord) == 0
+            or len(dataRecord["rows"]) != nrows
+        ):
+            raise ValueError("%s changed since it was first read" % thisFile)
+
+        data = dataRecord["data"]
+        if chanSlice is not None:
+            data = data[:, chanSlice]
+        yield (specOffset, data)
+
+
+def _load_task(
+    shmName,
+    shape,
+    dtype,
+    task,
+    rows,
+    selection,
+    smoothing,
+    cacheDir,
+    verbose,
+    zeroNans,
+):
+    """Run one data pass task in a worker process.
+
+    rows are the selected table rows of the task's row range.
+
+    Returns (nrows, nans) where nrows is the number of rows written, or -1
+    if get_data found a problem.  nans is the zero_nans result for those
+    rows if zeroNans, otherwise None.
+    """
+    thisFile, rowRange, specOffset, nrows = task
+    shm = shared_memory.SharedMemory(name=shmName)
+    try:
+        spec = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        dataRecord = get_data(
+            thisFile,
+            *selection,
+            smoothing=smoothing,
+            cacheDir=cacheDir,
+            verbose=verbose,
+            out=spec[specOffset : specOffset + nrows],
+            rowRange=rowRange,
+            rows=rows,
+        )
+        nans = None
+        if zeroNans and dataRecord is not None and len(dataRecord) > 0:
+            nans = zero_nans(spec[specOffset : specOffset + nrows])
+        del spec
+    finally:
+        shm.close()
+
+    if dataRecord is None or len(dataRecord) == 0:
+        return (-1, None)
+    return (len(dataRecord["rows"]), nans)
+
+
+def task_rows(rows, rowRange):
+    """The rows within rowRange, (rowStart, rowStop)."""
+    return rows[(rows >= rowRange[0]) & (rows < rowRange[1])]
+
+
+def load_spectra_parallel(
+    files,
+    shm,
+    spec,
+    chanStart,
+    chanStop,
+    average,
+    scanlist,
+    minTsys,
+    maxTsys,
+    jobs,
+    smoothing="boxcar",
+    cacheDir=None,
+    rowsPerTask=None,
+    verbose=4,
+    nans=None,
+):
+    """The data pass over the files found by scan_sdfits using a pool of
+    jobs worker processes.
+
+    spec must have been allocated by create_shared_spectra, shm is the
+    shared memory returned with it.  Each worker opens its file, applies
+    the same selection and averaging as load_spectra to its row range and
+    writes those spectra directly into spec.  With nans, as for
+    load_spectra, each worker also sets the NaN values of its rows to 0.
+
+    Returns True on success, False otherwise.
+    """
+    tasks = split_load_tasks(files, jobs, rowsPerTask=rowsPerTask)
+    if verbose > 4:
+        print("   %d load tasks using %d processes" % (len(tasks), jobs))
+
+    # get_data arguments after the file name
+    selection = (chanStart, chanStop, average, scanlist, minTsys, maxTsys)
+    fileRows = dict(files)
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [
+            pool.submit(
+                _load_task,
+                shm.name,
+                spec.shape,
+                spec.dtype,
+                task,
+                task_rows(fileRows[task[0]], task[1]),
+                selection,
+                smoothing,
+                cacheDir,
+                verbose,
+                nans is not None,
+            )
+            for task in tasks
+        ]
+        for task, future in zip(tasks, futures):
+            try:
+                nrows, taskNans = future.result()
+            except ValueError:
+                print("There was an error getting data from the SDFits file")
+                return False
+            if nrows != task[3]:
+                if verbose > 1:
+                    print("%s changed since it was first read" % task[0])
+                return False
+            if nans is not None:
+                nans.append((task[2],) + taskNans)
+
+    return True
@@ -0,0 +1,254 @@
+# Copyright (C) 2015 Associated Universities, Inc. Washington DC, USA.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+# Correspondence concerning GBT software should be addressed as follows:
+#       GBT Operations
+#       National Radio Astronomy Observatory
+#       P. O. Box 2
+#       Green Bank, WV 24944-0002 USA
+
+
+import numpy as np
+from astropy.io import fits as pyfits
+
+# speed of light (km/s)
+_C_KMS = 299792.458
+
+# the maps made from the --signal window and from the --line-free windows
+SIGNAL_PRODUCTS = ["mom0", "mom1", "mom2", "peak"]
+NOISE_PRODUCTS = ["noise"]
+
+
+def parse_window(windowString):
+    """Turn a --signal or --line-free value into a dictionary.
+
+    START:END is a channel range of the output cube, counted as for
+    --channels, and START:ENDkm/s is a velocity range.  The result has
+    these fields:
+       text: windowString, for the HISTORY of the maps
+       chanStart, chanStop: the channel range in python channels,
+          chanStop is inclusive, or None for a velocity range
+       vmin, vmax: the velocity range (km/s), or None for channels
+
+    Returns None if windowString does not parse.
+    """
+    result = {
+        "text": windowString,
+        "chanStart": None,
+        "chanStop": None,
+        "vmin": None,
+        "vmax": None,
+    }
+    isVelocity = windowString.endswith("km/s")
+    items = windowString[: -len("km/s")] if isVelocity else windowString
+    items = items.split(":")
+    if len(items) != 2:
+        return None
+    try:
+        if isVelocity:
+            v0, v1 = (float(items[0]), float(items[1]))
+            result["vmin"] = min(v0, v1)
+            result["vmax"] = max(v0, v1)
+        else:
+            # subtract 1 to go from FITS to python convention
+            result["chanStart"] = int(items[0]) - 1
+            result["chanStop"] = int(items[1]) - 1
+    except ValueError:
+        return None
+    if not isVelocity and (
+        result["chanStart"] < 0 or result["chanStop"] < result["chanStart"]
+    ):
+        return None
+    return result
+
+
+def channel_frequencies(hdr, nchan):
+    """The frequency (Hz) of each channel of a cube with header hdr."""
+    return hdr["CRVAL3"] + (np.arange(nchan) + 1.0 - hdr["CRPIX3"]) * hdr["CDELT3"]
+
+
+def channel_velocities(hdr, nchan, veldef):
+    """The velocity (km/s) of each channel of a cube with header hdr.
+
+    veldef is the velocity definition of the data, RADI, OPTI or RELA,
+    relative to the RESTFRQ of hdr.  Returns None if there is no rest
+    frequency.
+    """
+    restfreq = hdr.get("RESTFRQ", 0.0)
+    if restfreq <= 0.0:
+        return None
+    ratio = channel_frequencies(hdr, nchan) / restfreq
+    if veldef == "OPTI":
+        return _C_KMS * (1.0 / ratio - 1.0)
+    if veldef == "RELA":
+        return _C_KMS * (1.0 - ratio**2) / (1.0 + ratio**2)
+    return _C_KMS * (1.0 - ratio)
+
+
+def window_channels(windows, nchan, velocity):
+    """The nchan length mask of the channels in any of windows.
+
+    velocity is the channel_velocities of the cube, it is only needed for
+    velocity windows.  Returns None if there are velocity windows and no
+    velocities.
+    """
+    mask = np.zeros(nchan, dtype=bool)
+    for window in windows:
+        if window["vmin"] is None:
+            mask[window["chanStart"] : window["chanStop"] + 1] = True
+        elif velocity is None:
+            return None
+        else:
+            mask |= (velocity >= window["vmin"]) & (velocity <= window["vmax"])
+    return mask
+
+
+def new_moments(ny, nx, velocity, signal, lineFree):
+    """The accumulators of the maps of one (nchan, ny, nx) cube.
+
+    signal and lineFree are nchan length channel masks from
+    window_channels, either can be None for no such maps.  The velocities
+    are needed for the moment maps, each channel counts for its width in
+    velocity.
+    """
+    moments = {"signal": signal, "lineFree": lineFree}
+    if signal is not None:
+        moments["velocity"] = velocity
+        moments["dv"] = np.abs(np.gradient(velocity)) if len(velocity) > 1 else None
+        for key in ["s0", "s1", "s2", "nsig"]:
+            moments[key] = np.zeros((ny, nx))
+        moments["peak"] = np.full((ny, nx), np.nan)
+    if lineFree is not None:
+        moments["sumsq"] = np.zeros((ny, nx))
+        moments["nfree"] = np.zeros((ny, nx))
+    return moments
+
+
+def add_moment_block(moments, chanStart, x0, y0, block):
+    """Add a (nchan, ny, nx) block of the cube, for the channels from
+    chanStart and the pixels from x0, y0, to the new_moments accumulators.
+
+    Only the planes in the windows are looked at, one at a time.  Blanked
+    (NaN) values are left out.
+    """
+    signal = moments["signal"]
+    lineFree = moments["lineFree"]
+    region = (slice(y0, y0 + block.shape[1]), slice(x0, x0 + block.shape[2]))
+    for chan, plane in enumerate(block, start=chanStart):
+        inSignal = signal is not None and signal[chan]
+        inLineFree = lineFree is not None and lineFree[chan]
+        if not (inSignal or inLineFree):
+            continue
+        good = ~np.isnan(plane)
+        values = np.where(good, plane, 0.0)
+        if inSignal:
+            # the integral over velocity of the values, of the values times
+            # the velocity and of the values times the velocity squared
+            area = values
+            if moments["dv"] is not None:
+                area = values * moments["dv"][chan]
+            velocity = moments["velocity"][chan]
+            moments["s0"][region] += area
+            moments["s1"][region] += area * velocity
+            moments["s2"][region] += area * velocity**2
+            moments["nsig"][region] += good
+            moments["peak"][region] = np.fmax(moments["peak"][region], plane)
+        if inLineFree:
+            moments["sumsq"][region] += values * values
+            moments["nfree"][region] += good
+
+
+def moment_maps(moments):
+    """The finished maps from the add_moment_block accumulators.
+
+    Returns a dictionary of 2-D maps, mom0 (the integrated intensity),
+    mom1 (the intensity weighted velocity), mom2 (the intensity weighted
+    velocity dispersion) and peak for the signal window, and noise (the
+    rms of the line-free channels).  Pixels with no valid channels are
+    NaN, as are mom1 and mom2 where mom0 is not positive.
+    """
+    maps = {}
+    if moments["signal"] is not None:
+        empty = moments["nsig"] == 0
+        s0 = moments["s0"]
+        positive = s0 > 0.0
+        mom1 = np.full(s0.shape, np.nan)
+        mom2 = np.full(s0.shape, np.nan)
+        mom1[positive] = moments["s1"][positive] / s0[positive]
+        mom2[positive] = np.sqrt(
+            np.maximum(
+                moments["s2"][positive] / s0[positive] - mom1[positive] ** 2, 0.0
+            )
+        )
+        maps["mom0"] = np.where(empty, np.nan, s0)
+        maps["mom1"] = mom1
+        maps["mom2"] = mom2
+        maps["peak"] = moments["peak"]
+    if moments["lineFree"] is not None:
+        noise = np.full(moments["sumsq"].shape, np.nan)
+        good = moments["nfree"] > 0
+        noise[good] = np.sqrt(moments["sumsq"][good] / moments["nfree"][good])
+        maps["noise"] = noise
+    return maps
+
+
+def map_header(hdr, product, chanMask, windows):
+    """The header of one of the moment_maps of a cube with header hdr.
+
+    The spectral axis is one channel covering the channels of chanMask,
+    the windows the map was made from.  BUNIT is set for the product.
+    """
+    mapHdr = hdr.copy()
+    for key in ["DATAMAX", "DATAMIN", "CASAMBM"]:
+        if key in mapHdr:
+            del mapHdr[key]
+    unit = hdr.get("BUNIT", "K")
+    units = {
+        "mom0": unit + " km/s",
+        "mom1": "km/s",
+        "mom2": "km/s",
+        "peak": unit,
+        "noise": unit,
+    }
+    mapHdr["BUNIT"] = units[product]
+    freq = channel_frequencies(hdr, len(chanMask))[chanMask]
+    if len(freq) > 0:
+        mapHdr["CRVAL3"] = 0.5 * (freq.min() + freq.max())
+        mapHdr["CDELT3"] = hdr["CDELT3"] * np.count_nonzero(chanMask)
+        mapHdr["CRPIX3"] = 1.0
+        if "ALTRPIX" in mapHdr and mapHdr["CDELT3"] != 0.0 and hdr["RESTFRQ"] > 0.0:
+            mapHdr["ALTRPIX"] = (
+                mapHdr["CRPIX3"]
+                + (hdr["RESTFRQ"] - mapHdr["CRVAL3"]) / mapHdr["CDELT3"]
+            )
+    mapHdr.add_history(
+        "gbtgridder %s from %s"
+        % (product, ", ".join([window["text"] for window in windows]))
+    )
+    return mapHdr
+
+
+def write_map(mapFile, hdr, image, dtype=np.float64):
+    """Write a 2-D map as a (1, 1, ny, nx) FITS image with header hdr from
+    map_header, setting DATAMAX and DATAMIN."""
+    image = np.asarray(image, dtype=dtype)
+    mapHdr = hdr.copy()
+    if np.any(np.isfinite(image)):
+        mapHdr["DATAMAX"] = float(np.nanmax(image))
+        mapHdr["DATAMIN"] = float(np.nanmin(image))
+    pyfits.PrimaryHDU(image[None, None, ...], header=mapHdr).writeto(
+        mapFile, overwrite=True
+    )
@@ -0,0 +1,239 @@
+# Copyright (C) 2015 Associated Universities, Inc. Washington DC, USA.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+# Correspondence concerning GBT software should be addressed as follows:
+#       GBT Operations
+#       National Radio Astronomy Observatory
+#       P. O. Box 2
+#       Green Bank, WV 24944-0002 USA
+
+
+import json
+import os
+import shutil
+import zlib
+
+import numpy as np
+from astropy.io import fits as pyfits
+
+# the astropy compression types used by --compress
+_COMPRESSION_TYPES = {"gzip": "GZIP_2", "rice": "RICE_1"}
+
+# the chunk file names and the metadata follow version 2 of the Zarr
+# storage specification, so zarr and xarray can open the store directly
+_ZARR_FORMAT = 2
+
+
+def compressed_name(cubeFile):
+    """The name of the tile-compressed copy of cubeFile, as from fpack."""
+    return cubeFile + ".fz"
+
+
+def store_name(cubeFile):
+    """The name of the chunked directory store copy of cubeFile."""
+    return os.path.splitext(cubeFile)[0] + ".zarr"
+
+
+def output_copies(cubeFile, compress, chunked):
+    """The names of the copies of cubeFile asked for by --compress and
+    --chunked."""
+    copies = []
+    if compress is not None:
+        copies.append(compressed_name(cubeFile))
+    if chunked:
+        copies.append(store_name(cubeFile))
+    return copies
+
+
+def remove_copy(copyName):
+    """Remove an existing compressed file or directory store."""
+    if os.path.isdir(copyName):
+        shutil.rmtree(copyName)
+    elif os.path.exists(copyName):
+        os.remove(copyName)
+
+
+def chunk_shape(shape, chunks):
+    """The (1, nchan, ny, nx) chunk shape for a (1, nchan, ny, nx) cube
+    from the --chunk-shape (nchan, ny, nx), no larger than the cube."""
+    return (1,) + tuple([max(1, min(c, n)) for c, n in zip(chunks, shape[1:])])
+
+
+def write_compressed(cubeFile, compress, quantize, chunks, verbose=4):
+    """Write a tile-compressed copy of the FITS cube cubeFile.
+
+    The cube becomes a CompImageHDU (with an empty PHDU, as fpack writes)
+    compressed in tiles of chunks (nchan, ny, nx) pixels, so a reader only
+    decompresses the tiles a cutout or a few channels touch, e.g. with
+    the section attribute in astropy.  Other extensions (the BEAMS table)
+    are copied as they are.  compress is "gzip", which is lossless unless
+    quantize is given, or "rice", which needs quantize.  quantize is the
+    astropy quantize_level, the values are rounded to about 1/quantize of
+    the noise of each tile.
+
+    Returns the name of the compressed file.
+    """
+    outFile = compressed_name(cubeFile)
+    quantizeLevel = 0.0 if quantize is None else quantize
+    with pyfits.open(cubeFile, memmap=True) as hdul:
+        cube = hdul[0]
+        compHdu = pyfits.CompImageHDU(
+            cube.data,
+            header=cube.header,
+            compression_type=_COMPRESSION_TYPES[compress],
+            quantize_level=quantizeLevel,
+            tile_shape=chunk_shape(cube.data.shape, chunks),
+        )
+        hdus = [pyfits.PrimaryHDU(), compHdu] + [hdu.copy() for hdu in hdul[1:]]
+        pyfits.HDUList(hdus).writeto(outFile, overwrite=True)
+    if verbose > 3:
+        print("Wrote " + outFile)
+    return outFile
+
+
+def _json_value(value):
+    """value with the non-finite floats in it replaced by the strings used
+    for them by the Zarr version 2 specification, which JSON has no
+    values for.
+    """
+    if isinstance(value, list):
+        return [_json_value(item) for item in value]
+    if isinstance(value, dict):
+        return dict([(key, _json_value(item)) for key, item in value.items()])
+    if isinstance(value, float) and not np.isfinite(value):
+        if np.isnan(value):
+            return "NaN"
+        return "Infinity" if value > 0 else "-Infinity"
+    return value
+
+
+def write_chunk_store(cubeFile, chunks, verbose=4):
+    """Write a copy of the FITS cube cubeFile as a chunked directory store.
+
+    The data are split into chunks of (nchan, ny, nx) pixels, each one a
+    zlib compressed file of little-endian values, and the FITS header is
+    kept as JSON next to them (see read_store_header).  The layout is that
+    of a Zarr version 2 array, edge chunks are padded with NaN.  Other
+    extensions of cubeFile (the BEAMS table) are kept in the JSON as
+    columns.  NaN and infinite values in the JSON are written as the
+    strings "NaN", "Infinity" and "-Infinity", as Zarr does for fill
+    values, so that the JSON is valid.  The cube is read one plane of
+    chunks at a time.
+
+    Returns the name of the store.
+    """
+    storeDir = store_name(cubeFile)
+    remove_copy(storeDir)
+    os.makedirs(storeDir)
+    with pyfits.open(cubeFile, memmap=True) as hdul:
+        cube = hdul[0].data
+        chunkShape = chunk_shape(cube.shape, chunks)
+        dtype = cube.dtype.newbyteorder("<")
+        meta = {
+            "zarr_format": _ZARR_FORMAT,
+            "shape": list(cube.shape),
+            "chunks": list(chunkShape),
+            "dtype": dtype.str,
+            "compressor": {"id": "zlib", "level": 1},
+            "fill_value": "NaN",
+            "order": "C",
+            "filters": None,
+        }
+        attrs = {
+            "fits_header": [
+                [card.keyword, card.value, card.comment]
+                for card in hdul[0].header.cards
+            ]
+        }
+        for hdu in hdul[1:]:
+            if isinstance(hdu, pyfits.BinTableHDU):
+                attrs[hdu.name] = dict(
+                    [(name, hdu.data[name].tolist()) for name in hdu.columns.names]
+                )
+
+        _, nchan, ny, nx = cube.shape
+        _, cChunk, yChunk, xChunk = chunkShape
+        for ci, c0 in enumerate(range(0, nchan, cChunk)):
+            # one plane of chunks, converted from big-endian
+            slab = np.asarray(cube[0, c0 : c0 + cChunk], dtype=dtype)
+            for yi, y0 in enumerate(range(0, ny, yChunk)):
+                for xi, x0 in enumerate(range(0, nx, xChunk)):
+                    block = slab[:, y0 : y0 + yChunk, x0 : x0 + xChunk]
+                    if block.shape != chunkShape[1:]:
+                        padded = np.full(chunkShape[1:], np.nan, dtype=dtype)
+                        padded[: block.shape[0], : block.shape[1], : block.shape[2]] = (
+                            block
+                        )
+                        block = padded
+                    chunkName = "0.%d.%d.%d" % (ci, yi, xi)
+                    with open(os.path.join(storeDir, chunkName), "wb") as f:
+                        f.write(zlib.compress(np.ascontiguousarray(block).tobytes(), 1))
+
+    with open(os.path.join(storeDir, ".zarray"), "w") as f:
+        json.dump(meta, f, indent=2, allow_nan=False)
+    with open(os.path.join(storeDir, ".zattrs"), "w") as f:
+        json.dump(_json_value(attrs), f, indent=2, allow_nan=False)
+    if verbose > 3:
+        print("Wrote " + storeDir)
+    return storeDir
+
+
+def read_store_header(storeDir):
+    """The FITS header kept in a store from write_chunk_store."""
+    with open(os.path.join(storeDir, ".zattrs")) as f:
+        attrs = json.load(f)
+    hdr = pyfits.Header()
+    for keyword, value, comment in attrs["fits_header"]:
+        hdr.append(pyfits.Card(keyword, value, comment), bottom=True)
+    return hdr
+
+
+def read_store(storeDir, chanStart=0, chanStop=None, y0=0, y1=None, x0=0, x1=None):
+    """Read channels chanStart to chanStop-1 of the pixels x0 to x1-1 and
+    y0 to y1-1 from a store from write_chunk_store.
+
+    Only the chunks holding those values are read.  Returns a (nchan, ny,
+    nx) array.
+    """
+    with open(os.path.join(storeDir, ".zarray")) as f:
+        meta = json.load(f)
+    _, nchan, ny, nx = meta["shape"]
+    _, cChunk, yChunk, xChunk = meta["chunks"]
+    dtype = np.dtype(meta["dtype"])
+    chanStop = nchan if chanStop is None else min(chanStop, nchan)
+    y1 = ny if y1 is None else min(y1, ny)
+    x1 = nx if x1 is None else min(x1, nx)
+
+    result = np.empty((chanStop - chanStart, y1 - y0, x1 - x0), dtype=dtype)
+    for ci in range(chanStart // cChunk, -(-chanStop // cChunk)):
+        for yi in range(y0 // yChunk, -(-y1 // yChunk)):
+            for xi in range(x0 // xChunk, -(-x1 // xChunk)):
+                chunkName = "0.%d.%d.%d" % (ci, yi, xi)
+                with open(os.path.join(storeDir, chunkName), "rb") as f:
+                    block = np.frombuffer(zlib.decompress(f.read()), dtype=dtype)
+                block = block.reshape(cChunk, yChunk, xChunk)
+                # the part of this chunk that is wanted, in chunk and
+                # result coordinates
+                cs, ys, xs = (ci * cChunk, yi * yChunk, xi * xChunk)
+                ca, cb = (max(chanStart, cs), min(chanStop, cs + cChunk))
+                ya, yb = (max(y0, ys), min(y1, ys + yChunk))
+                xa, xb = (max(x0, xs), min(x1, xs + xChunk))
+                result[
+                    ca - chanStart : cb - chanStart,
+                    ya - y0 : yb - y0,
+                    xa - x0 : xb - x0,
+                ] = block[ca - cs : cb - cs, ya - ys : yb - ys, xa - xs : xb - xs]
+    return result
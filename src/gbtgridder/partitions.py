@@ -0,0 +1,248 @@
+# Copyright (C) 2015 Associated Universities, Inc. Washington DC, USA.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+# Correspondence concerning GBT software should be addressed as follows:
+#       GBT Operations
+#       National Radio Astronomy Observatory
+#       P. O. Box 2
+#       Green Bank, WV 24944-0002 USA
+
+
+import numpy as np
+
+from .grid_otf import grid_otf
+from .tiles import tile_chunks
+
+# names of the SDFITS CRVAL4 polarization codes
+_POL_NAMES = {
+    1: "I",
+    2: "Q",
+    3: "U",
+    4: "V",
+    -1: "RR",
+    -2: "LL",
+    -3: "RL",
+    -4: "LR",
+    -5: "XX",
+    -6: "YY",
+    -7: "XY",
+    -8: "YX",
+}
+
+# the pairs of polarizations that are averaged to make Stokes I
+_STOKES_I_PAIRS = [(-5, -6), (-1, -2)]
+
+
+def pol_name(stokes):
+    """The name of an SDFITS polarization code, e.g. XX for -5."""
+    return _POL_NAMES.get(stokes, "pol%d" % stokes)
+
+
+def partition_rows(stokes, feeds, partition):
+    """Split the rows by polarization, by feed or by both (partition is one
+    of pol, feed, polfeed).
+
+    stokes and feeds are the CRVAL4 and FEED values of each row.  Returns
+    a list of dictionaries, one per partition in feed then polarization
+    order, with these fields:
+       name: used in the output file names, e.g. XX, feed1 or feed1_XX
+       rows: the indices of the rows in this partition
+       stokes: the polarization code, None when partitioning by feed
+       feed: the feed, None when partitioning by polarization
+    """
+    stokes = np.asarray(stokes)
+    feeds = np.asarray(feeds)
+    byPol = partition in ["pol", "polfeed"]
+    byFeed = partition in ["feed", "polfeed"]
+
+    keys = set()
+    for feed, pol in zip(feeds, stokes):
+        keys.add((int(feed) if byFeed else None, int(pol) if byPol else None))
+
+    result = []
+    for feed, pol in sorted(
+        keys, key=lambda key: (key[0] or 0, 0 if key[1] is None else abs(key[1]))
+    ):
+        mask = np.ones(len(stokes), dtype=bool)
+        names = []
+        if feed is not None:
+            mask &= feeds == feed
+            names.append("feed%d" % feed)
+        if pol is not None:
+            mask &= stokes == pol
+            names.append(pol_name(pol))
+        result.append(
+            {
+                "name": "_".join(names),
+                "rows": np.flatnonzero(mask),
+                "stokes": pol,
+                "feed": feed,
+            }
+        )
+    return result
+
+
+def position_groups(partitions, xsky, ysky):
+    """Group the partitions whose spectra are at the same sky positions.
+
+    Partitions are in the same group when their rows have exactly the same
+    positions in the same order, as the polarizations of one feed usually
+    do.  Those can be gridded together as one set of channels with a single
+    neighbour search (or sparse gridding plan).  Returns a list of lists
+    of indices into partitions.
+    """
+    groups = []
+    for index, part in enumerate(partitions):
+        rows = part["rows"]
+        for group in groups:
+            groupRows = partitions[group[0]]["rows"]
+            if (
+                len(groupRows) == len(rows)
+                and np.array_equal(xsky[groupRows], xsky[rows])
+                and np.array_equal(ysky[groupRows], ysky[rows])
+            ):
+                group.append(index)
+                break
+        else:
+            groups.append([index])
+    return groups
+
+
+def stokes_i_sets(partitions, verbose=4):
+    """The partitions to average into Stokes I, one set per feed.
+
+    Returns a list of (name, indexA, indexB) where name is I (or feed1_I
+    etc when partitioning by feed too) and indexA and indexB are the
+    partitions holding XX and YY (or RR and LL) for that feed.  A feed
+    without both of either pair is reported (at verbose > 2) and left out.
+    """
+    feeds = []
+    for part in partitions:
+        if part["feed"] not in feeds:
+            feeds.append(part["feed"])
+
+    result = []
+    for feed in feeds:
+        pols = {}
+        for index, part in enumerate(partitions):
+            if part["feed"] == feed:
+                pols[part["stokes"]] = index
+        name = "I" if feed is None else "feed%d_I" % feed
+        for polA, polB in _STOKES_I_PAIRS:
+            if polA in pols and polB in pols:
+                result.append((name, pols[polA], pols[polB]))
+                break
+        else:
+            if verbose > 2:
+                print("Warning: no XX and YY or RR and LL data to make %s from" % name)
+    return result
+
+
+def stokes_i(cubeA, weightA, cubeB, weightB):
+    """Stokes I from the gridded cubes of a pair of polarizations.
+
+    I is the mean of the two cubes, blanked where either one is.  Its
+    weight is the sum of their weights.  Returns (cube, weight).
+    """
+    return (0.5 * (cubeA + cubeB), weightA + weightB)
+
+
+def grid_partitions(
+    partitions,
+    groups,
+    stokesSets,
+    spec,
+    makeChunks,
+    xsky,
+    ysky,
+    weights,
+    nx,
+    ny,
+    wcsObj,
+    gridArgs,
+):
+    """Grid one slab of channels of every partition onto the same map.
+
+    spec holds the slab for all of the rows.  The spectra of the
+    partitions in each of groups (see position_groups) are put side by
+    side and gridded with one grid_otf call.  With makeChunks (--stream)
+    spec is None and each group must be a single partition, which reads
+    its own rows from the chunks.  gridArgs are the remaining grid_otf
+    keyword arguments.
+
+    Returns a dictionary of the gridded arrays keyed by output file type,
+    name_cube and name_weight for each partition and each of stokesSets.
+    Returns None if grid_otf fails.
+    """
+    result = {}
+    for group in groups:
+        groupRows = [partitions[index]["rows"] for index in group]
+        groupSpec = None
+        chunks = None
+        groupWeights = None
+        if makeChunks is not None:
+            rows = groupRows[0]
+            chunks = tile_chunks(makeChunks(), rows)
+            if weights is not None:
+                groupWeights = weights[rows]
+        else:
+            groupSpec = np.concatenate([spec[rows] for rows in groupRows], axis=1)
+            if weights is not None:
+                # one weight per row for each partition's range of channels
+                groupWeights = np.stack([weights[rows] for rows in groupRows], axis=1)
+        cube, weight, final_fwhm = grid_otf(
+            groupSpec,
+            nx,
+            ny,
+            xsky[groupRows[0]],
+            ysky[groupRows[0]],
+            wcsObj,
+            weights=groupWeights,
+            chunks=chunks,
+            **gridArgs,
+        )
+        if cube is None or weight is None:
+            return None
+
+        nchan = cube.shape[0] // len(group)
+        for k, index in enumerate(group):
+            name = partitions[index]["name"]
+            result[name + "_cube"] = cube[k * nchan : (k + 1) * nchan]
+            result[name + "_weight"] = weight[k * nchan : (k + 1) * nchan]
+
+    for name, indexA, indexB in stokesSets:
+        nameA = partitions[indexA]["name"]
+        nameB = partitions[indexB]["name"]
+        result[name + "_cube"], result[name + "_weight"] = stokes_i(
+            result[nameA + "_cube"],
+            result[nameA + "_weight"],
+            result[nameB + "_cube"],
+            result[nameB + "_weight"],
+        )
+    return result
+
+
+def partition_header(hdr, name, stokes):
+    """A copy of the cube header for the output of one partition.
+
+    The STOKES axis is set to the polarization of the partition, when it
+    has just one.
+    """
+    partHdr = hdr.copy()
+    if stokes is not None:
+        partHdr["CRVAL4"] = float(stokes)
+    partHdr.add_history("gbtgridder partition: " + name)
+    return partHdr
@@ -0,0 +1,252 @@
+# Copyright (C) 2015 Associated Universities, Inc. Washington DC, USA.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+# Correspondence concerning GBT software should be addressed as follows:
+#       GBT Operations
+#       National Radio Astronomy Observatory
+#       P. O. Box 2
+#       Green Bank, WV 24944-0002 USA
+
+
+import numpy as np
+from astropy import wcs
+from astropy.io import fits as pyfits
+
+from .get_data import data_window_view, read_data_window
+from .grid_otf import channel_slabs
+
+# the files written by --preview in place of the cube and weight files
+PREVIEW_TYPES = ["preview", "hits"]
+
+# the number of rows of a file read at a time
+_CHUNK_ROWS = 4096
+
+
+def preview_blocks(nchan, nblocks):
+    """Split nchan output channels into at most nblocks (chanStart, chanStop)
+    blocks of the same size, the last one may be smaller.  chanStop is
+    exclusive."""
+    return channel_slabs(nchan, int(np.ceil(nchan / nblocks)))
+
+
+def preview_rows(files, sample):
+    """Every sample'th row of the rows found by scan_sdfits.
+
+    files is the scan_sdfits list of (sdfitsFile, rows).  Returns a list of
+    (sdfitsFile, rows, specIndex) for each file with rows picked, where
+    specIndex is the index of each picked row in the scan_sdfits row order
+    (and so in its xsky, ysky and weights).
+    """
+    result = []
+    offset = 0
+    for thisFile, rows in files:
+        picked = np.arange((-offset) % sample, len(rows), sample)
+        if len(picked) > 0:
+            result.append((thisFile, np.asarray(rows)[picked], offset + picked))
+        offset += len(rows)
+    return result
+
+
+def read_preview_spectra(sdfitsFile, rows, chanStart, average, blocks, dtype):
+    """The average of each block of output channels for some rows of a file.
+
+    rows are table rows of sdfitsFile and blocks the preview_blocks of the
+    output channels.  Output channel k is made from the average input
+    channels chanStart + k*average through chanStart + (k+1)*average - 1
+    (average is None for no averaging), so each block is the plain average
+    of its input channels, without the --smooth kernel.  NaN values are
+    left out.  Only the channels in the blocks of those rows are read,
+    _CHUNK_ROWS rows at a time.
+
+    Returns a (len(rows), len(blocks)) array, NaN where a block has no
+    valid values.
+    """
+    average = 1 if average is None else average
+    rawStop = chanStart + blocks[-1][1] * average - 1
+    result = np.empty((len(rows), len(blocks)), dtype=dtype)
+    with pyfits.open(sdfitsFile, memmap=True, mode="readonly") as hdul:
+        dataView = data_window_view(hdul[1])
+        for i0 in range(0, len(rows), _CHUNK_ROWS):
+            chunkRows = rows[i0 : i0 + _CHUNK_ROWS]
+            if dataView is not None:
+                data = read_data_window(dataView, chunkRows, chanStart, rawStop)
+            else:
+                data = hdul[1].data.field("data")[chunkRows, chanStart : rawStop + 1]
+            for block, (k0, k1) in enumerate(blocks):
+                values = data[:, k0 * average : k1 * average]
+                good = ~np.isnan(values)
+                total = np.where(good, values, 0.0).sum(axis=1)
+                count = good.sum(axis=1)
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    result[i0 : i0 + len(chunkRows), block] = total / count
+    return result
+
+
+def preview_header(hdr, binning, faxis, blocks):
+    """The header of the preview of a cube with header hdr.
+
+    The pixels are binning x binning pixels of the cube, on the same
+    projection, and each channel is one of the blocks of the channels with
+    frequencies faxis, blocks as from preview_blocks.  The spectral axis
+    assumes that all blocks are the size of the first one.
+    """
+    previewHdr = hdr.copy()
+    for key in ["DATAMAX", "DATAMIN", "CASAMBM"]:
+        if key in previewHdr:
+            del previewHdr[key]
+    for axis in ["1", "2"]:
+        previewHdr["NAXIS" + axis] = int(np.ceil(hdr["NAXIS" + axis] / binning))
+        previewHdr["CDELT" + axis] = hdr["CDELT" + axis] * binning
+        # the center of each preview pixel is the center of its pixels
+        previewHdr["CRPIX" + axis] = (hdr["CRPIX" + axis] - 0.5) / binning + 0.5
+    blockSize = blocks[0][1] - blocks[0][0]
+    previewHdr["NAXIS3"] = len(blocks)
+    previewHdr["CRVAL3"] = float(np.mean(faxis[blocks[0][0] : blocks[0][1]]))
+    previewHdr["CRPIX3"] = 1.0
+    if len(faxis) > 1:
+        previewHdr["CDELT3"] = (faxis[1] - faxis[0]) * blockSize
+    restfreq = previewHdr.get("RESTFRQ", 0.0)
+    if "ALTRPIX" in previewHdr and previewHdr["CDELT3"] != 0.0 and restfreq > 0.0:
+        previewHdr["ALTRPIX"] = (
+            previewHdr["CRPIX3"]
+            + (restfreq - previewHdr["CRVAL3"]) / previewHdr["CDELT3"]
+        )
+    previewHdr.add_history(
+        "gbtgridder preview: %d x %d pixels, %d channels in each plane"
+        % (binning, binning, blockSize)
+    )
+    return previewHdr
+
+
+def preview_pixels(previewHdr, xsky, ysky):
+    """The index in the flattened (ny, nx) map of the preview pixel nearest
+    to each sky position, -1 for positions off the map."""
+    nx = previewHdr["NAXIS1"]
+    ny = previewHdr["NAXIS2"]
+    wcsObj = wcs.WCS(previewHdr, relax=True)
+    xpix, ypix = wcsObj.celestial.wcs_world2pix(xsky, ysky, 0)
+    with np.errstate(invalid="ignore"):
+        ix = np.floor(xpix + 0.5)
+        iy = np.floor(ypix + 0.5)
+        onMap = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+    pixels = np.full(len(xsky), -1, dtype=np.int64)
+    pixels[onMap] = (iy[onMap] * nx + ix[onMap]).astype(np.int64)
+    return pixels
+
+
+def bin_preview(pixels, spec, weights, npix):
+    """The weighted average of the spectra nearest to each preview pixel.
+
+    pixels are from preview_pixels, spec the (nspec, nblocks) block
+    averages and weights the weight of each spectrum.  Returns an
+    (nblocks, npix) array, NaN where a pixel has no valid values.
+    """
+    onMap = pixels >= 0
+    result = np.full((spec.shape[1], npix), np.nan, dtype=spec.dtype)
+    for block in range(spec.shape[1]):
+        values = spec[onMap, block]
+        good = ~np.isnan(values)
+        pixel = pixels[onMap][good]
+        wt = weights[onMap][good]
+        sumWt = np.bincount(pixel, weights=wt, minlength=npix)
+        sumData = np.bincount(pixel, weights=wt * values[good], minlength=npix)
+        hasData = sumWt > 0.0
+        result[block, hasData] = sumData[hasData] / sumWt[hasData]
+    return result
+
+
+def write_preview(
+    outputFiles,
+    hdr,
+    files,
+    xsky,
+    ysky,
+    weights,
+    chanStart,
+    average,
+    faxis,
+    nblocks,
+    binning,
+    sample,
+    dtype=np.float64,
+    verbose=4,
+):
+    """Grid a quick look at the cube with header hdr and write it to
+    outputFiles["preview"], with the number of spectra in each of its
+    pixels in outputFiles["hits"].
+
+    The channels with frequencies faxis are averaged into nblocks blocks,
+    the pixels into binning x binning pixels and only every sample'th of the
+    scan_sdfits files and rows is read.  Each preview pixel is the weighted
+    average of the spectra nearest to it, there is no convolution kernel.
+    weights is the weight of every spectrum, None for equal weights.  The
+    hits count every spectrum with a weight, read or not.
+
+    Returns a dictionary with the number of preview pixels (npix), of those
+    with any hits (covered) and of spectra off the map (offmap).
+    """
+    if weights is None:
+        weights = np.ones(len(xsky))
+    blocks = preview_blocks(len(faxis), nblocks)
+    previewHdr = preview_header(hdr, binning, faxis, blocks)
+    nx, ny = (previewHdr["NAXIS1"], previewHdr["NAXIS2"])
+
+    pixels = preview_pixels(previewHdr, xsky, ysky)
+    counted = (pixels >= 0) & (weights > 0.0)
+    hits = np.bincount(pixels[counted], minlength=nx * ny).astype(np.int32)
+
+    specIndex = []
+    spec = []
+    for thisFile, rows, fileIndex in preview_rows(files, sample):
+        if verbose > 3:
+            print("   ", thisFile, "%d rows" % len(rows))
+        spec.append(
+            read_preview_spectra(thisFile, rows, chanStart, average, blocks, dtype)
+        )
+        specIndex.append(fileIndex)
+    specIndex = np.concatenate(specIndex)
+    cube = bin_preview(
+        pixels[specIndex], np.concatenate(spec), weights[specIndex], nx * ny
+    )
+
+    cube = cube.reshape(len(blocks), ny, nx)
+    if np.any(np.isfinite(cube)):
+        previewHdr["DATAMAX"] = float(np.nanmax(cube))
+        previewHdr["DATAMIN"] = float(np.nanmin(cube))
+    previewHdr.add_history("gbtgridder preview: every %d spectra read" % sample)
+    pyfits.PrimaryHDU(cube[None], header=previewHdr).writeto(outputFiles["preview"])
+
+    hitsHdr = preview_header(hdr, binning, faxis, [(0, len(faxis))])
+    hitsHdr["BUNIT"] = ("spectra", "Number of spectra nearest each pixel")
+    hitsHdr["DATAMAX"] = int(hits.max())
+    hitsHdr["DATAMIN"] = int(hits.min())
+    pyfits.PrimaryHDU(hits.reshape(1, 1, ny, nx), header=hitsHdr).writeto(
+        outputFiles["hits"]
+    )
+
+    result = {
+        "npix": nx * ny,
+        "covered": int(np.count_nonzero(hits)),
+        "offmap": int(np.count_nonzero(pixels < 0)),
+    }
+    if verbose > 2:
+        print(
+            "Preview: %d x %d pixels, %d with data, %d spectra off the map"
+            % (nx, ny, result["covered"], result["offmap"])
+        )
+    if verbose > 3:
+        print("Wrote " + outputFiles["preview"] + " and " + outputFiles["hits"])
+    return result
@@ -0,0 +1,187 @@
+# Copyright (C) 2015 Associated Universities, Inc. Washington DC, USA.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+# Correspondence concerning GBT software should be addressed as follows:
+#       GBT Operations
+#       National Radio Astronomy Observatory
+#       P. O. Box 2
+#       Green Bank, WV 24944-0002 USA
+
+
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from .cache import cache_key
+
+# bump this when the layout of the index changes
+INDEX_VERSION = 1
+
+# optional columns whose distinct values are listed for each scan
+_ID_COLUMNS = ["FEED", "PLNUM", "IFNUM"]
+
+
+def build_scan_index(sdfitsHDU):
+    """Summarize each scan in an SDFITS table.
+
+    The table is read one column at a time and each scan is found as one
+    or more runs of consecutive rows, so the cost does not depend on the
+    number of scans.
+
+    Returns a dictionary with "nrows", the number of rows in the table,
+    and "scans", a list with one dictionary per scan (in scan number
+    order) with these fields:
+       scan: the scan number
+       rows: list of [rowStart, rowStop) ranges holding the scan
+       nrows: the number of rows in the scan
+       time: DATE-OBS of the first and last row of the scan
+       tsys: the min, max and median TSYS
+       xsky, ysky: the min and max CRVAL2 and CRVAL3
+       feed, plnum, ifnum: the distinct values in the scan, when those
+          columns are present
+    """
+    tabData = sdfitsHDU.data
+    names = [name.upper() for name in tabData.names]
+    nrows = len(tabData)
+    index = {"version": INDEX_VERSION, "nrows": nrows, "scans": []}
+    if nrows == 0:
+        return index
+
+    scans = np.asarray(tabData.field("scan"))
+    runStarts = np.concatenate(([0], np.flatnonzero(np.diff(scans) != 0) + 1))
+    runStops = np.append(runStarts[1:], nrows)
+    runScans = scans[runStarts]
+
+    tsys = np.asarray(tabData.field("tsys"))
+    xsky = np.asarray(tabData.field("crval2"))
+    ysky = np.asarray(tabData.field("crval3"))
+    dateObs = tabData.field("date-obs")
+    idValues = {}
+    for col in _ID_COLUMNS:
+        if col in names:
+            idValues[col.lower()] = np.asarray(tabData.field(col))
+
+    # runs of the same scan, in row order
+    order = np.argsort(runScans, kind="stable")
+    groups = np.split(order, np.flatnonzero(np.diff(runScans[order]) != 0) + 1)
+    for runs in groups:
+        scanRows = np.concatenate([np.arange(runStarts[i], runStops[i]) for i in runs])
+        scanInfo = {}
+        scanInfo["scan"] = int(runScans[runs[0]])
+        scanInfo["rows"] = [[int(runStarts[i]), int(runStops[i])] for i in runs]
+        scanInfo["nrows"] = len(scanRows)
+        scanInfo["time"] = [str(dateObs[scanRows[0]]), str(dateObs[scanRows[-1]])]
+        scanTsys = tsys[scanRows]
+        scanInfo["tsys"] = [
+            float(scanTsys.min()),
+            float(scanTsys.max()),
+            float(np.median(scanTsys)),
+        ]
+        scanInfo["xsky"] = [float(xsky[scanRows].min()), float(xsky[scanRows].max())]
+        scanInfo["ysky"] = [float(ysky[scanRows].min()), float(ysky[scanRows].max())]
+        for col in idValues:
+            scanInfo[col] = [int(v) for v in np.unique(idValues[col][scanRows])]
+        index["scans"].append(scanInfo)
+
+    return index
+
+
+def read_scan_index(sdfitsFile, sdfitsHDU, cacheDir=None, verbose=4):
+    """Return the scan index (see build_scan_index) of an SDFITS file.
+
+    If cacheDir is given the index is kept there as a small JSON sidecar,
+    keyed like the ingestion cache on the path, size and modification
+    time of the file, so it is only built the first time it is needed.
+    Otherwise it is built each time.
+    """
+    indexFile = None
+    if cacheDir is not None:
+        name, _ = cache_key(sdfitsFile, {"index": INDEX_VERSION})
+        indexFile = os.path.join(cacheDir, "index-%s.json" % name)
+        try:
+            with open(indexFile) as f:
+                index = json.load(f)
+            # recently used, see cache.trim_cache
+            os.utime(indexFile)
+            return index
+        except (OSError, ValueError):
+            pass
+
+    index = build_scan_index(sdfitsHDU)
+
+    if indexFile is not None:
+        tmpName = None
+        try:
+            os.makedirs(cacheDir, exist_ok=True)
+            fd, tmpName = tempfile.mkstemp(prefix=".tmp-", dir=cacheDir)
+            with os.fdopen(fd, "w") as f:
+                json.dump(index, f)
+            os.replace(tmpName, indexFile)
+            tmpName = None
+        except OSError as e:
+            if verbose > 2:
+                print(
+                    "Warning: could not write the scan index for %s: %s"
+                    % (sdfitsFile, e)
+                )
+        finally:
+            if tmpName is not None:
+                os.remove(tmpName)
+
+    return index
+
+
+def index_rows(scanIndex, scanlist, rowRange=None):
+    """The table rows of the scans in scanlist, in row order.
+
+    If rowRange is given as (rowStart, rowStop) only the rows in that range
+    are returned.
+    """
+    scanSet = set(scanlist)
+    ranges = []
+    for scanInfo in scanIndex["scans"]:
+        if scanInfo["scan"] in scanSet:
+            ranges.extend(scanInfo["rows"])
+    ranges.sort()
+
+    rows = [np.arange(r0, r1) for (r0, r1) in ranges]
+    rows = np.concatenate(rows) if len(rows) > 0 else np.arange(0)
+    if rowRange is not None:
+        rows = rows[(rows >= rowRange[0]) & (rows < rowRange[1])]
+    return rows
+
+
+def scan_rows(sdfitsFile, sdfitsHDU, scanlist, rowRange=None, cacheDir=None, verbose=4):
+    """The table rows of the scans in scanlist, in row order.
+
+    With cacheDir the rows come from the scan index kept there (see
+    read_scan_index and index_rows).  Without it only the SCAN column is
+    read, building an index that would be thrown away costs more.
+    """
+    if cacheDir is not None:
+        scanIndex = read_scan_index(
+            sdfitsFile, sdfitsHDU, cacheDir=cacheDir, verbose=verbose
+        )
+        return index_rows(scanIndex, scanlist, rowRange=rowRange)
+
+    scans = sdfitsHDU.data.field("scan")
+    rowStart = 0
+    if rowRange is not None:
+        rowStart = rowRange[0]
+        scans = scans[rowRange[0] : rowRange[1]]
+    return np.flatnonzero(np.isin(scans, list(scanlist))) + rowStart
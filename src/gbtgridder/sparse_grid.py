@@ -0,0 +1,322 @@
+# Copyright (C) 2015 Associated Universities, Inc. Washington DC, USA.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+# Correspondence concerning GBT software should be addressed as follows:
+#       GBT Operations
+#       National Radio Astronomy Observatory
+#       P. O. Box 2
+#       Green Bank, WV 24944-0002 USA
+
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+from astropy import wcs
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+# channels per sparse x dense product, keeps the temporaries small
+_CHANNEL_BLOCK = 256
+
+# bump this when the way the kernel matrix is built changes
+PLAN_VERSION = 1
+
+
+def kernel_weights(kernel_type, kernel_params, distance):
+    """The kernel value at each distance (deg) for a kernel from
+    grid_otf.kernel_setup.
+
+    Only gauss1d, the cygrid gaussian exp(-d**2 / (2 sigma**2)), is
+    supported.  That is the only kernel checked against cygrid.
+    """
+    if kernel_type == "gauss1d":
+        sigma = np.atleast_1d(kernel_params)[0]
+        return np.exp(-distance * distance * (0.5 / sigma**2))
+
+    raise ValueError("kernel %s is not supported by the sparse backend" % kernel_type)
+
+
+def pixel_coords(header):
+    """World coordinates (deg) of the pixel centers of the celestial axes
+    of a header made by grid_otf.prepare_header, computed as cygrid does.
+
+    Returns (lon, lat), flat arrays in (y, x) order, NaN where the
+    projection has no valid coordinates.
+    """
+    celestial = wcs.WCS(header, naxis=[wcs.WCSSUB_CELESTIAL])
+    ypix, xpix = np.indices((header["NAXIS2"], header["NAXIS1"]))
+    lon, lat = celestial.wcs_pix2world(xpix.ravel() + 1, ypix.ravel() + 1, 1)
+    return (lon, lat)
+
+
+def _unit_vectors(lon, lat):
+    lonRad = np.radians(lon)
+    latRad = np.radians(lat)
+    return np.column_stack(
+        (
+            np.cos(latRad) * np.cos(lonRad),
+            np.cos(latRad) * np.sin(lonRad),
+            np.sin(latRad),
+        )
+    )
+
+
+def kernel_matrix(header, glon, glat, kernel_type, kernel_params, support_distance):
+    """The (npix, nspec) matrix of kernel weights between each pixel of
+    the map and each spectrum position.
+
+    Pairs are found with a KD tree of unit vectors and their distances are
+    the haversine angular distances used by cygrid, so the same pairs (those
+    closer than support_distance) get the same kernel values.  The matrix
+    does not depend on the channel, so it is built once and used for all
+    of the channels.
+
+    Returns a scipy.sparse CSC matrix, so that the columns for a block of
+    spectra are cheap to take.
+    """
+    pixLon, pixLat = pixel_coords(header)
+    npix = pixLon.size
+    valid = np.flatnonzero(np.isfinite(pixLon) & np.isfinite(pixLat))
+
+    pixTree = cKDTree(_unit_vectors(pixLon[valid], pixLat[valid]))
+    specTree = cKDTree(_unit_vectors(glon, glat))
+    # chord length for the support distance, slightly larger so that the
+    # exact angular distance decides the pairs on the edge
+    chord = 2.0 * np.sin(np.radians(support_distance) / 2.0) * (1.0 + 1e-9)
+    pairs = pixTree.sparse_distance_matrix(specTree, chord, output_type="ndarray")
+    pix = valid[pairs["i"]]
+    spec = pairs["j"]
+
+    # haversine, as in cygrid
+    l1, b1 = (np.radians(pixLon[pix]), np.radians(pixLat[pix]))
+    l2, b2 = (np.radians(glon[spec]), np.radians(glat[spec]))
+    distance = np.degrees(
+        2.0
+        * np.arcsin(
+            np.sqrt(
+                np.sin((b1 - b2) / 2.0) ** 2
+                + np.cos(b1) * np.cos(b2) * np.sin((l1 - l2) / 2.0) ** 2
+            )
+        )
+    )
+    inside = distance < support_distance
+    values = kernel_weights(kernel_type, kernel_params, distance[inside])
+
+    return sparse.csc_matrix(
+        (values, (pix[inside], spec[inside])),
+        shape=(npix, len(glon)),
+    )
+
+
+def weight_columns(weight_array, nchan, chanStart, chanStop):
+    """The (nrows, chanStop - chanStart) weights of channels chanStart to
+    chanStop from (nrows, m) weights.
+
+    Column j of weight_array is the weight of the j-th of m equal ranges of
+    the nchan channels, so m == nchan is a weight for each channel and
+    stacked spectra can keep one weight per row for each stack.
+    """
+    if weight_array.shape[1] == nchan:
+        return weight_array[:, chanStart:chanStop]
+    columns = np.arange(chanStart, chanStop) * weight_array.shape[1] // nchan
+    return weight_array[:, columns]
+
+
+def grid_rows_sparse(
+    kernelMatrix,
+    rowStart,
+    spec,
+    weight_array,
+    dataSum,
+    weightSum,
+    nanMask=None,
+    chanBlocks=None,
+    executor=None,
+):
+    """Accumulate one block of spectra into the (nchan, npix) sums.
+
+    kernelMatrix is from kernel_matrix, spec and weight_array are the
+    (nrows, nchan) spectra for rows rowStart onward and their weights, with
+    no NaN values left in spec (see grid_otf.row_weights).  weight_array is
+    either the nrows weights of the spectra, per-channel (nrows, nchan)
+    weights which are already zero where spec was NaN, or (nrows, m) weights
+    for m equal ranges of channels (see weight_columns).  nanMask is None or
+    the sparse matrix of where spec was NaN, for all but per-channel
+    weights.
+    dataSum and weightSum are the unweighted data cube and weight cube,
+    with the channels along the first axis so that they reshape to
+    (nchan, ny, nx) cubes without a copy.
+
+    With weights of the spectra they are put into the kernel columns, so
+    no weighted copy of the spectra is made and the weight sums are the
+    same for every channel without NaN values.
+
+    chanBlocks is an optional list of (chanStart, chanStop) ranges that are
+    done separately, concurrently when an executor is also given.  Each
+    channel of the sums only depends on that channel of the spectra so this
+    does not change the result.
+    """
+    columns = kernelMatrix[:, rowStart : rowStart + spec.shape[0]]
+    pixelWeights = None
+    if weight_array.ndim == 1:
+        columns = (columns @ sparse.diags(weight_array)).tocsc()
+        pixelWeights = np.asarray(columns.sum(axis=1)).ravel()
+        if nanMask is not None:
+            nanMask = nanMask.tocsc()
+    if chanBlocks is None:
+        chanBlocks = [(0, spec.shape[1])]
+    gridArgs = (columns, spec, weight_array, pixelWeights, nanMask, dataSum, weightSum)
+    if executor is None:
+        for c0, c1 in chanBlocks:
+            _grid_channels(*gridArgs, c0, c1)
+    else:
+        futures = [
+            executor.submit(_grid_channels, *gridArgs, c0, c1) for c0, c1 in chanBlocks
+        ]
+        for future in futures:
+            future.result()
+
+
+def _grid_channels(
+    columns,
+    spec,
+    weight_array,
+    pixelWeights,
+    nanMask,
+    dataSum,
+    weightSum,
+    chanStart,
+    chanStop,
+):
+    # grid channels chanStart to chanStop, _CHANNEL_BLOCK at a time to
+    # bound the size of the temporaries
+    for c0 in range(chanStart, chanStop, _CHANNEL_BLOCK):
+        c1 = min(c0 + _CHANNEL_BLOCK, chanStop)
+        if pixelWeights is None:
+            blockWeights = weight_columns(weight_array, spec.shape[1], c0, c1)
+            if nanMask is not None and weight_array.shape[1] != spec.shape[1]:
+                blockWeights[nanMask[:, c0:c1].nonzero()] = 0
+            dataSum[c0:c1] += (columns @ (spec[:, c0:c1] * blockWeights)).T
+            weightSum[c0:c1] += (columns @ blockWeights).T
+            continue
+
+        # the weights are already in the columns
+        dataSum[c0:c1] += (columns @ spec[:, c0:c1]).T
+        nanChans = []
+        if nanMask is not None:
+            blockMask = nanMask[:, c0:c1]
+            nanChans = np.flatnonzero(np.diff(blockMask.indptr))
+        if len(nanChans) == 0:
+            weightSum[c0:c1] += pixelWeights
+        else:
+            # only the channels with NaN values need their own weight sums
+            goodChans = np.setdiff1d(np.arange(c1 - c0), nanChans)
+            weightSum[c0 + goodChans] += pixelWeights
+            valid = 1.0 - blockMask[:, nanChans].toarray()
+            weightSum[c0 + nanChans] += (
+                columns @ valid.astype(weightSum.dtype, copy=False)
+            ).T
+
+
+def plan_key(header, glon, glat, kernel_type, kernel_params, support_distance):
+    """A hash of everything the kernel matrix depends on.
+
+    That is the celestial part of the header (not the spectral axis, so a
+    different channel selection or rest frequency gives the same key), the
+    positions and the kernel.
+    """
+    celestial = wcs.WCS(header, naxis=[wcs.WCSSUB_CELESTIAL])
+    keyInfo = {
+        "version": PLAN_VERSION,
+        "shape": [header["NAXIS1"], header["NAXIS2"]],
+        "wcs": celestial.to_header_string(),
+        "kernel": kernel_type,
+        "params": np.atleast_1d(kernel_params).tolist(),
+        "support": support_distance,
+    }
+    planHash = hashlib.sha1(json.dumps(keyInfo, sort_keys=True).encode("utf-8"))
+    planHash.update(np.ascontiguousarray(glon, dtype=np.float64).tobytes())
+    planHash.update(np.ascontiguousarray(glat, dtype=np.float64).tobytes())
+    return planHash.hexdigest()
+
+
+def kernel_plan(
+    header,
+    glon,
+    glat,
+    kernel_type,
+    kernel_params,
+    support_distance,
+    dtype=np.float64,
+    planDir=None,
+    verbose=4,
+    plans=None,
+):
+    """The kernel_matrix for these inputs, reusing an earlier one if possible.
+
+    This gridding plan is the only part of the gridding that depends on the
+    geometry.  plans, if given, is a dictionary kept by the caller for one
+    run that holds the last plan used, so the channel slabs of that run
+    build it once.  If planDir is given plans are also saved there, as
+    plan-<key>.npz (see plan_key), and later runs with the same positions,
+    map and kernel load the plan instead of building it.
+    """
+    key = plan_key(header, glon, glat, kernel_type, kernel_params, support_distance)
+    matrix = None
+    if plans is not None:
+        matrix = plans.get(key)
+
+    planFile = None
+    if matrix is None and planDir is not None:
+        planFile = os.path.join(planDir, "plan-%s.npz" % key)
+        try:
+            matrix = sparse.load_npz(planFile).tocsc()
+            # recently used, see cache.trim_cache
+            os.utime(planFile)
+            if verbose > 4:
+                print("Using the gridding plan in %s" % planFile)
+        except (OSError, ValueError):
+            matrix = None
+
+    if matrix is None:
+        matrix = kernel_matrix(
+            header, glon, glat, kernel_type, kernel_params, support_distance
+        )
+        if planFile is not None:
+            tmpName = None
+            try:
+                os.makedirs(planDir, exist_ok=True)
+                fd, tmpName = tempfile.mkstemp(
+                    prefix=".tmp-", suffix=".npz", dir=planDir
+                )
+                os.close(fd)
+                sparse.save_npz(tmpName, matrix, compressed=False)
+                os.replace(tmpName, planFile)
+                tmpName = None
+            except OSError as e:
+                if verbose > 2:
+                    print("Warning: could not save the gridding plan: %s" % e)
+            finally:
+                if tmpName is not None and os.path.exists(tmpName):
+                    os.remove(tmpName)
+
+    if plans is not None:
+        plans.clear()
+        plans[key] = matrix
+    return matrix.astype(dtype, copy=False)
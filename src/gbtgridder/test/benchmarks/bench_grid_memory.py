@@ -0,0 +1,79 @@
+"""Measure the peak memory grid_otf uses on top of its inputs.
+
+Grids a synthetic raster map of random spectra with each backend, with
+and without some NaN values in the spectra, and prints the peak of the
+numpy memory allocated while gridding (as traced by tracemalloc) next to
+the size of the spectra.
+
+    python -m gbtgridder.test.benchmarks.bench_grid_memory --nchan 1024
+"""
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+from gbtgridder.grid_otf import grid_otf
+
+from .bench_grid_threads import synthetic_map
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backend", nargs="+", default=["cygrid", "sparse"])
+    parser.add_argument("--nx", type=int, default=100, help="map size (pixels)")
+    parser.add_argument("--nspec", type=int, default=20000)
+    parser.add_argument("--nchan", type=int, default=512)
+    parser.add_argument(
+        "--nan-rows",
+        type=float,
+        default=0.01,
+        help="fraction of the spectra with a NaN channel, for the NaN runs",
+    )
+    args = parser.parse_args()
+
+    spec, glon, glat, weights, wcsObj, pixScale = synthetic_map(
+        args.nx, args.nspec, args.nchan
+    )
+    nanSpec = spec.copy()
+    rng = np.random.default_rng(2)
+    nanRows = rng.choice(args.nspec, int(args.nan_rows * args.nspec), replace=False)
+    nanSpec[nanRows, rng.integers(0, args.nchan, len(nanRows))] = np.nan
+    beamFwhm = 3.0 * pixScale
+    print(
+        "%d spectra of %d channels (%.0f MB) onto %d x %d pixels"
+        % (args.nspec, args.nchan, spec.nbytes / 1024.0**2, args.nx, args.nx)
+    )
+    print("%-8s %6s %10s %14s" % ("backend", "NaN", "time (s)", "peak (MB)"))
+    for backend in args.backend:
+        for label, data in [("no", spec), ("yes", nanSpec)]:
+            tracemalloc.start()
+            startTime = time.perf_counter()
+            grid_otf(
+                data,
+                args.nx,
+                args.nx,
+                glon,
+                glat,
+                wcsObj,
+                pixScale,
+                180.0,
+                30.0,
+                beamFwhm,
+                weights.copy(),
+                "gauss",
+                beamFwhm / 3.0,
+                0,
+                backend=backend,
+            )
+            elapsed = time.perf_counter() - startTime
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(
+                "%-8s %6s %10.2f %14.0f" % (backend, label, elapsed, peak / 1024.0**2)
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Time grid_otf with different numbers of threads.
+
+Grids a synthetic raster map of random spectra with each backend and
+number of threads, checks that the cubes are identical to the one thread
+result and prints the times and speed-ups.
+
+    python -m gbtgridder.test.benchmarks.bench_grid_threads --threads 1 2 4 8
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+from astropy import wcs
+
+from gbtgridder.grid_otf import grid_otf
+
+
+def synthetic_map(nx, nspec, nchan, seed=1):
+    # a square map of nx by nx pixels of 1 arcmin, with nspec spectra at
+    # random positions over it
+    pixScale = 1.0 / 60.0
+    wcsObj = wcs.WCS(naxis=3)
+    wcsObj.wcs.ctype = ["RA---SFL", "DEC--SFL", "FREQ"]
+    wcsObj.wcs.crval = [180.0, 30.0, 1.4e9]
+    wcsObj.wcs.crpix = [(nx + 1) / 2.0, (nx + 1) / 2.0, 1.0]
+    wcsObj.wcs.cdelt = [-pixScale, pixScale, 1.0e4]
+    rng = np.random.default_rng(seed)
+    halfSize = nx * pixScale / 2.0
+    glat = 30.0 + rng.uniform(-halfSize, halfSize, nspec)
+    glon = 180.0 + rng.uniform(-halfSize, halfSize, nspec) / np.cos(np.radians(glat))
+    spec = rng.normal(size=(nspec, nchan))
+    weights = rng.uniform(0.5, 1.5, nspec)
+    return (spec, glon, glat, weights, wcsObj, pixScale)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--backend", nargs="+", default=["cygrid", "sparse"])
+    parser.add_argument("--nx", type=int, default=100, help="map size (pixels)")
+    parser.add_argument("--nspec", type=int, default=20000)
+    parser.add_argument("--nchan", type=int, default=512)
+    args = parser.parse_args()
+
+    spec, glon, glat, weights, wcsObj, pixScale = synthetic_map(
+        args.nx, args.nspec, args.nchan
+    )
+    beamFwhm = 3.0 * pixScale
+    print(
+        "%d spectra of %d channels onto %d x %d pixels, %d cpus"
+        % (args.nspec, args.nchan, args.nx, args.nx, os.cpu_count())
+    )
+    print(
+        "%-8s %8s %10s %8s %10s"
+        % ("backend", "threads", "time (s)", "speedup", "identical")
+    )
+    for backend in args.backend:
+        serialTime = None
+        serialCube = None
+        for threads in args.threads:
+            startTime = time.perf_counter()
+            cube, weight, final_fwhm = grid_otf(
+                spec,
+                args.nx,
+                args.nx,
+                glon,
+                glat,
+                wcsObj,
+                pixScale,
+                180.0,
+                30.0,
+                beamFwhm,
+                weights.copy(),
+                "gauss",
+                beamFwhm / 3.0,
+                0,
+                backend=backend,
+                threads=threads,
+            )
+            elapsed = time.perf_counter() - startTime
+            if serialCube is None:
+                serialTime, serialCube = (elapsed, cube)
+            identical = np.array_equal(cube, serialCube, equal_nan=True)
+            print(
+                "%-8s %8d %10.2f %8.2f %10s"
+                % (backend, threads, elapsed, serialTime / elapsed, identical)
+            )
+
+
+if __name__ == "__main__":
+    main()
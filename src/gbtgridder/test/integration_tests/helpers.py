@@ -0,0 +1,45 @@
+import os
+import sys
+
+import numpy as np
+from astropy.io import fits
+
+from gbtgridder import gbtgridder, gbtgridder_args
+
+
+def run_gridder(sdfitsFile, name, extraArgs):
+    # grid sdfitsFile with the given arguments and return the cube and weight arrays
+    sys.argv = [sys.argv[0], sdfitsFile, "-o", name, "--clobber", "--autoConfirm"]
+    sys.argv += extraArgs
+    args = gbtgridder_args.parser_args(sys.argv, "1.0")
+    gbtgridder_args.check_args(args)
+    gbtgridder.gbtgridder(args)
+
+    cube = fits.getdata(name + "_cube.fits")
+    weight = fits.getdata(name + "_weight.fits")
+
+    # cleanup for the next test
+    sys.argv = [sys.argv[0]]
+    os.remove(name + "_cube.fits")
+    os.remove(name + "_weight.fits")
+    return (cube, weight)
+
+
+def run_args(sdfitsFiles, extraArgs):
+    # run the gridder on one SDFITS file or a list of them with the given arguments
+    if isinstance(sdfitsFiles, str):
+        sdfitsFiles = [sdfitsFiles]
+    sys.argv = [sys.argv[0]] + sdfitsFiles + ["--clobber", "--autoConfirm"] + extraArgs
+    args = gbtgridder_args.parser_args(sys.argv, "1.0")
+    gbtgridder_args.check_args(args)
+    gbtgridder.gbtgridder(args)
+    sys.argv = [sys.argv[0]]
+
+
+def assert_close(ref, other, tolerance=1.0e-12):
+    # the same blanked pixels and the same values to within tolerance of
+    # the peak value, the default allows for rounding, 0 is exact
+    assert np.array_equal(np.isnan(ref), np.isnan(other))
+    good = np.isfinite(ref)
+    peak = np.max(np.abs(ref[good]))
+    assert np.max(np.abs(ref[good] - other[good])) <= tolerance * peak
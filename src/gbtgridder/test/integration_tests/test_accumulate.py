@@ -0,0 +1,110 @@
+import os
+
+from astropy.io import fits
+
+from .helpers import assert_close, run_args, run_gridder
+
+
+# test building up a map with --accumulate
+class TestAccumulate:
+    def setup_method(self):
+        # Path to the test directory.
+        self.test_file_dir = os.path.dirname(os.path.abspath(__file__))
+        # split normal.fits into two sessions
+        with fits.open(f"{self.test_file_dir}/normal.fits") as hdul:
+            table = hdul[1].data
+            half = len(table) // 2
+            for name, rows in [
+                ("test_session1.fits", slice(0, half)),
+                ("test_session2.fits", slice(half, None)),
+            ]:
+                session = fits.BinTableHDU(table[rows], header=hdul[1].header)
+                fits.HDUList([hdul[0].copy(), session]).writeto(name, overwrite=True)
+            # and one session of four scans
+            scans = fits.BinTableHDU(table, header=hdul[1].header)
+            scans.data["SCAN"] = [1 + (4 * i) // len(table) for i in range(len(table))]
+            fits.HDUList([hdul[0].copy(), scans]).writeto(
+                "test_scans.fits", overwrite=True
+            )
+
+    def teardown_method(self):
+        for name in [
+            "test_session1.fits",
+            "test_session2.fits",
+            "test_scans.fits",
+            "test_map.acc",
+            "test_first_cube.fits",
+            "test_first_weight.fits",
+        ]:
+            if os.path.exists(name):
+                os.remove(name)
+
+    def test_accumulate_matches_all(self):
+        # the first run sets the map, as --clonecube would
+        run_args(
+            "test_session1.fits",
+            ["-o", "test_first", "--accumulate", "test_map.acc"],
+        )
+        cube, weight = run_gridder(
+            "test_session2.fits", "test_second", ["--accumulate", "test_map.acc"]
+        )
+        with fits.open("test_map.acc") as hdul:
+            ingested = hdul["INGESTED"].data
+            assert len(ingested) == 2
+            assert os.path.basename(ingested["FILE"][1]) == "test_session2.fits"
+
+        # gridding all of the data onto the same map at once
+        run_args(
+            ["test_session1.fits", "test_session2.fits"],
+            ["-o", "test_all", "--clonecube", "test_first_cube.fits"],
+        )
+        allCube = fits.getdata("test_all_cube.fits")
+        allWeight = fits.getdata("test_all_weight.fits")
+        os.remove("test_all_cube.fits")
+        os.remove("test_all_weight.fits")
+        assert_close(allCube, cube)
+        assert_close(allWeight, weight)
+
+        # nothing is new now, and a changed file can not be added again
+        for sdfits in ["test_session2.fits", "test_session1.fits"]:
+            run_args(sdfits, ["-o", "test_third", "--accumulate", "test_map.acc"])
+            assert not os.path.exists("test_third_cube.fits")
+            os.utime(sdfits, ns=(0, 0))
+        with fits.open("test_map.acc") as hdul:
+            assert len(hdul["INGESTED"].data) == 2
+
+    def test_accumulate_scans(self, capsys):
+        # scans of a file already in the accumulator are added once each
+        run_args(
+            "test_scans.fits",
+            ["-o", "test_first", "--accumulate", "test_map.acc", "--scans", "1:2"],
+        )
+        cube, weight = run_gridder(
+            "test_scans.fits", "test_second", ["--accumulate", "test_map.acc"]
+        )
+        with fits.open("test_map.acc") as hdul:
+            ingested = hdul["INGESTED"].data
+            assert list(ingested["SCANS"]) == ["1:2", "3:4"]
+            assert ingested["NSPEC"].sum() == len(fits.getdata("test_scans.fits", 1))
+
+        run_args(
+            "test_scans.fits",
+            ["-o", "test_all", "--clonecube", "test_first_cube.fits"],
+        )
+        allCube = fits.getdata("test_all_cube.fits")
+        allWeight = fits.getdata("test_all_weight.fits")
+        os.remove("test_all_cube.fits")
+        os.remove("test_all_weight.fits")
+        assert_close(allCube, cube)
+        assert_close(allWeight, weight)
+
+        # every selected scan is in now
+        args = ["-o", "test_third", "--accumulate", "test_map.acc", "--scans", "2:4"]
+        run_args("test_scans.fits", args)
+        assert not os.path.exists("test_third_cube.fits")
+        # and scans that are not in the file are not new scans of it
+        capsys.readouterr()
+        args[-1] = "3:9"
+        run_args("test_scans.fits", args)
+        assert "already in the accumulator, skipping" in capsys.readouterr().out
+        assert not os.path.exists("test_third_cube.fits")
@@ -0,0 +1,23 @@
+import os
+
+from .helpers import assert_close, run_gridder
+
+
+# test the sparse gridding backend against cygrid
+class TestBackend:
+    def setup_method(self):
+        # Path to the test directory.
+        self.test_file_dir = os.path.dirname(os.path.abspath(__file__))
+
+    def test_sparse_matches_cygrid(self):
+        # the same pixel-spectrum pairs and kernel values, only the order
+        # of the sums differs.  Only the gauss kernel can be compared, the
+        # installed cygrid may not have gaussbessel.
+        for name in ["cygx_sdfits.fits", "normal.fits"]:
+            sdfits = f"{self.test_file_dir}/{name}"
+            cube, weight = run_gridder(sdfits, "test_cygrid", [])
+            cubeSparse, weightSparse = run_gridder(
+                sdfits, "test_sparse", ["--backend", "sparse"]
+            )
+            assert_close(cube, cubeSparse)
+            assert_close(weight, weightSparse)
@@ -0,0 +1,43 @@
+import os
+
+from astropy.io import fits
+
+from gbtgridder.beams import beam_fwhm_at
+
+from .helpers import assert_close, run_args, run_gridder
+
+
+# test gridding channel bands each with their own beam
+class TestBeams:
+    def setup_method(self):
+        # Path to the test directory.
+        self.test_file_dir = os.path.dirname(os.path.abspath(__file__))
+
+    def teardown_method(self):
+        for name in ["test_bands_cube.fits", "test_bands_weight.fits"]:
+            if os.path.exists(name):
+                os.remove(name)
+
+    def test_bands_match_single_beam(self):
+        # the two channels are 3.3e-5 apart in frequency so each is its own
+        # band.  Each should be the channel from a run with just that beam.
+        sdfits = f"{self.test_file_dir}/normal.fits"
+        mapArgs = ["--pixelwidth", "100", "--size", "40", "40"]
+        run_args(sdfits, ["-o", "test_bands", "--beam-tolerance", "1.0e-5"] + mapArgs)
+        with fits.open("test_bands_cube.fits") as hdul:
+            hdr = hdul[0].header
+            cube = hdul[0].data
+            beams = hdul["BEAMS"].data
+            assert hdr["CASAMBM"]
+            assert len(beams) == 2
+            assert beams["BMAJ"][0] != beams["BMAJ"][1]
+        weight = fits.getdata("test_bands_weight.fits")
+
+        for chan in range(2):
+            freq = hdr["CRVAL3"] + (chan + 1 - hdr["CRPIX3"]) * hdr["CDELT3"]
+            beamArgs = ["--beam_fwhm", repr(beam_fwhm_at(freq, 100.0))]
+            chanCube, chanWeight = run_gridder(
+                sdfits, "test_one_beam", beamArgs + mapArgs
+            )
+            assert_close(chanCube[:, chan], cube[:, chan])
+            assert_close(chanWeight[:, chan], weight[:, chan])
@@ -0,0 +1,49 @@
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from .helpers import run_args
+
+
+# test the CHANSTATS table and DATAMAX/DATAMIN written with the cube
+class TestCube_Stats:
+    def setup_method(self):
+        # Path to the test directory.
+        self.test_file_dir = os.path.dirname(os.path.abspath(__file__))
+
+    def teardown_method(self):
+        for name in ["test_stats", "test_stats_nowt"]:
+            for fileType in ["cube", "weight"]:
+                fileName = "%s_%s.fits" % (name, fileType)
+                if os.path.exists(fileName):
+                    os.remove(fileName)
+
+    def test_stats_match_cube(self):
+        # statistics gathered from the tiles as they are written match
+        # those of the finished cube
+        sdfits = f"{self.test_file_dir}/normal.fits"
+        mapArgs = ["--pixelwidth", "100", "--size", "40", "40"]
+        run_args(sdfits, ["-o", "test_stats", "--tile-size", "15"] + mapArgs)
+        with fits.open("test_stats_cube.fits") as hdul:
+            hdr = hdul[0].header
+            cube = hdul[0].data[0]
+            stats = hdul["CHANSTATS"].data
+        weight = fits.getdata("test_stats_weight.fits")[0]
+
+        assert hdr["DATAMAX"] == np.nanmax(cube)
+        assert hdr["DATAMIN"] == np.nanmin(cube)
+        assert np.array_equal(stats["NPIX"], np.sum(~np.isnan(cube), axis=(1, 2)))
+        assert np.array_equal(stats["MIN"], np.nanmin(cube, axis=(1, 2)))
+        assert np.array_equal(stats["MAX"], np.nanmax(cube, axis=(1, 2)))
+        assert np.allclose(stats["MEAN"], np.nanmean(cube, axis=(1, 2)), rtol=1e-12)
+        assert np.allclose(
+            stats["RMS"], np.sqrt(np.nanmean(cube**2, axis=(1, 2))), rtol=1e-12
+        )
+        assert np.allclose(stats["SUMWT"], np.nansum(weight, axis=(1, 2)), rtol=1e-12)
+
+        # the weights are summed without writing the weight cube
+        run_args(sdfits, ["-o", "test_stats_nowt", "--noweight"] + mapArgs)
+        assert not os.path.exists("test_stats_nowt_weight.fits")
+        with fits.open("test_stats_nowt_cube.fits") as hdul:
+            assert np.allclose(hdul["CHANSTATS"].data["SUMWT"], stats["SUMWT"])
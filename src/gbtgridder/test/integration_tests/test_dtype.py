@@ -0,0 +1,22 @@
+import os
+
+from .helpers import assert_close, run_gridder
+
+
+# test the accuracy of --dtype float32 against the default float64
+class TestDtype:
+    def setup_method(self):
+        # Path to the test directory.
+        self.test_file_dir = os.path.dirname(os.path.abspath(__file__))
+
+    def test_float32_accuracy(self):
+        # single precision accumulation in cygrid agrees with double precision
+        # to a few times 1e-7 of the peak value, 1e-5 leaves plenty of room.
+        sdfits = f"{self.test_file_dir}/cygx_sdfits.fits"
+        cube, weight = run_gridder(sdfits, "test_float64", [])
+        cube32, weight32 = run_gridder(sdfits, "test_float32", ["--dtype", "float32"])
+
+        assert cube32.dtype.itemsize == 4
+        assert weight32.dtype.itemsize == 4
+        assert_close(cube, cube32, tolerance=1.0e-5)
+        assert_close(weight, weight32, tolerance=1.0e-5)
@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from .helpers import run_args, run_gridder
+
+
+# test gridding several channel windows from one read of the data
+class TestLines:
+    def setup_method(self):
+        # Path to the test directory.
+        self.test_file_dir = os.path.dirname(os.path.abspath(__file__))
+        # normal.fits with 16 channels
+        with fits.open(f"{self.test_file_dir}/normal.fits") as hdul:
+            table = hdul[1]
+            data = table.data["DATA"]
+            wide = np.concatenate([data * (1.0 + 0.1 * k) for k in range(8)], axis=1)
+            columns = []
+            for column in table.columns:
+                if column.name == "DATA":
+                    column = fits.Column(
+                        name="DATA", format="16E", unit=column.unit, array=wide
+                    )
+                columns.append(column)
+            wideTable = fits.BinTableHDU.from_columns(columns, header=table.header)
+            fits.HDUList([hdul[0].copy(), wideTable]).writeto(
+                "test_wide.fits", overwrite=True
+            )
+
+    def teardown_method(self):
+        names = ["test_wide.fits"]
+        for line in ["A", "B"]:
+            names += [
+                "test_lines_%s_cube.fits" % line,
+                "test_lines_%s_weight.fits" % line,
+            ]
+        for name in names:
+            if os.path.exists(name):
+                os.remove(name)
+
+    def test_lines_match_windows(self):
+        # each line is the same as gridding its window on its own
+        mapArgs = ["--pixelwidth", "100", "--size", "40", "40"]
+        run_args(
+            "test_wide.fits",
+            ["-o", "test_lines", "--line", "A:2:6", "--line", "B:8:15:1420.5:3"]
+            + mapArgs,
+        )
+        for line, windowArgs in [
+            ("A", ["-c", "2:6"]),
+            ("B", ["-c", "8:15", "-a", "3", "--restfreq", "1420.5"]),
+        ]:
+            cube, weight = run_gridder(
+                "test_wide.fits", "test_window", windowArgs + mapArgs
+            )
+            with fits.open("test_lines_%s_cube.fits" % line) as hdul:
+                assert np.array_equal(hdul[0].data, cube, equal_nan=True)
+                if line == "B":
+                    assert hdul[0].header["RESTFRQ"] == 1420.5e6
+                    assert hdul[0].data.shape[1] == 2
+            assert np.array_equal(
+                fits.getdata("test_lines_%s_weight.fits" % line), weight
+            )
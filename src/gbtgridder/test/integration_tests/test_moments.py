@@ -0,0 +1,59 @@
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from gbtgridder.moments import channel_velocities
+
+from .helpers import run_args
+
+
+# test the moment, peak and noise maps written with the cube
+class TestMoments:
+    def setup_method(self):
+        # Path to the test directory.
+        self.test_file_dir = os.path.dirname(os.path.abspath(__file__))
+
+    def teardown_method(self):
+        for name in ["test_moments", "test_moments_tiles"]:
+            for fileType in ["cube", "weight", "mom0", "mom1", "mom2", "peak", "noise"]:
+                fileName = "%s_%s.fits" % (name, fileType)
+                if os.path.exists(fileName):
+                    os.remove(fileName)
+
+    def test_maps_match_cube(self):
+        # the maps added up as the cube is written match those made from
+        # the finished cube, whether it is written in slabs or in tiles
+        sdfits = f"{self.test_file_dir}/normal.fits"
+        mapArgs = ["--pixelwidth", "100", "--size", "40", "40"]
+        mapArgs += ["--signal", "1:2", "--line-free", "2:2"]
+        run_args(sdfits, ["-o", "test_moments"] + mapArgs)
+        run_args(sdfits, ["-o", "test_moments_tiles", "--tile-size", "15"] + mapArgs)
+        with fits.open("test_moments_cube.fits") as hdul:
+            hdr = hdul[0].header
+            cube = hdul[0].data[0].astype(np.float64)
+        velocity = channel_velocities(hdr, 2, "RADI")
+        dv = np.abs(velocity[1] - velocity[0])
+        s0 = np.sum(cube, axis=0) * dv
+        s1 = np.sum(cube * velocity[:, None, None], axis=0) * dv
+        positive = s0 > 0
+        expected = {
+            "mom0": s0,
+            "mom1": np.where(positive, s1 / np.where(positive, s0, 1.0), np.nan),
+            "peak": np.max(cube, axis=0),
+            "noise": np.abs(cube[1]),
+        }
+        for name in ["test_moments", "test_moments_tiles"]:
+            for product, image in expected.items():
+                with fits.open("%s_%s.fits" % (name, product)) as hdul:
+                    mapHdr = hdul[0].header
+                    data = hdul[0].data
+                assert data.shape == (1, 1, 40, 40)
+                assert np.allclose(data[0, 0], image, rtol=1e-6, equal_nan=True)
+                assert mapHdr["NAXIS3"] == 1
+                assert mapHdr["DATAMAX"] == np.nanmax(data)
+        assert fits.getheader("test_moments_mom0.fits")["BUNIT"] == "K km/s"
+        assert fits.getheader("test_moments_mom1.fits")["BUNIT"] == "km/s"
+        assert fits.getheader("test_moments_noise.fits")["CRVAL3"] == (
+            hdr["CRVAL3"] + hdr["CDELT3"]
+        )
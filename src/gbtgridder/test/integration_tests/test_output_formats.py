@@ -0,0 +1,51 @@
+import os
+import shutil
+
+import numpy as np
+from astropy.io import fits
+
+from gbtgridder.output_formats import read_store
+
+from .helpers import run_args
+
+
+# test writing the compressed and chunked copies of the output cubes
+class TestOutput_Formats:
+    def setup_method(self):
+        # Path to the test directory.
+        self.test_file_dir = os.path.dirname(os.path.abspath(__file__))
+
+    def teardown_method(self):
+        for name in ["test_formats_cube", "test_formats_weight"]:
+            for suffix in [".fits", ".fits.fz"]:
+                if os.path.exists(name + suffix):
+                    os.remove(name + suffix)
+            if os.path.exists(name + ".zarr"):
+                shutil.rmtree(name + ".zarr")
+
+    def test_copies_match_cubes(self):
+        sdfits = f"{self.test_file_dir}/normal.fits"
+        run_args(
+            sdfits,
+            [
+                "-o",
+                "test_formats",
+                "--compress",
+                "gzip",
+                "--chunked",
+                "--chunk-shape",
+                "1",
+                "16",
+                "16",
+            ],
+        )
+        for fileType in ["cube", "weight"]:
+            name = "test_formats_" + fileType
+            with fits.open(name + ".fits") as hdul:
+                data = hdul[0].data
+                hdr = hdul[0].header
+            with fits.open(name + ".fits.fz") as hdul:
+                assert np.array_equal(hdul[1].data, data, equal_nan=True)
+                assert hdul[1].header["DATAMAX"] == hdr["DATAMAX"]
+                assert hdul[1].tile_shape == (1, 1, 16, 16)
+            assert np.array_equal(read_store(name + ".zarr"), data[0], equal_nan=True)
@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from .helpers import run_args, run_gridder
+
+
+# test gridding each polarization separately from one file
+class TestPartitions:
+    def setup_method(self):
+        # Path to the test directory.
+        self.test_file_dir = os.path.dirname(os.path.abspath(__file__))
+        # normal.fits as XX, and YY with different data and tsys at the same
+        # positions, in one file with the two polarizations interleaved and
+        # in a file of their own
+        with fits.open(f"{self.test_file_dir}/normal.fits") as hdul:
+            table = hdul[1].data
+            rows = np.repeat(np.arange(len(table)), 2)
+            dual = fits.BinTableHDU(table[rows], header=hdul[1].header)
+            data = dual.data
+            data["CRVAL4"][0::2] = -5
+            data["CRVAL4"][1::2] = -6
+            data["DATA"][1::2] = 2.0 * data["DATA"][1::2] + 1.0
+            data["TSYS"][1::2] *= 1.3
+            fits.HDUList([hdul[0].copy(), dual]).writeto(
+                "test_dual.fits", overwrite=True
+            )
+            yy = fits.BinTableHDU(data[1::2], header=hdul[1].header)
+            fits.HDUList([hdul[0].copy(), yy]).writeto("test_yy.fits", overwrite=True)
+
+    def teardown_method(self):
+        for name in ["test_dual.fits", "test_yy.fits"]:
+            if os.path.exists(name):
+                os.remove(name)
+        for pol in ["XX", "YY", "I"]:
+            for fileType in ["cube", "weight"]:
+                name = "test_pol_%s_%s.fits" % (pol, fileType)
+                if os.path.exists(name):
+                    os.remove(name)
+
+    def test_pol_partitions(self):
+        # each polarization is the same as gridding it on its own
+        xx, xxWeight = run_gridder(f"{self.test_file_dir}/normal.fits", "test_xx", [])
+        yy, yyWeight = run_gridder("test_yy.fits", "test_yy", [])
+        for extraArgs in [[], ["--stream"]]:
+            run_args(
+                "test_dual.fits",
+                ["-o", "test_pol", "--partition", "pol", "--stokes-i"] + extraArgs,
+            )
+            for pol, cube, weight in [("XX", xx, xxWeight), ("YY", yy, yyWeight)]:
+                with fits.open("test_pol_%s_cube.fits" % pol) as hdul:
+                    assert hdul[0].header["CRVAL4"] == {"XX": -5, "YY": -6}[pol]
+                    assert np.array_equal(hdul[0].data, cube, equal_nan=True)
+                assert np.array_equal(
+                    fits.getdata("test_pol_%s_weight.fits" % pol), weight
+                )
+            with fits.open("test_pol_I_cube.fits") as hdul:
+                assert hdul[0].header["CRVAL4"] == 1
+                assert np.array_equal(hdul[0].data, 0.5 * (xx + yy), equal_nan=True)
+            assert np.array_equal(
+                fits.getdata("test_pol_I_weight.fits"), xxWeight + yyWeight
+            )
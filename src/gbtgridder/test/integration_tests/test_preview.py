@@ -0,0 +1,46 @@
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from .helpers import run_args
+
+
+# test the quick look written by --preview
+class TestPreview:
+    def setup_method(self):
+        # Path to the test directory.
+        self.test_file_dir = os.path.dirname(os.path.abspath(__file__))
+
+    def teardown_method(self):
+        for name in ["test_preview", "test_preview_sample"]:
+            for fileType in ["cube", "weight", "preview", "hits"]:
+                fileName = "%s_%s.fits" % (name, fileType)
+                if os.path.exists(fileName):
+                    os.remove(fileName)
+
+    def test_preview(self):
+        sdfits = f"{self.test_file_dir}/normal.fits"
+        mapArgs = ["--pixelwidth", "100", "--preview"]
+        run_args(sdfits, ["-o", "test_preview", "--preview-binning", "4"] + mapArgs)
+        assert not os.path.exists("test_preview_cube.fits")
+        assert not os.path.exists("test_preview_weight.fits")
+        # the map holds all of the spectra, 214 x 214 pixels binned 4 x 4
+        nrows = len(fits.getdata(sdfits, 1))
+        with fits.open("test_preview_hits.fits") as hdul:
+            hits = hdul[0].data
+            assert hits.shape == (1, 1, 54, 54)
+            assert hits.sum() == nrows
+            assert hdul[0].header["CDELT2"] == 4 * 100 / 3600.0
+        with fits.open("test_preview_preview.fits") as hdul:
+            preview = hdul[0].data
+            assert preview.shape == (1, 1, 54, 54)
+            assert np.array_equal(np.isfinite(preview[0, 0]), hits[0, 0] > 0)
+            assert hdul[0].header["DATAMAX"] == np.nanmax(preview)
+
+        # reading fewer spectra changes the preview, not the hits
+        sampleArgs = ["--preview-sample", "3", "--preview-channels", "2"]
+        run_args(sdfits, ["-o", "test_preview_sample"] + sampleArgs + mapArgs)
+        assert np.array_equal(fits.getdata("test_preview_sample_hits.fits"), hits)
+        sampled = fits.getdata("test_preview_sample_preview.fits")
+        assert sampled.shape == (1, 2, 54, 54)
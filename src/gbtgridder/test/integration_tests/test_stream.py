@@ -0,0 +1,40 @@
+import os
+
+import numpy as np
+
+from .helpers import run_gridder
+
+
+# test gridding the spectra in chunks as they are read
+class TestStream:
+    def setup_method(self):
+        # Path to the test directory.
+        self.test_file_dir = os.path.dirname(os.path.abspath(__file__))
+
+    def test_stream_matches_memory(self):
+        sdfits = f"{self.test_file_dir}/cygx_sdfits.fits"
+        cube, weight = run_gridder(sdfits, "test_in_memory", [])
+        streamCube, streamWeight = run_gridder(
+            sdfits, "test_stream", ["--stream", "--chunkrows", "700"]
+        )
+        assert np.allclose(cube, streamCube, equal_nan=True)
+        assert np.allclose(weight, streamWeight, equal_nan=True)
+
+
+# test gridding the spectral axis in slabs of channels
+class TestSlabs:
+    def setup_method(self):
+        # Path to the test directory.
+        self.test_file_dir = os.path.dirname(os.path.abspath(__file__))
+
+    def test_slabs_match_single_grid(self):
+        # this budget only fits one channel of the 86x86 cygx image at a time
+        sdfits = f"{self.test_file_dir}/cygx_sdfits.fits"
+        cube, weight = run_gridder(sdfits, "test_one_grid", [])
+        for extraArgs in [
+            ["--max-memory", "0.0005"],
+            ["--max-memory", "0.0005", "--stream"],
+        ]:
+            slabCube, slabWeight = run_gridder(sdfits, "test_slabs", extraArgs)
+            assert np.array_equal(cube, slabCube, equal_nan=True)
+            assert np.array_equal(weight, slabWeight, equal_nan=True)
@@ -0,0 +1,24 @@
+import os
+
+from .helpers import assert_close, run_gridder
+
+
+# test gridding blocks of channels in several threads
+class TestThreads:
+    def setup_method(self):
+        # Path to the test directory.
+        self.test_file_dir = os.path.dirname(os.path.abspath(__file__))
+
+    def test_threads_match_serial(self):
+        # each channel is gridded on its own, so the blocks give exactly
+        # the same result as one gridder for all the channels
+        sdfits = f"{self.test_file_dir}/cygx_sdfits.fits"
+        for backend in ["cygrid", "sparse"]:
+            for extraArgs in [[], ["--stream", "--chunkrows", "700"]]:
+                extraArgs = ["--backend", backend] + extraArgs
+                cube, weight = run_gridder(sdfits, "test_serial", extraArgs)
+                threadCube, threadWeight = run_gridder(
+                    sdfits, "test_threads", extraArgs + ["--threads", "3"]
+                )
+                assert_close(cube, threadCube, tolerance=0.0)
+                assert_close(weight, threadWeight, tolerance=0.0)
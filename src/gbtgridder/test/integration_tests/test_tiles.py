@@ -0,0 +1,67 @@
+import os
+import shlex
+
+from astropy.io import fits
+
+from .helpers import assert_close, run_args, run_gridder
+
+
+# test gridding the map in tiles
+class TestTiles:
+    def setup_method(self):
+        # Path to the test directory.
+        self.test_file_dir = os.path.dirname(os.path.abspath(__file__))
+
+    def teardown_method(self):
+        if os.path.exists("test_tile_tasks.txt"):
+            os.remove("test_tile_tasks.txt")
+
+    def test_tiles_match_whole_map(self):
+        # a tile has the same pixel-spectrum pairs as the whole map, only the
+        # pixel positions may differ by rounding.  The blanked pixels must be
+        # exactly the same.
+        sdfits = f"{self.test_file_dir}/normal.fits"
+        cube, weight = run_gridder(sdfits, "test_whole_map", [])
+        for extraArgs in [
+            ["--tile-size", "20"],
+            ["--tile-size", "20", "--jobs", "2"],
+            ["--tile-size", "32", "--stream", "--chunkrows", "700"],
+        ]:
+            tileCube, tileWeight = run_gridder(sdfits, "test_tiles", extraArgs)
+            assert_close(cube, tileCube)
+            assert_close(weight, tileWeight)
+
+        # one tile on its own is that part of the whole map
+        run_args(sdfits, ["-o", "test_one", "--tile-size", "50", "--tile", "4"])
+        tileCube = fits.getdata("test_one_tile004_cube.fits")
+        os.remove("test_one_tile004_cube.fits")
+        os.remove("test_one_tile004_weight.fits")
+        assert tileCube.shape == cube.shape[:2] + (50, 50)
+        assert_close(cube[..., 50:100, 50:100], tileCube)
+
+    def test_tile_tasks(self):
+        # the task list has one command per tile and nothing is gridded
+        sdfits = f"{self.test_file_dir}/normal.fits"
+        run_args(
+            sdfits,
+            [
+                "-o",
+                "test_tasks",
+                "--tile-size",
+                "50",
+                "--tile-tasks",
+                "test_tile_tasks.txt",
+            ],
+        )
+
+        with open("test_tile_tasks.txt") as f:
+            commands = f.read().splitlines()
+        # the map is 124 x 124 pixels
+        assert len(commands) == 9
+        assert commands[8].endswith("--tile-size 50 --tile 8")
+        assert "--autoConfirm" in commands[8]
+        # the tasks can be run from any directory
+        command = shlex.split(commands[8])
+        assert command[1] == sdfits
+        assert command[command.index("--output") + 1] == os.path.abspath("test_tasks")
+        assert not os.path.exists("test_tasks_cube.fits")
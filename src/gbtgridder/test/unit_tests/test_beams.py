@@ -0,0 +1,43 @@
+import numpy as np
+
+from gbtgridder.beams import band_beam_fwhm, band_slabs, beam_bands, beam_table
+
+
+# test the channel bands of beams.py
+class TestBeams:
+    def test_beam_bands(self):
+        # the frequency changes by 0.1% per channel
+        faxis = 1.0e9 * (1.0 + 0.001 * np.arange(10))
+        bands = beam_bands(faxis, 0.0025)
+        assert bands == [(0, 3), (3, 6), (6, 9), (9, 10)]
+        for b0, b1 in bands:
+            assert faxis[b1 - 1] <= 1.0025 * faxis[b0]
+        # the order of the channels doesn't matter
+        assert beam_bands(faxis[::-1], 0.0025) == bands
+        assert beam_bands(faxis, 1.0) == [(0, 10)]
+        assert len(beam_bands(faxis, 1.0e-6)) == 10
+
+        # the band beam is in the middle of the beams of its channels
+        beam = band_beam_fwhm(faxis, (0, 3), 100.0)
+        lowest = band_beam_fwhm(faxis, (2, 3), 100.0)
+        highest = band_beam_fwhm(faxis, (0, 1), 100.0)
+        assert lowest < beam < highest
+        assert np.isclose(beam, 0.5 * (lowest + highest), rtol=1.0e-15)
+
+    def test_band_slabs(self):
+        slabs = [(0, 4), (4, 8), (8, 10)]
+        bands = [(0, 3), (3, 10)]
+        assert band_slabs(slabs, bands) == [
+            (0, 3, 0),
+            (3, 4, 1),
+            (4, 8, 1),
+            (8, 10, 1),
+        ]
+
+    def test_beam_table(self):
+        table = beam_table([(0, 2), (2, 5)], [0.1, 0.2], 5)
+        assert table.name == "BEAMS"
+        assert table.header["NCHAN"] == 5
+        assert np.allclose(table.data["BMAJ"], [360.0, 360.0, 720.0, 720.0, 720.0])
+        assert np.array_equal(table.data["BMAJ"], table.data["BMIN"])
+        assert np.array_equal(table.data["CHAN"], np.arange(5))
@@ -1,7 +1,7 @@
 import numpy as np
 import pytest
 
-from gbtgridder.boxcar import boxcar
+from gbtgridder.boxcar import SMOOTH_KERNELS, boxcar, smooth, smooth_kernel
 
 
 # test the parse_channels function in gbtgridder.py
@@ -50,3 +50,65 @@ class TestBoxcar:
         width = 50
         with pytest.raises(ValueError):
             boxcar(dataArray, freqAxis, width)
+
+    def test_matches_convolve_boxcar(self):
+        # the batched boxcar gives the per-spectrum convolve result
+        dataArray = np.random.random((20, 43)).astype(np.float32)
+        dataArray[3, 10] = np.nan
+        freqAxis = np.arange(43.0)
+        width = 4
+        box = np.ones(width) / width
+        expected = np.array(
+            [np.convolve(box, row, mode="valid")[0:-1:width] for row in dataArray]
+        )
+        data, freq = boxcar(dataArray, freqAxis, width)
+        assert data.dtype == np.float32
+        assert np.allclose(data, expected, rtol=1e-6, equal_nan=True)
+        assert (
+            np.isnan(data[3, 2]) and np.isfinite(data[3, 1]) and np.isfinite(data[3, 3])
+        )
+        assert np.array_equal(freq, freqAxis[0 : 4 * 10 : 4] + 1.5)
+
+    def test_out_boxcar(self):
+        dataArray = np.random.random((20, 40))
+        out = np.empty((20, 9))
+        data, freq = boxcar(dataArray, np.arange(40.0), 4, out=out)
+        assert data is out
+        assert np.allclose(out, dataArray[:, :36].reshape(20, 9, 4).mean(axis=2))
+        with pytest.raises(ValueError):
+            boxcar(dataArray, np.arange(40.0), 4, out=np.empty((20, 10)))
+
+    def test_smooth_kernels(self):
+        for kernel in SMOOTH_KERNELS:
+            for width in range(1, 7):
+                taps = smooth_kernel(kernel, width)
+                # symmetric about the box center and normalized
+                assert len(taps) % 2 == width % 2
+                assert np.allclose(taps, taps[::-1])
+                assert np.isclose(taps.sum(), 1.0)
+        # cos^2 taps at 0, 1 and 2 channels from the center of a 3 channel box
+        assert np.allclose(smooth_kernel("hanning", 3)[1:-1], [0.25, 1.0 / 3.0, 0.25])
+        with pytest.raises(ValueError):
+            smooth_kernel("triangle", 3)
+
+    def test_smooth(self):
+        dataArray = np.random.random((5, 43))
+        freqAxis = np.arange(43.0)
+        for kernel in SMOOTH_KERNELS:
+            for width in [2, 3, 4]:
+                data, freq = smooth(dataArray, freqAxis, width, kernel=kernel)
+                nout = (43 - 1) // width
+                assert data.shape == (5, nout)
+                # same channels and frequency axis as boxcar
+                assert np.array_equal(freq, boxcar(dataArray, freqAxis, width)[1])
+                # a constant is unchanged, including at the edges
+                flat, _ = smooth(np.ones((2, 43)), freqAxis, width, kernel=kernel)
+                assert np.allclose(flat, 1.0)
+                # compare to a direct, renormalized sum for each output channel
+                taps = smooth_kernel(kernel, width)
+                first = (width - len(taps)) // 2
+                for k in range(nout):
+                    chans = k * width + first + np.arange(len(taps))
+                    use = (chans >= 0) & (chans < 43)
+                    expected = dataArray[:, chans[use]] @ taps[use] / taps[use].sum()
+                    assert np.allclose(data[:, k], expected, rtol=1e-5)
@@ -0,0 +1,123 @@
+import os
+import shutil
+
+import numpy as np
+
+from gbtgridder.cache import trim_cache
+from gbtgridder.get_data import get_data
+
+# the SDFITS files used by the integration tests
+sdfits_dir = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "integration_tests"
+)
+
+
+# test the ingestion cache in cache.py, used through get_data
+class TestCache:
+    def setup_method(self, method):
+        self.cacheDir = os.path.join(sdfits_dir, "test_cache_%s" % method.__name__)
+        shutil.rmtree(self.cacheDir, ignore_errors=True)
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.cacheDir, ignore_errors=True)
+
+    def copy_sdfits(self, name):
+        # a private copy that the test can touch
+        os.makedirs(self.cacheDir, exist_ok=True)
+        copyFile = os.path.join(self.cacheDir, name)
+        shutil.copy(os.path.join(sdfits_dir, name), copyFile)
+        return copyFile
+
+    def test_same_result(self):
+        sdfitsFile = os.path.join(sdfits_dir, "normal.fits")
+        args = (0, None, None, None, None, 200.0)
+        expected = get_data(sdfitsFile, *args, verbose=0)
+        first = get_data(sdfitsFile, *args, verbose=0, cacheDir=self.cacheDir)
+        assert len(os.listdir(self.cacheDir)) == 1
+        cached = get_data(sdfitsFile, *args, verbose=0, cacheDir=self.cacheDir)
+        for result in [first, cached]:
+            assert sorted(result.keys()) == sorted(expected.keys())
+            for key in expected:
+                if isinstance(expected[key], np.ndarray):
+                    isFloat = expected[key].dtype.kind == "f"
+                    assert np.array_equal(result[key], expected[key], equal_nan=isFloat)
+                else:
+                    assert result[key] == expected[key]
+
+        # the metadata pass is answered by the same entry
+        info = get_data(
+            sdfitsFile, *args, getdata=False, verbose=0, cacheDir=self.cacheDir
+        )
+        assert info["data"] is None
+        assert "obstimes" not in info
+        assert np.array_equal(info["rows"], expected["rows"])
+        assert len(os.listdir(self.cacheDir)) == 1
+
+        # and the spectra can be copied into a preallocated array
+        out = np.empty(expected["data"].shape)
+        cached = get_data(sdfitsFile, *args, verbose=0, out=out, cacheDir=self.cacheDir)
+        assert cached["data"] is out
+        assert np.array_equal(out, expected["data"], equal_nan=True)
+
+    def test_selection_and_changed_file(self):
+        sdfitsFile = self.copy_sdfits("cygx_sdfits.fits")
+        get_data(
+            sdfitsFile, 0, 0, None, None, None, None, verbose=0, cacheDir=self.cacheDir
+        )
+        get_data(
+            sdfitsFile, 1, 1, None, None, None, None, verbose=0, cacheDir=self.cacheDir
+        )
+        entries = [
+            name for name in os.listdir(self.cacheDir) if name != "cygx_sdfits.fits"
+        ]
+        assert len(entries) == 2
+
+        # a changed file does not use the old entries
+        stat = os.stat(sdfitsFile)
+        os.utime(sdfitsFile, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        get_data(
+            sdfitsFile, 0, 0, None, None, None, None, verbose=0, cacheDir=self.cacheDir
+        )
+        entries = [
+            name for name in os.listdir(self.cacheDir) if name != "cygx_sdfits.fits"
+        ]
+        assert len(entries) == 3
+
+    def test_trim(self):
+        sdfitsFile = os.path.join(sdfits_dir, "cygx_sdfits.fits")
+        for chan in [0, 1]:
+            get_data(
+                sdfitsFile,
+                chan,
+                chan,
+                None,
+                None,
+                None,
+                None,
+                verbose=0,
+                cacheDir=self.cacheDir,
+            )
+        # use the channel 0 entry again, so channel 1 is the least recently used
+        entries = sorted(os.listdir(self.cacheDir))
+        for name in entries:
+            os.utime(os.path.join(self.cacheDir, name, "manifest.json"), (1, 1))
+        get_data(
+            sdfitsFile, 0, 0, None, None, None, None, verbose=0, cacheDir=self.cacheDir
+        )
+
+        assert trim_cache(self.cacheDir, 1e12) == 0
+        entrySize = sum(
+            [
+                os.path.getsize(os.path.join(self.cacheDir, entries[0], f))
+                for f in os.listdir(os.path.join(self.cacheDir, entries[0]))
+            ]
+        )
+        assert trim_cache(self.cacheDir, 1.5 * entrySize) == 1
+        remaining = os.listdir(self.cacheDir)
+        assert len(remaining) == 1
+        # the remaining entry is for channel 0
+        data = get_data(
+            sdfitsFile, 0, 0, None, None, None, None, verbose=0, cacheDir=self.cacheDir
+        )
+        assert data["chanStop"] == 0
+        assert os.listdir(self.cacheDir) == remaining
@@ -0,0 +1,61 @@
+import numpy as np
+
+from gbtgridder.cube_stats import (
+    add_stats,
+    block_stats,
+    new_stats,
+    stats_range,
+    stats_table,
+)
+
+
+# test the per-channel statistics of the output cubes in cube_stats.py
+class TestCube_Stats:
+    def setup_method(self):
+        rng = np.random.default_rng(8)
+        self.cube = rng.normal(size=(6, 10, 12))
+        self.cube[1, 3:7, 2] = np.nan
+        self.cube[4] = np.nan
+
+    def test_block_stats(self):
+        stats = block_stats(self.cube)
+        good = ~np.isnan(self.cube)
+        assert np.array_equal(stats["npix"], good.sum(axis=(1, 2)))
+        assert np.allclose(stats["sum"], np.nansum(self.cube, axis=(1, 2)))
+        assert np.allclose(stats["sumsq"], np.nansum(self.cube**2, axis=(1, 2)))
+        assert np.isnan(stats["max"][4]) and stats["npix"][4] == 0
+        for chan in [0, 1, 2, 3, 5]:
+            assert stats["max"][chan] == np.nanmax(self.cube[chan])
+            assert stats["min"][chan] == np.nanmin(self.cube[chan])
+        assert stats_range(stats) == (np.nanmax(self.cube), np.nanmin(self.cube))
+
+    def test_tiles_and_slabs(self):
+        # adding the blocks of the tiles of channel slabs gives the
+        # statistics of the whole cube
+        stats = new_stats(6)
+        for c0, c1 in [(0, 4), (4, 6)]:
+            for y0, y1, x0, x1 in [(0, 10, 0, 5), (0, 4, 5, 12), (4, 10, 5, 12)]:
+                add_stats(stats, c0, block_stats(self.cube[c0:c1, y0:y1, x0:x1]))
+        whole = block_stats(self.cube)
+        for key in ["npix", "min", "max"]:
+            assert np.array_equal(stats[key], whole[key], equal_nan=True)
+        for key in ["sum", "sumsq"]:
+            assert np.allclose(stats[key], whole[key])
+
+    def test_all_nan(self):
+        stats = block_stats(np.full((3, 2, 2), np.nan))
+        assert np.all(np.isnan(stats_range(stats)))
+        assert np.all(np.isnan(stats_range(new_stats(0))))
+
+    def test_table(self):
+        weights = np.abs(self.cube) + 1.0
+        table = stats_table(block_stats(self.cube), "K", block_stats(weights))
+        assert table.name == "CHANSTATS"
+        assert table.columns["RMS"].unit == "K"
+        data = table.data
+        assert np.array_equal(data["CHAN"], np.arange(6))
+        assert np.allclose(data["MEAN"][0], np.mean(self.cube[0]))
+        assert np.allclose(data["RMS"][1], np.sqrt(np.nanmean(self.cube[1] ** 2)))
+        assert np.isnan(data["MEAN"][4]) and np.isnan(data["RMS"][4])
+        assert np.allclose(data["SUMWT"], np.nansum(weights, axis=(1, 2)))
+        assert "SUMWT" not in stats_table(block_stats(self.cube), "K").columns.names
@@ -0,0 +1,68 @@
+import os
+
+import astropy.time as apTime
+import numpy as np
+from astropy.io import fits
+
+from gbtgridder.get_data import (
+    data_window_view,
+    get_data,
+    obstimes_jd,
+    read_data_window,
+)
+
+# the SDFITS files used by the integration tests
+sdfits_dir = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "integration_tests"
+)
+
+
+# test the direct channel-window reads in get_data.py
+class TestRead_Data_Window:
+    def setup_method(self):
+        self.sdfits = os.path.join(sdfits_dir, "normal.fits")
+
+    def test_window_matches_field(self):
+        # a channel window of a non-contiguous row selection must match
+        # slicing the DATA field read through astropy
+        rows = np.concatenate((np.arange(10, 50), np.arange(100, 101), [3000]))
+        with fits.open(self.sdfits, memmap=True) as hdul:
+            view = data_window_view(hdul[1])
+            assert view is not None
+            assert view.dtype.byteorder == ">"
+            window = read_data_window(view, rows, 1, 1)
+            expected = hdul[1].data.field("data")[rows, 1:2]
+        assert window.dtype.isnative
+        assert np.array_equal(window, expected, equal_nan=True)
+
+    def test_window_into_out(self):
+        # values are written into a supplied array, converting the type
+        out = np.zeros((5, 2), dtype=np.float64)
+        with fits.open(self.sdfits, memmap=True) as hdul:
+            view = data_window_view(hdul[1])
+            result = read_data_window(view, np.arange(5), 0, 1, out=out)
+            expected = hdul[1].data.field("data")[:5]
+        assert result is out
+        assert np.array_equal(out, expected.astype(np.float64), equal_nan=True)
+
+    def test_get_data_channel_selection(self):
+        # get_data uses the window reader for its channel selection
+        result = get_data(self.sdfits, 1, 1, None, [0], None, None)
+        assert result["data"].shape == (3600, 1)
+        with fits.open(self.sdfits) as hdul:
+            expected = hdul[1].data.field("data")[:, 1:2]
+        assert np.array_equal(result["data"], expected, equal_nan=True)
+
+
+# test the timestamps returned by get_data
+class TestObs_Times:
+    def test_obstimes_jd(self):
+        sdfits = os.path.join(sdfits_dir, "normal.fits")
+        result = get_data(sdfits, 0, None, None, None, None, None, verbose=0)
+        dateObs = fits.getdata(sdfits).field("date-obs")
+        assert np.array_equal(result["obstimes"], dateObs)
+        expected = apTime.Time(dateObs, format="isot", scale="utc").jd
+        assert np.array_equal(obstimes_jd(result["obstimes"]), expected)
+
+        info = get_data(sdfits, 0, None, None, None, None, None, getdata=False)
+        assert "obstimes" not in info
@@ -0,0 +1,263 @@
+import time
+import tracemalloc
+
+import numpy as np
+from astropy import wcs
+
+import gbtgridder.grid_otf
+from gbtgridder.grid_otf import (
+    channel_weights,
+    grid_otf,
+    nan_mask,
+    normalize_cube,
+    row_weights,
+    zero_nans,
+)
+
+
+def small_map(nspec=300, nchan=6, nx=12, seed=3):
+    # random spectra over a small map of 1 arcmin pixels, with some NaN values
+    pixScale = 1.0 / 60.0
+    wcsObj = wcs.WCS(naxis=3)
+    wcsObj.wcs.ctype = ["RA---SFL", "DEC--SFL", "FREQ"]
+    wcsObj.wcs.crval = [180.0, 30.0, 1.4e9]
+    wcsObj.wcs.crpix = [(nx + 1) / 2.0, (nx + 1) / 2.0, 1.0]
+    wcsObj.wcs.cdelt = [-pixScale, pixScale, 1.0e4]
+    rng = np.random.default_rng(seed)
+    halfSize = nx * pixScale / 2.0
+    glat = 30.0 + rng.uniform(-halfSize, halfSize, nspec)
+    glon = 180.0 + rng.uniform(-halfSize, halfSize, nspec) / np.cos(np.radians(glat))
+    spec = rng.normal(size=(nspec, nchan))
+    spec[5, 2] = np.nan
+    spec[17, :] = np.nan
+    spec[40:60, 4] = np.nan
+    weights = rng.uniform(0.5, 1.5, nspec)
+    return (spec, glon, glat, weights, wcsObj, pixScale)
+
+
+def masked_normalize(data_cube, weights_cube):
+    # the numpy.ma division normalize_cube used to do
+    data_cube = np.ma.masked_invalid(data_cube)
+    weights_cube = np.ma.masked_invalid(weights_cube)
+    data_cube /= weights_cube
+    return (data_cube.filled(np.nan), weights_cube.filled(np.nan))
+
+
+def run_grid(spec, glon, glat, weights, wcsObj, pixScale, backend, nx=12, nanMask=None):
+    beamFwhm = 3.0 * pixScale
+    return grid_otf(
+        spec,
+        nx,
+        nx,
+        glon,
+        glat,
+        wcsObj,
+        pixScale,
+        180.0,
+        30.0,
+        beamFwhm,
+        weights,
+        "gauss",
+        beamFwhm / 3.0,
+        0,
+        backend=backend,
+        nanMask=nanMask,
+    )
+
+
+# test the weights used by grid_otf
+class TestGrid_Otf:
+    def test_row_weights(self):
+        spec = np.arange(12.0).reshape(4, 3)
+        outSpec, weight_array, nanMask = row_weights(spec, None)
+        assert outSpec is spec
+        assert np.array_equal(weight_array, np.ones(4))
+        assert nanMask is None
+
+        spec[1, 2] = np.nan
+        spec[3, 0] = np.nan
+        outSpec, weight_array, nanMask = row_weights(spec, np.arange(4))
+        assert np.isnan(spec[1, 2])
+        assert not np.any(np.isnan(outSpec))
+        assert outSpec[1, 2] == 0.0
+        assert weight_array.shape == (4,)
+        assert np.array_equal(np.transpose(nanMask.nonzero()), [[1, 2], [3, 0]])
+
+        # per-channel weights are zeroed where the data are NaN
+        weights2d = np.ones((4, 3))
+        outSpec, weight_array, nanMask = row_weights(spec, weights2d)
+        assert weights2d[1, 2] == 1.0
+        assert weight_array[1, 2] == 0.0 and weight_array[3, 0] == 0.0
+        assert weight_array.sum() == 10.0
+
+    def test_channel_weights(self):
+        spec = np.ones((5, 4))
+        spec[2, 1] = np.nan
+        spec, weight_array, nanMask = row_weights(spec, np.arange(1.0, 6.0))
+        block = channel_weights(weight_array, nanMask, 1, 4, 1, 3)
+        assert np.array_equal(block, [[2.0, 2.0], [0.0, 3.0], [4.0, 4.0]])
+
+    def test_per_spectrum_weights(self):
+        # one weight per spectrum grids the same as the same weight repeated
+        # for every channel, and NaN values are blanked the same way
+        spec, glon, glat, weights, wcsObj, pixScale = small_map()
+        weights2d = np.repeat(weights[:, None], spec.shape[1], axis=1)
+        for backend in ["cygrid", "sparse"]:
+            cube, weight, fwhm = run_grid(
+                spec, glon, glat, weights, wcsObj, pixScale, backend
+            )
+            cube2d, weight2d, fwhm2d = run_grid(
+                spec, glon, glat, weights2d, wcsObj, pixScale, backend
+            )
+            assert np.array_equal(np.isnan(cube), np.isnan(cube2d))
+            assert np.allclose(cube, cube2d, rtol=1e-12, atol=0.0, equal_nan=True)
+            assert np.allclose(weight, weight2d, rtol=1e-12, atol=0.0, equal_nan=True)
+
+    def test_channel_range_weights(self):
+        # stacked spectra with one weight per row for each stack grid the
+        # same as those weights repeated for every channel
+        spec, glon, glat, weights, wcsObj, pixScale = small_map()
+        nchan = spec.shape[1]
+        stacked = np.concatenate([spec, 2.0 * spec[:, ::-1]], axis=1)
+        rangeWeights = np.stack([weights, weights[::-1]], axis=1)
+        weights2d = np.repeat(rangeWeights, nchan, axis=1)
+        block = channel_weights(
+            rangeWeights, None, 2, 4, nchan - 1, nchan + 1, 2 * nchan
+        )
+        assert np.array_equal(block, weights2d[2:4, nchan - 1 : nchan + 1])
+        for backend in ["cygrid", "sparse"]:
+            cube, weight, fwhm = run_grid(
+                stacked, glon, glat, rangeWeights, wcsObj, pixScale, backend
+            )
+            cube2d, weight2d, fwhm2d = run_grid(
+                stacked, glon, glat, weights2d, wcsObj, pixScale, backend
+            )
+            assert np.array_equal(np.isnan(cube), np.isnan(cube2d))
+            assert np.allclose(cube, cube2d, rtol=1e-12, atol=0.0, equal_nan=True)
+            assert np.allclose(weight, weight2d, rtol=1e-12, atol=0.0, equal_nan=True)
+
+    def test_weight_blocks(self, monkeypatch):
+        # gridding in small row blocks gives the same cubes as one block
+        spec, glon, glat, weights, wcsObj, pixScale = small_map()
+        cube, weight, fwhm = run_grid(
+            spec, glon, glat, weights, wcsObj, pixScale, "cygrid"
+        )
+        monkeypatch.setattr(gbtgridder.grid_otf, "_WEIGHT_BLOCK_BYTES", 1000)
+        blockCube, blockWeight, blockFwhm = run_grid(
+            spec, glon, glat, weights, wcsObj, pixScale, "cygrid"
+        )
+        assert np.allclose(cube, blockCube, rtol=1e-12, atol=0.0, equal_nan=True)
+        assert np.allclose(weight, blockWeight, rtol=1e-12, atol=0.0, equal_nan=True)
+
+    def test_equal_weights(self):
+        # with no weights every spectrum has weight 1
+        spec, glon, glat, weights, wcsObj, pixScale = small_map()
+        cube, weight, fwhm = run_grid(
+            spec, glon, glat, None, wcsObj, pixScale, "cygrid"
+        )
+        cubeOnes, weightOnes, fwhmOnes = run_grid(
+            spec, glon, glat, np.ones(len(glon)), wcsObj, pixScale, "cygrid"
+        )
+        assert np.array_equal(weight, weightOnes, equal_nan=True)
+
+    def test_zero_nans(self):
+        # spectra with their NaN values set to 0 in place and the mask of
+        # where they were grid the same as the spectra with NaN values
+        spec, glon, glat, weights, wcsObj, pixScale = small_map()
+        zeroSpec = spec.copy()
+        nans = [(0,) + zero_nans(zeroSpec[:100]), (100,) + zero_nans(zeroSpec[100:])]
+        assert np.array_equal(zeroSpec, np.nan_to_num(spec))
+        nanMask = nan_mask(nans, spec.shape)
+        assert np.array_equal(nanMask.toarray() == 1, np.isnan(spec))
+        assert nan_mask([(0,) + zero_nans(zeroSpec)], spec.shape) is None
+        for backend in ["cygrid", "sparse"]:
+            cube, weight, fwhm = run_grid(
+                spec, glon, glat, weights, wcsObj, pixScale, backend
+            )
+            zeroCube, zeroWeight, zeroFwhm = run_grid(
+                zeroSpec,
+                glon,
+                glat,
+                weights,
+                wcsObj,
+                pixScale,
+                backend,
+                nanMask=nanMask,
+            )
+            assert np.array_equal(cube, zeroCube, equal_nan=True)
+            assert np.array_equal(weight, zeroWeight, equal_nan=True)
+
+    def test_normalize_cube(self):
+        # the in place division blanks the same pixels as numpy.ma did
+        rng = np.random.default_rng(5)
+        for dtype in [np.float64, np.float32]:
+            data = rng.normal(size=(4, 6, 7)).astype(dtype)
+            weights = rng.uniform(0.0, 2.0, size=(4, 6, 7)).astype(dtype)
+            weights[0, 0, :3] = 0.0
+            weights[1, 2, 2] = np.nan
+            weights[2, 3, 4] = np.inf
+            weights[3, 1, 1] = 1e-320 if dtype == np.float64 else 1e-44
+            data[0, 0, 2] = 0.0
+            data[1, 4, 4] = np.nan
+            # the tiny float32 weight overflows, as it did before
+            with np.errstate(over="ignore"):
+                expected = masked_normalize(data.copy(), weights.copy())
+                cube, weight = normalize_cube(data, weights)
+            assert cube is data and weight is weights
+            assert np.array_equal(cube, expected[0], equal_nan=True)
+            assert np.array_equal(weight, expected[1], equal_nan=True)
+
+    def test_normalize_memory(self):
+        # report the peak memory and time of normalizing a cube, in place
+        # this needs about one plane, numpy.ma needed several cubes
+        shape = (64, 128, 128)
+        rng = np.random.default_rng(6)
+        data = rng.normal(size=shape)
+        weights = rng.uniform(0.0, 2.0, size=shape)
+        weights[:, :10] = 0.0
+        cubeMB = data.nbytes / 1024.0**2
+        results = {}
+        for name, normalize in [
+            ("numpy.ma", masked_normalize),
+            ("in place", normalize_cube),
+        ]:
+            dataCopy, weightCopy = (data.copy(), weights.copy())
+            tracemalloc.start()
+            startTime = time.perf_counter()
+            normalize(dataCopy, weightCopy)
+            elapsed = time.perf_counter() - startTime
+            peak = tracemalloc.get_traced_memory()[1] / 1024.0**2
+            tracemalloc.stop()
+            results[name] = peak
+            print(
+                "normalize_cube %s: %.1f MB cube, peak %.2f MB, %.3f s"
+                % (name, cubeMB, peak, elapsed)
+            )
+        assert results["in place"] < 0.1 * cubeMB
+        assert results["numpy.ma"] > cubeMB
+
+    def test_nan_memory(self):
+        # report the peak memory and time of preparing spectra with NaN
+        # values for gridding, from a copy or from the loaders' mask
+        rng = np.random.default_rng(7)
+        spec = rng.normal(size=(8192, 128))
+        spec[rng.integers(0, 8192, 100), rng.integers(0, 128, 100)] = np.nan
+        weights = rng.uniform(0.5, 1.5, 8192)
+        specMB = spec.nbytes / 1024.0**2
+        zeroSpec = spec.copy()
+        nanMask = nan_mask([(0,) + zero_nans(zeroSpec)], spec.shape)
+        results = {}
+        for name, data, mask in [("copy", spec, None), ("mask", zeroSpec, nanMask)]:
+            tracemalloc.start()
+            startTime = time.perf_counter()
+            row_weights(data, weights, mask)
+            elapsed = time.perf_counter() - startTime
+            peak = tracemalloc.get_traced_memory()[1] / 1024.0**2
+            tracemalloc.stop()
+            results[name] = peak
+            print(
+                "row_weights from %s: %.1f MB spectra, peak %.2f MB, %.3f s"
+                % (name, specMB, peak, elapsed)
+            )
+        assert results["mask"] < 0.1 * specMB
+        assert results["copy"] > specMB
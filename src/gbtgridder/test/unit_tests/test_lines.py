@@ -0,0 +1,41 @@
+import numpy as np
+
+from gbtgridder.boxcar import smooth
+from gbtgridder.lines import fan_out, line_layout, parse_line
+
+
+# test the channel windows of --line in lines.py
+class TestLines:
+    def test_parse_line(self):
+        line = parse_line("NH3_11:101:300:23694.4955:4")
+        assert line == {
+            "name": "NH3_11",
+            "chanStart": 100,
+            "chanStop": 299,
+            "restfreq": 23694.4955e6,
+            "average": 4,
+        }
+        line = parse_line("H110a:1:10")
+        assert line["restfreq"] is None and line["average"] is None
+        assert parse_line("H110a:1:10::2")["average"] == 2
+        for bad in ["H110a:1", "H110a:10:1", "H110a:0:10", "a/b:1:10", "x:1:10:y"]:
+            assert parse_line(bad) is None
+
+    def test_fan_out(self):
+        # the lines of a block of spectra are those of each window on its own
+        lines = [parse_line("A:3:6"), parse_line("B:9:20::3")]
+        chanStart = 2
+        freq = 1.0e9 + 1.0e3 * np.arange(chanStart, 21)
+        assert line_layout(lines, freq, chanStart) == 4 + 3
+        assert (lines[1]["specStart"], lines[1]["specStop"]) == (4, 7)
+        assert np.array_equal(lines[0]["faxis"], freq[0:4])
+
+        data = np.random.default_rng(1).normal(size=(5, len(freq)))
+        out = np.full((5, 7), np.nan)
+        fan_out(data, freq, lines, chanStart, out, smoothing="hanning")
+        assert np.array_equal(out[:, :4], data[:, 0:4])
+        lineB, lineFreq = smooth(
+            data[:, 6:18], freq[6:18], 3, kernel="hanning", out=np.empty((5, 3))
+        )
+        assert np.array_equal(out[:, 4:], lineB)
+        assert np.array_equal(lines[1]["faxis"], lineFreq)
@@ -0,0 +1,192 @@
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from gbtgridder.boxcar import smooth
+from gbtgridder.get_data import get_data
+from gbtgridder.grid_otf import channel_slabs, find_nans, nan_mask
+from gbtgridder.load_data import (
+    close_shared_spectra,
+    create_shared_spectra,
+    load_spectra,
+    load_spectra_parallel,
+    release_shared_spectra,
+    scan_sdfits,
+    slab_channel_range,
+    split_load_tasks,
+)
+
+# the SDFITS files used by the integration tests
+sdfits_dir = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "integration_tests"
+)
+
+
+# test the two-phase loading in load_data.py
+# scan_sdfits() is the metadata pass, load_spectra() is the data pass
+class TestLoad_Data:
+    def setup_method(self):
+        self.files = [
+            os.path.join(sdfits_dir, "cygx_sdfits.fits"),
+            os.path.join(sdfits_dir, "normal.fits"),
+        ]
+
+    def test_metadata_pass(self):
+        # no data is returned by the metadata pass
+        # but the number of rows and output channels are known
+        info = get_data(self.files[0], 0, None, None, None, None, None, getdata=False)
+        assert info["data"] is None
+        assert info["nrows"] == 2500
+        assert info["spec_size"] == 2
+
+    def test_two_phase(self):
+        # the two passes must give the same values as get_data
+        info = scan_sdfits(self.files, 0, None, None, None, None, None, verbose=0)
+        assert info["num_positions"] == 6100
+        assert [len(rows) for (_, rows) in info["files"]] == [2500, 3600]
+
+        spec = np.full((info["num_positions"], info["first"]["spec_size"]), np.nan)
+        assert load_spectra(
+            info["files"], spec, 0, None, None, None, None, None, verbose=0
+        )
+
+        expected = np.concatenate(
+            [get_data(f, 0, None, None, None, None, None)["data"] for f in self.files]
+        )
+        assert np.array_equal(spec, expected, equal_nan=True)
+        assert np.array_equal(
+            info["xsky"],
+            np.concatenate(
+                [
+                    get_data(f, 0, None, None, None, None, None)["xsky"]
+                    for f in self.files
+                ]
+            ).astype(np.float32),
+        )
+
+    def test_split_load_tasks(self):
+        # files are split into row ranges, largest tasks first
+        files = [("a.fits", np.arange(0, 10)), ("b.fits", np.arange(5, 30, 5))]
+        tasks = split_load_tasks(files, 2, rowsPerTask=4)
+        assert tasks[0] == ("a.fits", (0, 4), 0, 4)
+        assert ("a.fits", (8, 10), 8, 2) in tasks
+        assert ("b.fits", (5, 21), 10, 4) in tasks
+        assert ("b.fits", (25, 26), 14, 1) in tasks
+        assert sum([task[3] for task in tasks]) == 15
+
+    def test_parallel_load(self):
+        # the process pool must give the same spectra as the serial pass
+        info = scan_sdfits(self.files, 0, None, None, [0], None, None, verbose=0)
+        spec_size = info["first"]["spec_size"]
+        expected = np.full((info["num_positions"], spec_size), np.nan)
+        assert load_spectra(
+            info["files"], expected, 0, None, None, [0], None, None, verbose=0
+        )
+
+        shm, spec = create_shared_spectra((info["num_positions"], spec_size))
+        try:
+            assert load_spectra_parallel(
+                info["files"],
+                shm,
+                spec,
+                0,
+                None,
+                None,
+                [0],
+                None,
+                None,
+                2,
+                rowsPerTask=1000,
+                verbose=0,
+            )
+        finally:
+            release_shared_spectra(shm)
+        assert np.array_equal(spec, expected, equal_nan=True)
+        del spec
+        close_shared_spectra(shm)
+        assert shm.buf is None
+
+    def test_nan_record(self, tmp_path):
+        # the loaders set NaN values to 0 as they are read and record where
+        # they were, serially and in the worker processes
+        nanFile = str(tmp_path / "nans.fits")
+        with fits.open(self.files[0]) as hdul:
+            table = hdul[1].copy()
+            table.data["DATA"][[3, 7, 2400], 1] = np.nan
+            table.data["DATA"][100] = np.nan
+            fits.HDUList([hdul[0].copy(), table]).writeto(nanFile)
+        files = [nanFile, self.files[1]]
+
+        info = scan_sdfits(files, 0, None, None, None, None, None, verbose=0)
+        shape = (info["num_positions"], info["first"]["spec_size"])
+        expected = np.full(shape, np.nan)
+        assert load_spectra(
+            info["files"], expected, 0, None, None, None, None, None, verbose=0
+        )
+        expectedNans = np.transpose(find_nans(expected))
+        assert len(expectedNans) == 5
+
+        spec = np.full(shape, np.nan)
+        nans = []
+        assert load_spectra(
+            info["files"], spec, 0, None, None, None, None, None, verbose=0, nans=nans
+        )
+        mask = nan_mask(nans, shape)
+        assert np.array_equal(np.transpose(mask.nonzero()), expectedNans)
+        assert np.array_equal(spec, np.nan_to_num(expected))
+
+        shm, spec = create_shared_spectra(shape)
+        nans = []
+        try:
+            assert load_spectra_parallel(
+                info["files"],
+                shm,
+                spec,
+                0,
+                None,
+                None,
+                None,
+                None,
+                None,
+                2,
+                rowsPerTask=1000,
+                verbose=0,
+                nans=nans,
+            )
+        finally:
+            release_shared_spectra(shm)
+        mask = nan_mask(nans, shape)
+        assert np.array_equal(np.transpose(mask.nonzero()), expectedNans)
+        assert np.array_equal(spec, np.nan_to_num(expected))
+        del spec
+        close_shared_spectra(shm)
+
+    def test_slab_channel_range(self):
+        # each slab read with its own channel range must give the same
+        # channels as averaging the full range and then slicing
+        data = np.random.random((6, 103)).astype(np.float32)
+        freq = np.arange(103.0)
+        chanStart = 3
+        chanStop = 102
+        for average, smoothing in [
+            (None, "boxcar"),
+            (4, "boxcar"),
+            (4, "hanning"),
+            (3, "gaussian"),
+        ]:
+            if average is None:
+                full = data[:, chanStart:]
+            else:
+                full, _ = smooth(
+                    data[:, chanStart:], freq[chanStart:], average, kernel=smoothing
+                )
+            for slabStart, slabStop in channel_slabs(full.shape[1], 7):
+                c0, c1, skip = slab_channel_range(
+                    chanStart, slabStart, slabStop, average, smoothing, chanStop
+                )
+                slab = data[:, c0 : c1 + 1]
+                if average is not None:
+                    slab, _ = smooth(slab, freq[c0 : c1 + 1], average, kernel=smoothing)
+                slab = slab[:, skip : skip + slabStop - slabStart]
+                assert np.array_equal(slab, full[:, slabStart:slabStop])
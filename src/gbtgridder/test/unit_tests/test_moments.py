@@ -0,0 +1,116 @@
+import numpy as np
+from astropy.io import fits
+
+from gbtgridder.moments import (
+    add_moment_block,
+    channel_velocities,
+    map_header,
+    moment_maps,
+    new_moments,
+    parse_window,
+    window_channels,
+    write_map,
+)
+
+
+# test the moment, peak and noise maps in moments.py
+class TestMoments:
+    def setup_method(self):
+        # a gaussian line centred at 5 km/s with a dispersion of 8 km/s in
+        # 1 km/s channels, plus noise, with the line free channels at the ends
+        self.nchan = 120
+        restfreq = 1.4204058e9
+        self.hdr = fits.Header()
+        self.hdr["BUNIT"] = "K"
+        self.hdr["RESTFRQ"] = restfreq
+        self.hdr["CRPIX3"] = 1.0
+        self.hdr["CDELT3"] = -restfreq / 299792.458
+        self.hdr["CRVAL3"] = restfreq * (1.0 + 60.0 / 299792.458)
+        self.hdr["ALTRPIX"] = 1.0
+        self.velocity = channel_velocities(self.hdr, self.nchan, "RADI")
+        self.amplitude = np.linspace(1.0, 2.0, 7 * 9).reshape(7, 9)
+        line = np.exp(-0.5 * ((self.velocity - 5.0) / 8.0) ** 2)
+        self.cube = self.amplitude[None, :, :] * line[:, None, None]
+        rng = np.random.default_rng(24)
+        self.noise = 0.002
+        self.cube += rng.normal(scale=self.noise, size=self.cube.shape)
+        self.cube[:, 2, 3] = np.nan
+        self.signal = window_channels(
+            [parse_window("-40:50km/s")], self.nchan, self.velocity
+        )
+        self.lineFree = window_channels(
+            [parse_window("1:10"), parse_window("111:120")], self.nchan, None
+        )
+
+    def moments(self):
+        return new_moments(7, 9, self.velocity, self.signal, self.lineFree)
+
+    def test_parse_window(self):
+        window = parse_window("3:10")
+        assert (window["chanStart"], window["chanStop"]) == (2, 9)
+        assert window["vmin"] is None and window["text"] == "3:10"
+        window = parse_window("50:-20.5km/s")
+        assert (window["vmin"], window["vmax"]) == (-20.5, 50.0)
+        assert window["chanStart"] is None
+        for bad in ["3", "1:2:3", "a:b", "10:3", "0:4", "1:xkm/s"]:
+            assert parse_window(bad) is None
+
+    def test_velocities(self):
+        assert np.allclose(self.velocity, np.arange(-60.0, 60.0))
+        optical = channel_velocities(self.hdr, self.nchan, "OPTI")
+        relativistic = channel_velocities(self.hdr, self.nchan, "RELA")
+        assert np.allclose(optical, relativistic, atol=0.02)
+        assert np.all(np.abs(optical - self.velocity) < 0.02)
+        hdr = self.hdr.copy()
+        hdr["RESTFRQ"] = 0.0
+        assert channel_velocities(hdr, self.nchan, "RADI") is None
+        assert window_channels([parse_window("1:2km/s")], self.nchan, None) is None
+
+    def test_window_channels(self):
+        assert np.count_nonzero(self.signal) == 91
+        assert np.array_equal(np.flatnonzero(self.lineFree)[[0, 9, 10]], [0, 9, 110])
+        assert np.count_nonzero(self.lineFree) == 20
+
+    def test_maps(self):
+        moments = self.moments()
+        add_moment_block(moments, 0, 0, 0, self.cube)
+        maps = moment_maps(moments)
+        good = ~np.isnan(self.cube[0])
+        assert np.array_equal(np.isnan(maps["mom0"]), ~good)
+        area = self.amplitude * 8.0 * np.sqrt(2.0 * np.pi)
+        assert np.allclose(maps["mom0"][good], area[good], rtol=0.01)
+        assert np.allclose(maps["mom1"][good], 5.0, atol=0.1)
+        assert np.allclose(maps["mom2"][good], 8.0, atol=0.1)
+        assert np.allclose(maps["peak"][good], self.amplitude[good], atol=0.05)
+        assert np.allclose(maps["noise"][good], self.noise, rtol=0.5)
+
+    def test_tiles_and_slabs(self):
+        # adding slabs of tiles in any order gives the whole cube's maps
+        whole = self.moments()
+        add_moment_block(whole, 0, 0, 0, self.cube)
+        parts = self.moments()
+        for chanStart, chanStop in [(70, 120), (0, 33), (33, 70)]:
+            for x0, y0 in [(4, 3), (0, 0), (0, 3), (4, 0)]:
+                block = self.cube[chanStart:chanStop, y0 : y0 + 3 + y0 // 3]
+                block = block[:, :, x0 : x0 + 4 + x0 // 4]
+                add_moment_block(parts, chanStart, x0, y0, block)
+        wholeMaps = moment_maps(whole)
+        for product, image in moment_maps(parts).items():
+            assert np.allclose(image, wholeMaps[product], equal_nan=True)
+
+    def test_write_map(self, tmp_path):
+        moments = self.moments()
+        add_moment_block(moments, 0, 0, 0, self.cube)
+        maps = moment_maps(moments)
+        hdr = map_header(self.hdr, "mom0", self.signal, [parse_window("-40:50km/s")])
+        assert hdr["BUNIT"] == "K km/s"
+        assert hdr["CDELT3"] == 91 * self.hdr["CDELT3"]
+        assert np.isclose(channel_velocities(hdr, 1, "RADI")[0], 5.0, atol=1e-6)
+        assert "gbtgridder mom0 from -40:50km/s" in hdr["HISTORY"]
+        mapFile = str(tmp_path / "mom0.fits")
+        write_map(mapFile, hdr, maps["mom0"], np.float32)
+        with fits.open(mapFile) as hdul:
+            data = hdul[0].data
+            assert data.shape == (1, 1, 7, 9) and data.dtype.itemsize == 4
+            assert hdul[0].header["DATAMAX"] == np.nanmax(data)
+            assert hdul[0].header["DATAMIN"] == np.nanmin(data)
@@ -0,0 +1,94 @@
+import json
+
+import numpy as np
+from astropy.io import fits
+
+from gbtgridder.output_formats import (
+    chunk_shape,
+    output_copies,
+    read_store,
+    read_store_header,
+    write_chunk_store,
+    write_compressed,
+)
+
+
+# test the compressed and chunked copies of the output cubes
+class TestOutput_Formats:
+    def setup_method(self):
+        rng = np.random.default_rng(4)
+        self.cube = rng.normal(size=(1, 9, 13, 11))
+        self.cube[0, :, :2] = np.nan
+        self.cube[0, 4, 6, 7] = np.nan
+        self.hdr = fits.Header()
+        self.hdr["OBJECT"] = "test"
+        self.hdr["BUNIT"] = "K"
+        self.hdr.add_history("a history card")
+
+    @staticmethod
+    def reject_constant(name):
+        raise ValueError("%s is not valid JSON" % name)
+
+    def write_cube(self, tmp_path):
+        cubeFile = str(tmp_path / "test_cube.fits")
+        beams = fits.BinTableHDU.from_columns(
+            [
+                fits.Column(name="BMAJ", format="D", array=np.arange(9.0)),
+                fits.Column(name="BPA", format="D", array=np.full(9, np.nan)),
+            ],
+            name="BEAMS",
+        )
+        fits.HDUList([fits.PrimaryHDU(self.cube, header=self.hdr), beams]).writeto(
+            cubeFile
+        )
+        return cubeFile
+
+    def test_names(self):
+        assert output_copies("a_cube.fits", None, False) == []
+        assert output_copies("a_cube.fits", "gzip", True) == [
+            "a_cube.fits.fz",
+            "a_cube.zarr",
+        ]
+        assert chunk_shape((1, 9, 13, 11), (16, 4, 128)) == (1, 9, 4, 11)
+
+    def test_compressed(self, tmp_path):
+        cubeFile = self.write_cube(tmp_path)
+        outFile = write_compressed(cubeFile, "gzip", None, (2, 5, 4), verbose=0)
+        with fits.open(outFile) as hdul:
+            assert hdul[1].tile_shape == (1, 2, 5, 4)
+            assert hdul[1].compression_type == "GZIP_2"
+            assert hdul[1].header["OBJECT"] == "test"
+            assert np.array_equal(hdul[1].data, self.cube, equal_nan=True)
+            assert np.array_equal(
+                hdul[1].section[0, 3:6, 4:9, 2:3],
+                self.cube[0, 3:6, 4:9, 2:3],
+                equal_nan=True,
+            )
+            assert np.array_equal(hdul["BEAMS"].data["BMAJ"], np.arange(9.0))
+
+        # quantized values are within a fraction of the noise
+        outFile = write_compressed(cubeFile, "rice", 16, (2, 5, 4), verbose=0)
+        with fits.open(outFile) as hdul:
+            data = hdul[1].data
+            assert np.array_equal(np.isnan(data), np.isnan(self.cube))
+            assert np.nanmax(np.abs(data - self.cube)) < 0.1
+
+    def test_chunk_store(self, tmp_path):
+        cubeFile = self.write_cube(tmp_path)
+        storeDir = write_chunk_store(cubeFile, (2, 5, 4), verbose=0)
+        assert np.array_equal(read_store(storeDir), self.cube[0], equal_nan=True)
+        assert np.array_equal(
+            read_store(storeDir, 3, 8, 4, 13, 1, 10),
+            self.cube[0, 3:8, 4:13, 1:10],
+            equal_nan=True,
+        )
+        hdr = read_store_header(storeDir)
+        assert hdr["OBJECT"] == "test"
+        assert hdr["NAXIS3"] == 9
+        assert list(hdr["HISTORY"]) == ["a history card"]
+        # the JSON is strict, NaN values are written as Zarr writes them
+        with open(tmp_path / "test_cube.zarr" / ".zattrs") as f:
+            attrs = json.load(f, parse_constant=self.reject_constant)
+        assert attrs["BEAMS"]["BPA"] == ["NaN"] * 9
+        # one file per chunk, with the edges padded
+        assert len(list((tmp_path / "test_cube.zarr").glob("0.*"))) == 5 * 3 * 3
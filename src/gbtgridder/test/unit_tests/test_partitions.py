@@ -0,0 +1,66 @@
+import numpy as np
+
+from gbtgridder.partitions import (
+    partition_rows,
+    pol_name,
+    position_groups,
+    stokes_i,
+    stokes_i_sets,
+)
+
+
+# test splitting the rows by polarization and feed in partitions.py
+class TestPartitions:
+    def setup_method(self):
+        # two feeds, each with XX and YY rows at the same positions
+        self.stokes = np.array([-5, -6, -5, -6, -5, -6, -5, -6])
+        self.feeds = np.array([1, 1, 1, 1, 2, 2, 2, 2])
+        self.xsky = np.array([1.0, 1.0, 2.0, 2.0, 1.5, 1.5, 2.5, 2.5])
+        self.ysky = np.zeros(8)
+
+    def test_partition_rows(self):
+        parts = partition_rows(self.stokes, self.feeds, "pol")
+        assert [part["name"] for part in parts] == ["XX", "YY"]
+        assert np.array_equal(parts[1]["rows"], [1, 3, 5, 7])
+        assert parts[1]["stokes"] == -6 and parts[1]["feed"] is None
+
+        parts = partition_rows(self.stokes, self.feeds, "feed")
+        assert [part["name"] for part in parts] == ["feed1", "feed2"]
+        assert np.array_equal(parts[1]["rows"], [4, 5, 6, 7])
+
+        parts = partition_rows(self.stokes, self.feeds, "polfeed")
+        assert [part["name"] for part in parts] == [
+            "feed1_XX",
+            "feed1_YY",
+            "feed2_XX",
+            "feed2_YY",
+        ]
+        assert np.array_equal(parts[2]["rows"], [4, 6])
+        assert pol_name(0) == "pol0"
+
+    def test_position_groups(self):
+        parts = partition_rows(self.stokes, self.feeds, "polfeed")
+        assert position_groups(parts, self.xsky, self.ysky) == [[0, 1], [2, 3]]
+        # the polarizations of both feeds together are not at the same positions
+        parts = partition_rows(self.stokes, self.feeds, "pol")
+        assert position_groups(parts, self.xsky, self.ysky) == [[0, 1]]
+        self.xsky[1] += 0.1
+        assert position_groups(parts, self.xsky, self.ysky) == [[0], [1]]
+
+    def test_stokes_i(self):
+        parts = partition_rows(self.stokes, self.feeds, "polfeed")
+        assert stokes_i_sets(parts) == [("feed1_I", 0, 1), ("feed2_I", 2, 3)]
+        parts = partition_rows(self.stokes, self.feeds, "pol")
+        assert stokes_i_sets(parts) == [("I", 0, 1)]
+        # XX alone can not make I
+        parts = partition_rows(self.stokes[::2], self.feeds[::2], "pol")
+        assert stokes_i_sets(parts, verbose=0) == []
+
+        cube, weight = stokes_i(
+            np.array([1.0, np.nan]),
+            np.array([1.0, 0.0]),
+            np.array([3.0, 2.0]),
+            np.array([2.0, 1.0]),
+        )
+        assert cube[0] == 2.0 and np.isnan(cube[1])
+        assert np.array_equal(weight, [3.0, 1.0])
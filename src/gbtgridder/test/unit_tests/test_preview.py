@@ -0,0 +1,80 @@
+import numpy as np
+from astropy import wcs
+
+from gbtgridder.make_header import make_header
+from gbtgridder.preview import (
+    bin_preview,
+    preview_blocks,
+    preview_header,
+    preview_pixels,
+    preview_rows,
+)
+
+
+# test the quick look preview in preview.py
+class TestPreview:
+    def setup_method(self):
+        self.faxis = 1.42e9 + 1.0e4 * np.arange(10)
+        self.hdr = make_header(
+            180.0,
+            30.0,
+            21,
+            15,
+            0.01,
+            11.0,
+            8.0,
+            ("RA", "DEC"),
+            "FK5",
+            2000.0,
+            1.4204e9,
+            self.faxis,
+            0.03,
+            "RADI",
+            "LSRK",
+            proj="TAN",
+            verbose=0,
+        )
+
+    def test_blocks(self):
+        assert preview_blocks(10, 1) == [(0, 10)]
+        assert preview_blocks(10, 3) == [(0, 4), (4, 8), (8, 10)]
+        assert preview_blocks(3, 5) == [(0, 1), (1, 2), (2, 3)]
+
+    def test_rows(self):
+        files = [("a", np.arange(5)), ("b", np.arange(10, 13)), ("c", np.arange(4))]
+        picked = preview_rows(files, 3)
+        assert [thisFile for thisFile, _, _ in picked] == ["a", "b", "c"]
+        assert np.array_equal(
+            np.concatenate([index for _, _, index in picked]), [0, 3, 6, 9]
+        )
+        assert np.array_equal(picked[1][1], [11])
+        assert np.array_equal(preview_rows(files, 1)[2][2], [8, 9, 10, 11])
+
+    def test_header(self):
+        # each preview pixel is centred on the pixels it covers
+        previewHdr = preview_header(self.hdr, 4, self.faxis, preview_blocks(10, 2))
+        assert (previewHdr["NAXIS1"], previewHdr["NAXIS2"]) == (6, 4)
+        assert previewHdr["NAXIS3"] == 2
+        assert previewHdr["CRVAL3"] == np.mean(self.faxis[:5])
+        assert previewHdr["CDELT3"] == 5.0e4
+        fine = wcs.WCS(self.hdr).celestial
+        coarse = wcs.WCS(previewHdr).celestial
+        assert np.allclose(
+            coarse.wcs_pix2world([[2, 1]], 0), fine.wcs_pix2world([[9.5, 5.5]], 0)
+        )
+
+    def test_bin(self):
+        previewHdr = preview_header(self.hdr, 3, self.faxis, preview_blocks(10, 1))
+        coarse = wcs.WCS(previewHdr).celestial
+        xsky, ysky = coarse.wcs_pix2world(
+            [0.2, 0.1, 3.0, 30.0], [0.0, -0.3, 2.0, 1.0], 0
+        )
+        pixels = preview_pixels(previewHdr, xsky, ysky)
+        assert np.array_equal(pixels, [0, 0, 2 * 7 + 3, -1])
+        spec = np.array([[1.0, 2.0], [4.0, np.nan], [5.0, 6.0], [7.0, 8.0]])
+        weights = np.array([1.0, 3.0, 1.0, 1.0])
+        result = bin_preview(pixels, spec, weights, 7 * 5)
+        assert result.shape == (2, 35)
+        assert result[0, 0] == 3.25 and result[1, 0] == 2.0
+        assert result[0, 17] == 5.0 and result[1, 17] == 6.0
+        assert np.count_nonzero(np.isfinite(result)) == 4
@@ -0,0 +1,114 @@
+import os
+import shutil
+
+import numpy as np
+from astropy.io import fits
+
+from gbtgridder.get_data import get_data
+from gbtgridder.scan_index import (
+    build_scan_index,
+    index_rows,
+    read_scan_index,
+    scan_rows,
+)
+
+# the SDFITS files used by the integration tests
+sdfits_dir = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "integration_tests"
+)
+
+
+def make_table(scans):
+    # a minimal table with the columns used by the scan index
+    nrows = len(scans)
+    dateObs = ["2022-03-25T18:41:%05.2f" % (0.5 * i) for i in range(nrows)]
+    cols = [
+        fits.Column(name="SCAN", format="J", array=scans),
+        fits.Column(name="DATE-OBS", format="22A", array=dateObs),
+        fits.Column(name="TSYS", format="E", array=20.0 + np.arange(nrows)),
+        fits.Column(name="CRVAL2", format="D", array=np.arange(nrows) * 0.1),
+        fits.Column(name="CRVAL3", format="D", array=-np.arange(nrows) * 0.1),
+        fits.Column(name="PLNUM", format="I", array=np.arange(nrows) % 2),
+    ]
+    return fits.BinTableHDU.from_columns(cols)
+
+
+# test the scan index in scan_index.py
+class TestScan_Index:
+    def test_build(self):
+        scans = np.array([3, 3, 1, 1, 1, 3, 2])
+        index = build_scan_index(make_table(scans))
+        assert index["nrows"] == 7
+        assert [s["scan"] for s in index["scans"]] == [1, 2, 3]
+        scan3 = index["scans"][2]
+        assert scan3["rows"] == [[0, 2], [5, 6]]
+        assert scan3["nrows"] == 3
+        assert scan3["time"] == ["2022-03-25T18:41:00.00", "2022-03-25T18:41:02.50"]
+        assert scan3["tsys"] == [20.0, 25.0, 21.0]
+        assert scan3["plnum"] == [0, 1]
+        assert "feed" not in scan3
+        assert index["scans"][1]["plnum"] == [0]
+
+        # the same rows as masking the scan column
+        for scanlist in [[3], [1, 2], [2, 7], [1, 2, 3]]:
+            expected = np.flatnonzero(np.isin(scans, scanlist))
+            assert np.array_equal(index_rows(index, scanlist), expected)
+        assert np.array_equal(index_rows(index, [3, 1], rowRange=(1, 5)), [1, 2, 3, 4])
+
+        # without a cache directory the rows come from the SCAN column alone
+        table = make_table(scans)
+        for scanlist in [[3], [1, 2], [2, 7]]:
+            assert np.array_equal(
+                scan_rows("none", table, scanlist), index_rows(index, scanlist)
+            )
+        assert np.array_equal(
+            scan_rows("none", table, [3, 1], rowRange=(1, 5)), [1, 2, 3, 4]
+        )
+
+    def test_get_data_scans(self):
+        sdfitsFile = os.path.join(sdfits_dir, "normal.fits")
+        result = get_data(sdfitsFile, 0, None, None, [0], None, None, verbose=0)
+        assert np.array_equal(result["rows"], np.arange(3600))
+        result = get_data(
+            sdfitsFile, 0, None, None, [0, 4], None, None, verbose=0, rowRange=(5, 9)
+        )
+        assert np.array_equal(result["rows"], np.arange(5, 9))
+        assert get_data(sdfitsFile, 0, None, None, [4], None, None, verbose=0) == {}
+
+        # the rows of an earlier call are used as they are, within rowRange
+        spectra = get_data(sdfitsFile, 0, None, None, None, None, None, verbose=0)
+        rows = np.array([2, 3, 7, 11, 12])
+        result = get_data(
+            sdfitsFile, 0, None, None, None, None, None, verbose=0, rows=rows
+        )
+        assert np.array_equal(result["rows"], rows)
+        assert np.array_equal(result["data"], spectra["data"][rows])
+        assert np.array_equal(result["xsky"], spectra["xsky"][rows])
+        result = get_data(
+            sdfitsFile,
+            0,
+            None,
+            None,
+            [0],
+            None,
+            None,
+            verbose=0,
+            rows=rows,
+            rowRange=(3, 11),
+        )
+        assert np.array_equal(result["rows"], [3, 7])
+        assert np.array_equal(result["data"], spectra["data"][[3, 7]])
+
+    def test_saved_index(self):
+        cacheDir = os.path.join(sdfits_dir, "test_scan_index_cache")
+        shutil.rmtree(cacheDir, ignore_errors=True)
+        try:
+            sdfitsFile = os.path.join(sdfits_dir, "cygx_sdfits.fits")
+            with fits.open(sdfitsFile) as hdul:
+                index = read_scan_index(sdfitsFile, hdul[1], cacheDir=cacheDir)
+            assert len(os.listdir(cacheDir)) == 1
+            # the saved index is used without looking at the table
+            assert read_scan_index(sdfitsFile, None, cacheDir=cacheDir) == index
+            assert index["scans"][0]["nrows"] == 2500
+        finally:
+            shutil.rmtree(cacheDir, ignore_errors=True)
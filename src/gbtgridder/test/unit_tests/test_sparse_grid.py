@@ -0,0 +1,107 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+from astropy import wcs
+
+from gbtgridder.grid_otf import prepare_header
+from gbtgridder.sparse_grid import (
+    kernel_matrix,
+    kernel_plan,
+    kernel_weights,
+    plan_key,
+)
+
+# the SDFITS files used by the integration tests
+sdfits_dir = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "integration_tests"
+)
+
+
+def make_header(nchan, crval3=1.4e9):
+    # a small RA/DEC/FREQ map, as make_header would produce
+    wcsObj = wcs.WCS(naxis=3)
+    wcsObj.wcs.ctype = ["RA---SFL", "DEC--SFL", "FREQ"]
+    wcsObj.wcs.crval = [180.0, 30.0, crval3]
+    wcsObj.wcs.crpix = [10.5, 10.5, 1.0]
+    wcsObj.wcs.cdelt = [-0.05, 0.05, 1.0e5]
+    return prepare_header(wcsObj, 20, 20, nchan)
+
+
+# test the kernels of the sparse backend in sparse_grid.py
+class TestSparse_Grid:
+    def test_kernel_weights(self):
+        distance = np.array([0.0, 0.01, 0.02, 0.05])
+        sigma = 0.02
+        assert np.allclose(
+            kernel_weights("gauss1d", sigma, distance),
+            np.exp(-0.5 * (distance / sigma) ** 2),
+        )
+        with pytest.raises(ValueError):
+            kernel_weights("gaussbessel", (0.01, 2.52, 1.55), distance)
+
+    def test_kernel_matrix(self):
+        header = make_header(4)
+        rng = np.random.default_rng(3)
+        glon = 180.0 + rng.uniform(-0.5, 0.5, 50)
+        glat = 30.0 + rng.uniform(-0.5, 0.5, 50)
+        sigma = 0.04
+        matrix = kernel_matrix(header, glon, glat, "gauss1d", sigma, 0.15)
+        assert matrix.shape == (400, 50)
+
+        # compare to a direct calculation over all pixel-spectrum pairs
+        celestial = wcs.WCS(header, naxis=[wcs.WCSSUB_CELESTIAL])
+        ypix, xpix = np.indices((20, 20))
+        pixLon, pixLat = celestial.wcs_pix2world(xpix.ravel(), ypix.ravel(), 0)
+        l1, b1 = (np.radians(pixLon)[:, None], np.radians(pixLat)[:, None])
+        l2, b2 = (np.radians(glon)[None, :], np.radians(glat)[None, :])
+        distance = np.degrees(
+            np.arccos(
+                np.sin(b1) * np.sin(b2) + np.cos(b1) * np.cos(b2) * np.cos(l1 - l2)
+            )
+        )
+        expected = np.where(
+            distance < 0.15, np.exp(-0.5 * (distance / sigma) ** 2), 0.0
+        )
+        # pairs right at the support edge may differ, their weight is tiny
+        assert np.allclose(matrix.toarray(), expected, rtol=0, atol=1e-6)
+
+    def test_kernel_plan(self):
+        planDir = os.path.join(sdfits_dir, "test_kernel_plan")
+        shutil.rmtree(planDir, ignore_errors=True)
+        rng = np.random.default_rng(4)
+        glon = 180.0 + rng.uniform(-0.5, 0.5, 30)
+        glat = 30.0 + rng.uniform(-0.5, 0.5, 30)
+        kernel = ("gauss1d", 0.04, 0.15)
+
+        # the spectral axis does not change the plan, the positions do
+        key = plan_key(make_header(4), glon, glat, *kernel)
+        assert plan_key(make_header(9, crval3=1.6e9), glon, glat, *kernel) == key
+        assert plan_key(make_header(4), glon + 0.01, glat, *kernel) != key
+
+        try:
+            planned = kernel_plan(make_header(4), glon, glat, *kernel, planDir=planDir)
+            assert os.listdir(planDir) == ["plan-%s.npz" % key]
+            loaded = kernel_plan(
+                make_header(9),
+                glon,
+                glat,
+                *kernel,
+                dtype=np.float32,
+                planDir=planDir,
+            )
+            assert loaded.dtype == np.float32
+            assert np.array_equal(
+                loaded.toarray(), planned.toarray().astype(np.float32)
+            )
+        finally:
+            shutil.rmtree(planDir, ignore_errors=True)
+
+        # a run keeps only its last plan in plans
+        plans = {}
+        planned = kernel_plan(make_header(4), glon, glat, *kernel, plans=plans)
+        assert list(plans) == [key]
+        assert kernel_plan(make_header(9), glon, glat, *kernel, plans=plans) is planned
+        kernel_plan(make_header(4), glon + 0.01, glat, *kernel, plans=plans)
+        assert len(plans) == 1 and key not in plans
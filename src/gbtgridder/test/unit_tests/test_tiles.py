@@ -0,0 +1,73 @@
+import os
+import shlex
+
+import numpy as np
+
+from gbtgridder.gbtgridder_args import make_parser
+from gbtgridder.tiles import map_tiles, tile_chunks, tile_commands
+
+
+# test the map tiling in tiles.py
+class TestTiles:
+    def test_map_tiles(self):
+        tiles = map_tiles(5, 3, 2)
+        assert tiles == [
+            (0, 2, 0, 2),
+            (2, 4, 0, 2),
+            (4, 5, 0, 2),
+            (0, 2, 2, 3),
+            (2, 4, 2, 3),
+            (4, 5, 2, 3),
+        ]
+        # every pixel is in exactly one tile
+        count = np.zeros((3, 5), dtype=int)
+        for x0, x1, y0, y1 in tiles:
+            count[y0:y1, x0:x1] += 1
+        assert np.all(count == 1)
+        assert map_tiles(5, 3, 10) == [(0, 5, 0, 3)]
+
+    def test_tile_chunks(self):
+        # the kept rows of each chunk follow on from the previous chunk
+        spec = np.arange(20).reshape(10, 2)
+        rows = np.array([1, 2, 5, 9])
+        chunks = [(0, spec[:4]), (4, spec[4:5]), (5, spec[5:])]
+        result = list(tile_chunks(chunks, rows))
+        assert [rowStart for rowStart, data in result] == [0, 2]
+        assert np.array_equal(
+            np.concatenate([data for rowStart, data in result]), spec[rows]
+        )
+
+    def test_tile_commands(self):
+        args = make_parser("1.0").parse_args(
+            [
+                "my file.fits",
+                "--tile-size",
+                "100",
+                "--tile-tasks",
+                "tasks.txt",
+                "-j4",
+                "--jo=2",
+                "-o",
+                "out",
+                "--signal=-20:35km/s",
+            ]
+        )
+        commands = tile_commands(args, 3)
+        assert len(commands) == 3
+        assert shlex.split(commands[2]) == [
+            "gbtgridder",
+            os.path.abspath("my file.fits"),
+            "--output",
+            os.path.abspath("out"),
+            "--signal=-20:35km/s",
+            "--tile-size",
+            "100",
+            "--autoConfirm",
+            "--tile",
+            "2",
+        ]
+
+        # without --output the tasks write where this run would have
+        args.output = None
+        command = shlex.split(tile_commands(args, 1, "src_1420_MHz")[0])
+        assert command[2:4] == ["--output", os.path.abspath("src_1420_MHz")]
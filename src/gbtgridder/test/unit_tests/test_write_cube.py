@@ -0,0 +1,108 @@
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from gbtgridder.write_cube import (
+    create_cube_file,
+    update_cube_header,
+    write_cube_blocks,
+    write_cube_planes,
+    write_cube_region,
+)
+
+
+# test the incremental cube writing in write_cube.py
+class TestWrite_Cube:
+    def setup_method(self):
+        self.cube = np.random.random((5, 4, 3))
+        self.cube[2, 1, 1] = np.nan
+        self.hdr = fits.Header()
+        self.hdr["OBJECT"] = "test"
+        self.hdr["DATAMAX"] = 0.0
+        self.hdr["DATAMIN"] = 0.0
+        self.hdr.add_history("written in slabs")
+
+    def teardown_method(self):
+        for name in [
+            "test_write_cube.fits",
+            "test_write_cube_ref.fits",
+            "test_write_cube_wt.fits",
+        ]:
+            if os.path.exists(name):
+                os.remove(name)
+
+    def test_slabs_match_writeto(self):
+        # writing in slabs must give the same file as astropy writeto
+        name = "test_write_cube.fits"
+        offset = create_cube_file(name, self.hdr, 5, 4, 3)
+        write_cube_planes(name, offset, 3, self.cube[3:])
+        write_cube_planes(name, offset, 0, self.cube[:3])
+        update_cube_header(
+            name,
+            offset,
+            {"DATAMAX": np.nanmax(self.cube), "DATAMIN": np.nanmin(self.cube)},
+        )
+
+        hdr = self.hdr.copy()
+        hdr["DATAMAX"] = np.nanmax(self.cube)
+        hdr["DATAMIN"] = np.nanmin(self.cube)
+        fits.PrimaryHDU(self.cube[None, ...], header=hdr).writeto(
+            "test_write_cube_ref.fits"
+        )
+
+        with open(name, "rb") as f1, open("test_write_cube_ref.fits", "rb") as f2:
+            assert f1.read() == f2.read()
+
+    def test_remove_keywords(self):
+        # removing keywords keeps the header size and the data intact
+        name = "test_write_cube.fits"
+        offset = create_cube_file(name, self.hdr, 5, 4, 3)
+        write_cube_planes(name, offset, 0, self.cube)
+        update_cube_header(name, offset, {}, remove=["DATAMAX", "DATAMIN"])
+        with fits.open(name) as hdul:
+            assert "DATAMAX" not in hdul[0].header
+            assert "DATAMIN" not in hdul[0].header
+            assert np.array_equal(hdul[0].data[0], self.cube, equal_nan=True)
+
+    def test_regions(self):
+        # writing tiles of a slab at a time fills in the same cube
+        name = "test_write_cube.fits"
+        offset = create_cube_file(name, self.hdr, 5, 4, 3)
+        for c0, c1 in [(0, 2), (2, 5)]:
+            for x0, x1, y0, y1 in [(0, 2, 0, 3), (2, 3, 0, 3), (0, 3, 3, 4)]:
+                write_cube_region(
+                    name, offset, (5, 4, 3), c0, x0, y0, self.cube[c0:c1, y0:y1, x0:x1]
+                )
+        with fits.open(name) as hdul:
+            assert np.array_equal(hdul[0].data[0], self.cube, equal_nan=True)
+
+    def test_blocks(self):
+        # the files written together in threads get the same values as
+        # writing them one at a time, with the statistics of each block
+        names = ["test_write_cube.fits", "test_write_cube_wt.fits"]
+        weight = np.random.random((5, 4, 3))
+        offsets = [create_cube_file(name, self.hdr, 5, 4, 3) for name in names]
+        for c0, c1 in [(0, 2), (2, 5)]:
+            stats = write_cube_blocks(
+                [
+                    (name, offset, None, c0, 0, 0, block[c0:c1])
+                    for name, offset, block in zip(names, offsets, [self.cube, weight])
+                ]
+            )
+            assert np.array_equal(
+                stats[0]["max"], np.nanmax(self.cube[c0:c1], axis=(1, 2))
+            )
+            assert np.array_equal(stats[1]["min"], weight[c0:c1].min(axis=(1, 2)))
+        for name, block in zip(names, [self.cube, weight]):
+            with fits.open(name) as hdul:
+                assert np.array_equal(hdul[0].data[0], block, equal_nan=True)
+
+        # tiles use write_cube_region
+        offset = create_cube_file(names[0], self.hdr, 5, 4, 3)
+        write_cube_blocks(
+            [(names[0], offset, (5, 4, 3), 1, 1, 2, self.cube[1:4, 2:, 1:])]
+        )
+        with fits.open(names[0]) as hdul:
+            assert np.array_equal(hdul[0].data[0, 1:4, 2:, 1:], self.cube[1:4, 2:, 1:])
+            assert not np.any(hdul[0].data[0, :, :2])
@@ -0,0 +1,281 @@
+# Copyright (C) 2015 Associated Universities, Inc. Washington DC, USA.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+# Correspondence concerning GBT software should be addressed as follows:
+#       GBT Operations
+#       National Radio Astronomy Observatory
+#       P. O. Box 2
+#       Green Bank, WV 24944-0002 USA
+
+
+import argparse
+import os
+import shlex
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+
+import numpy as np
+from astropy import wcs
+
+from .gbtgridder_args import make_parser
+from .grid_otf import grid_otf, kernel_setup
+
+# arguments that are not passed on to the per-tile commands, each task
+# is one job of the batch system so it does not start its own pool
+_TASK_OPTIONS = ["tile_tasks", "tile", "jobs"]
+
+# arguments that are file names, written as absolute paths so the tasks
+# can be run from any directory
+_PATH_OPTIONS = ["SDFITSfiles", "output", "clonecube", "accumulate", "cache"]
+
+
+def map_tiles(nx, ny, tileSize):
+    """Split an nx by ny map into tiles of at most tileSize by tileSize pixels.
+
+    Returns a list of (x0, x1, y0, y1) pixel ranges, the stop values are
+    exclusive.  The tiles are numbered along x first.
+    """
+    return [
+        (x0, min(x0 + tileSize, nx), y0, min(y0 + tileSize, ny))
+        for y0 in range(0, ny, tileSize)
+        for x0 in range(0, nx, tileSize)
+    ]
+
+
+def tile_wcs(wcsObj, tile):
+    """A copy of wcsObj for the pixels of one tile from map_tiles.
+
+    The copy is made from the header of wcsObj, as cygrid's is, so the
+    reference pixel has the precision it has in the header.  That keeps
+    the pixel positions as close as possible to those of the whole map.
+    """
+    tileWcs = wcs.WCS(wcsObj.to_header(relax=True), relax=True)
+    tileWcs.wcs.crpix[0] -= tile[0]
+    tileWcs.wcs.crpix[1] -= tile[2]
+    return tileWcs
+
+
+def tile_padding(kernel_type, beam_fwhm, gauss_fwhm, pix_scale):
+    """The number of pixels the tiles are padded by when choosing their spectra.
+
+    This is twice the kernel support, the extra allows for the pixels
+    being larger or smaller than pix_scale away from the reference
+    position of the projection.
+    """
+    support_distance = kernel_setup(kernel_type, beam_fwhm, gauss_fwhm, pix_scale)[2]
+    return int(np.ceil(2.0 * support_distance / pix_scale)) + 1
+
+
+def tile_rows(wcsObj, glon, glat, tiles, padding):
+    """The rows of the spectra that can contribute to each tile.
+
+    Those are the spectra within padding pixels of the tile.  Returns a list
+    of increasing row number arrays, one per tile, so each tile grids its
+    spectra in the same order as the whole map would.
+    """
+    xpix, ypix = wcsObj.celestial.wcs_world2pix(glon, glat, 0)
+    result = []
+    for x0, x1, y0, y1 in tiles:
+        inTile = (
+            (xpix > x0 - 1 - padding)
+            & (xpix < x1 + padding)
+            & (ypix > y0 - 1 - padding)
+            & (ypix < y1 + padding)
+        )
+        result.append(np.flatnonzero(inTile))
+    return result
+
+
+def tile_chunks(chunks, rows):
+    """Keep the given rows of the (rowStart, data) chunks used by grid_otf.
+
+    rows is an increasing array of row numbers.  The chunks returned
+    start at the position of their first row in rows, as grid_otf expects
+    when it is given the positions and weights of just those rows.
+    """
+    for rowStart, data in chunks:
+        r0 = np.searchsorted(rows, rowStart)
+        r1 = np.searchsorted(rows, rowStart + data.shape[0])
+        if r1 > r0:
+            yield (r0, data[rows[r0:r1] - rowStart])
+
+
+def grid_tile(spec, glon, glat, weights, tile, wcsObj, nchan, gridArgs):
+    """Grid one tile of the map with grid_otf.
+
+    spec (or gridArgs["chunks"]), glon, glat and weights are for the
+    spectra of this tile only (see tile_rows), nchan is the number of
+    channels in them.  gridArgs are the remaining grid_otf keyword
+    arguments.  Returns (cube, weight) for the tile.  A
+    tile without spectra is blank with zero weight, as the whole map would
+    be there (the sums are zero if gridArgs has normalize=False).  Returns
+    (None, None) if grid_otf fails.
+    """
+    x0, x1, y0, y1 = tile
+    if len(glon) == 0:
+        weight = np.zeros((nchan, y1 - y0, x1 - x0), dtype=gridArgs["dtype"])
+        if not gridArgs.get("normalize", True):
+            # the unweighted data cube is also zero
+            return (np.zeros_like(weight), weight)
+        return (np.full_like(weight, np.nan), weight)
+    cube, weight, final_fwhm = grid_otf(
+        spec,
+        x1 - x0,
+        y1 - y0,
+        glon,
+        glat,
+        tile_wcs(wcsObj, tile),
+        weights=weights,
+        **gridArgs,
+    )
+    return (cube, weight)
+
+
+def tile_commands(args, ntiles, outputRoot=None):
+    """One gbtgridder command line per tile, for a batch system to run.
+
+    args are the parsed arguments of this run.  Each command is the same
+    gridding with --tile added, so it writes just that tile.  The commands
+    are made from args, not the command line as typed, so every alias of
+    the options left out is dropped.  File names are made absolute and
+    outputRoot, if given, is the --output used when args has none, so the
+    tiles are written where this run would have written the map.
+    """
+    files = []
+    arguments = []
+    for action in make_parser("")._actions:
+        if action.dest in _TASK_OPTIONS or action.default == argparse.SUPPRESS:
+            continue
+        value = getattr(args, action.dest)
+        if action.dest == "output" and value is None:
+            value = outputRoot
+        if value is None or value == action.default:
+            continue
+        if action.dest in _PATH_OPTIONS:
+            if isinstance(value, list):
+                value = [os.path.abspath(name) for name in value]
+            else:
+                value = os.path.abspath(value)
+        if not action.option_strings:
+            files = value
+            continue
+        option = max(action.option_strings, key=len)
+        if action.nargs == 0:
+            arguments.append(option)
+        elif action.nargs is None:
+            # the options given more than once have a list of values
+            for item in value if isinstance(value, list) else [value]:
+                if str(item).startswith("-"):
+                    arguments.append("%s=%s" % (option, item))
+                else:
+                    arguments += [option, str(item)]
+        else:
+            arguments += [option] + [str(item) for item in value]
+    if "--autoConfirm" not in arguments:
+        arguments.append("--autoConfirm")
+    return [
+        shlex.join(["gbtgridder"] + files + arguments + ["--tile", str(tile)])
+        for tile in range(ntiles)
+    ]
+
+
+def write_tile_tasks(taskFile, commands, verbose=4):
+    """Write the commands from tile_commands to taskFile, one per line.
+
+    Returns True on success.
+    """
+    try:
+        with open(taskFile, "w") as f:
+            for command in commands:
+                f.write(command + os.linesep)
+    except OSError as e:
+        if verbose > 1:
+            print("Unable to write the tile tasks to %s : %s" % (taskFile, e))
+        return False
+    if verbose > 3:
+        print("Wrote %d tile tasks to %s" % (len(commands), taskFile))
+    return True
+
+
+def iter_tiles(
+    tiles,
+    rowsList,
+    spec,
+    makeChunks,
+    glon,
+    glat,
+    weights,
+    wcsObj,
+    nchan,
+    gridArgs,
+    jobs=1,
+):
+    """Grid each tile and yield (tile, cube, weight) as they are done.
+
+    rowsList holds the rows of each tile from tile_rows.  The spectra are
+    either in spec or, when spec is None, read by the chunk iterator that
+    makeChunks() returns, once for each tile.  With jobs > 1 (and spec) the
+    tiles are gridded in that many worker processes, each given just the
+    spectra of its tile, and they may finish in any order.
+    """
+    tileArgs = []
+    for tile, rows in zip(tiles, rowsList):
+        tileWeights = None
+        if weights is not None:
+            tileWeights = weights[rows]
+        tileArgs.append((tile, rows, tileWeights))
+
+    if jobs > 1 and spec is not None:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            pending = {}
+            for tile, rows, tileWeights in tileArgs:
+                # only a few tiles of spectra are waiting at any time
+                while len(pending) >= 2 * jobs:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield (pending.pop(future),) + future.result()
+                future = pool.submit(
+                    grid_tile,
+                    spec[rows],
+                    glon[rows],
+                    glat[rows],
+                    tileWeights,
+                    tile,
+                    wcsObj,
+                    nchan,
+                    gridArgs,
+                )
+                pending[future] = tile
+            for future in as_completed(pending):
+                yield (pending[future],) + future.result()
+        return
+
+    for tile, rows, tileWeights in tileArgs:
+        tileSpec = None
+        tileGridArgs = gridArgs
+        if spec is not None:
+            tileSpec = spec[rows]
+        else:
+            tileGridArgs = dict(gridArgs, chunks=tile_chunks(makeChunks(), rows))
+        yield (tile,) + grid_tile(
+            tileSpec,
+            glon[rows],
+            glat[rows],
+            tileWeights,
+            tile,
+            wcsObj,
+            nchan,
+            tileGridArgs,
+        )
@@ -0,0 +1,180 @@
+# Copyright (C) 2015 Associated Universities, Inc. Washington DC, USA.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+# Correspondence concerning GBT software should be addressed as follows:
+#       GBT Operations
+#       National Radio Astronomy Observatory
+#       P. O. Box 2
+#       Green Bank, WV 24944-0002 USA
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from astropy.io import fits as pyfits
+
+from .cube_stats import block_stats
+
+# FITS files are written in blocks of this many bytes
+_BLOCK = 2880
+
+
+def create_cube_file(cubeFile, hdr, nchan, ny, nx, dtype=np.float64):
+    """Create a FITS file holding a (1, nchan, ny, nx) cube in the PHDU.
+
+    The file is written with its final header and its full size up front.
+    The data values start as zero and are filled in by write_cube_planes.
+    Keywords that will only be known after the cube is filled in (e.g.
+    DATAMAX, DATAMIN) should already be in hdr with placeholder values so
+    that update_cube_header can set them without changing the header size.
+
+    Returns the byte offset of the data in the file.
+    """
+    # a tiny array gets astropy to produce the standard PHDU keywords
+    phdu = pyfits.PrimaryHDU(np.empty((1, 1, 1, 1), dtype=dtype), header=hdr)
+    with open(cubeFile, "wb") as f:
+        return _write_cube_hdu(f, phdu, nchan, ny, nx)
+
+
+def append_cube_hdu(cubeFile, hdr, nchan, ny, nx, dtype=np.float64):
+    """Add a (1, nchan, ny, nx) image extension to the end of a FITS file.
+
+    This is create_cube_file for an extension, the data start as zero.
+    Returns the byte offset of the data in the file.
+    """
+    hdu = pyfits.ImageHDU(np.empty((1, 1, 1, 1), dtype=dtype), header=hdr)
+    with open(cubeFile, "rb+") as f:
+        f.seek(0, os.SEEK_END)
+        return _write_cube_hdu(f, hdu, nchan, ny, nx)
+
+
+def _write_cube_hdu(f, hdu, nchan, ny, nx):
+    # write the header of hdu for the full cube size at the current
+    # position of f and extend the file by the size of the data
+    hdu.header["NAXIS1"] = nx
+    hdu.header["NAXIS2"] = ny
+    hdu.header["NAXIS3"] = nchan
+    hdu.header["NAXIS4"] = 1
+    headerBytes = hdu.header.tostring().encode("ascii")
+
+    dataSize = nchan * ny * nx * hdu.data.itemsize
+    paddedSize = _BLOCK * int(np.ceil(dataSize / _BLOCK))
+    start = f.tell()
+    f.write(headerBytes)
+    f.truncate(start + len(headerBytes) + paddedSize)
+
+    return start + len(headerBytes)
+
+
+def write_cube_planes(cubeFile, dataOffset, chanStart, planes):
+    """Write channel planes into a file made by create_cube_file.
+
+    planes is a (nchan, ny, nx) array holding the channels starting at
+    chanStart.  The channels of a FITS cube are contiguous, so only those
+    planes of the file are memory mapped and the values are converted to
+    big-endian as they are copied in, without another copy of planes.
+    """
+    planes = np.asarray(planes)
+    if planes.size == 0:
+        return
+    planeSize = planes.shape[1] * planes.shape[2] * planes.itemsize
+    cube = np.memmap(
+        cubeFile,
+        dtype=planes.dtype.newbyteorder(">"),
+        mode="r+",
+        offset=dataOffset + chanStart * planeSize,
+        shape=planes.shape,
+    )
+    cube[...] = planes
+    cube.flush()
+    del cube
+
+
+def write_cube_region(cubeFile, dataOffset, shape, chanStart, x0, y0, block):
+    """Write a block of a tile into a file made by create_cube_file.
+
+    shape is the (nchan, ny, nx) shape of the whole cube and block is a
+    (nchan, ny, nx) array for the channels starting at chanStart and the
+    pixels starting at x0, y0.  The file is memory mapped so only the
+    pages holding the block are touched.
+    """
+    block = np.asarray(block)
+    cube = np.memmap(
+        cubeFile,
+        dtype=block.dtype.newbyteorder(">"),
+        mode="r+",
+        offset=dataOffset,
+        shape=tuple(shape),
+    )
+    nchan, ny, nx = block.shape
+    cube[chanStart : chanStart + nchan, y0 : y0 + ny, x0 : x0 + nx] = block
+    cube.flush()
+    del cube
+
+
+def _write_block(cubeFile, dataOffset, shape, chanStart, x0, y0, block):
+    if shape is None:
+        write_cube_planes(cubeFile, dataOffset, chanStart, block)
+    else:
+        write_cube_region(cubeFile, dataOffset, shape, chanStart, x0, y0, block)
+    return block_stats(block)
+
+
+def write_cube_blocks(blocks):
+    """Write blocks into several files made by create_cube_file at once.
+
+    blocks is a list of (cubeFile, dataOffset, shape, chanStart, x0, y0,
+    block) for write_cube_region, or with shape None for write_cube_planes
+    (x0 and y0 are then not used), for different files.  Each is written
+    in its own thread.  numpy does not hold the GIL while it copies the
+    values into the memory maps, so e.g. the cube and weight files of a
+    slab are filled at the same time.
+
+    Returns the cube_stats.block_stats of each block, worked out in the
+    same threads, for DATAMAX, DATAMIN and the CHANSTATS table.
+    """
+    if len(blocks) < 2:
+        return [_write_block(*args) for args in blocks]
+    with ThreadPoolExecutor(len(blocks)) as pool:
+        futures = [pool.submit(_write_block, *args) for args in blocks]
+        return [future.result() for future in futures]
+
+
+def update_cube_header(cubeFile, dataOffset, values, remove=()):
+    """Set and remove header keywords in a file made by create_cube_file.
+
+    values is a dictionary of keyword values (or (value, comment) tuples),
+    remove is a list of keywords to delete.  The header is rewritten in
+    place, so it must not grow past its original size.
+    """
+    with open(cubeFile, "rb+") as f:
+        hdr = pyfits.Header.fromstring(f.read(dataOffset).decode("ascii"))
+        for key in remove:
+            if key in hdr:
+                del hdr[key]
+        for key in values:
+            hdr[key] = values[key]
+
+        headerBytes = hdr.tostring().encode("ascii")
+        # pad out with blank cards if keywords were removed
+        while len(headerBytes) < dataOffset:
+            hdr.append(pyfits.Card(), useblanks=False, bottom=True)
+            headerBytes = hdr.tostring().encode("ascii")
+        if len(headerBytes) != dataOffset:
+            raise ValueError("Updated header of %s does not fit in place" % cubeFile)
+
+        f.seek(0)
+        f.write(headerBytes)